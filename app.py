@@ -10,7 +10,7 @@ load_dotenv(override=True)
 
 
 
-from src.application.mqtt import send_mqtt_message, MqttSubscriber
+from src.application.mqtt import send_mqtt_message, MqttSubscriber, get_default_publisher, stop_default_publisher
 import threading
 # Aggiungi dopo l'inizializzazione di mqtt_subscriber
 from src.digital_twin.dt_factory import DTFactory
@@ -20,6 +20,15 @@ from src.application.bot.handlers.dt_handlers import create_dt_handler, list_dt_
 from src.application.bot.handlers.dispenser_dt_handlers import add_dispenser_to_dt_handler, list_dt_devices_handler, check_irregularities_handler
 from src.application.bot.handlers.message_handlers import send_message_to_dispenser_handler
 from src.services.scheduler_service import SchedulerService
+from src.application.bot.notification_dispatcher import stop_notification_dispatcher
+from src.application.bot.chart_renderer import get_chart_renderer, stop_chart_renderer
+from src.application.bot.update_dispatcher import UpdateDispatcher
+from src.services.scheduler_leases import LocalLeaseStore, MongoLeaseStore, ShardLeaseManager
+from src.services.telemetry_buffer import TelemetryWriteBuffer
+from src.services.rollups import get_rollup_store
+from src.services.adherence import get_adherence_store
+from src.services.index_manager import IndexManager
+from src.services.collection_bootstrap import CollectionBootstrapper
 
 
 # Import configurations and handlers
@@ -29,6 +38,23 @@ from config.settings import (
     SERVER_HOST,
     SERVER_PORT,
     WEBHOOK_PATH,
+    DT_CACHE_SIZE,
+    MQTT_SUBSCRIBER_MODE,
+    TELEMETRY_FLUSH_INTERVAL_MS,
+    TELEMETRY_FLUSH_MAX_SAMPLES,
+    TELEMETRY_BUFFER_MAX_SAMPLES,
+    SCHEDULER_WORKERS,
+    SCHEDULER_TICK_DEADLINE,
+    SCHEDULER_SHARDS,
+    SCHEDULER_LEASE_STORE,
+    SCHEDULER_LEASE_TTL,
+    UPDATE_QUEUE_SIZE,
+    UPDATE_MAX_CONCURRENCY,
+    INDEX_SELF_CHECK,
+    DR_VALIDATION_LEVEL,
+    DR_VALIDATION_ACTION,
+    DR_COLLATION_LOCALE,
+    DR_CLUSTERED_ID,
     # Assicurati che la variabile MQTT_TOPIC_ENVIRONMENTAL sia importata correttamente
     # e che le variabili MQTT_TOPIC_TEMP e MQTT_TOPIC_HUMIDITY siano rimosse o commentate
 )
@@ -37,7 +63,8 @@ from src.application.bot.handlers.command_filter import restrict_patient_command
 from src.application.bot.handlers.user_handler import create_patient_handler
 from src.application.bot.handlers.base_handlers import start_handler, help_handler, echo_handler
 from src.application.bot.handlers.user_handler import register_handler, login_handler, logout_handler, status_handler, create_patient_handler
-from src.application.bot.routes.webhook_routes import webhook, init_routes
+from src.application.bot.routes.webhook_routes import webhook, init_routes, run_on_bot_loop
+from src.application.api import register_api_blueprints
 from src.application.bot.handlers.medicine_handlers import (
     create_medicine_handler,
     list_my_medicines_handler,
@@ -52,8 +79,6 @@ from src.virtualization.digital_replica.schema_registry import SchemaRegistry
 from config.config_loader import ConfigLoader
 
 
-# Apply nest_asyncio (useful when mixing Flask and asyncio)
-nest_asyncio.apply()
 
 # Global variables for cleanup
 http_tunnel = None
@@ -65,6 +90,7 @@ def create_app():
     """Create and configure the Flask application"""
     app = Flask(__name__)
     app.register_blueprint(webhook)
+    register_api_blueprints(app)
     return app
 
 def setup_handlers(application):
@@ -124,19 +150,8 @@ def setup_handlers(application):
 
     
 
-def main():
-    global http_tunnel, public_url
-    
-    # Verify essential variables
-    
-    # Create a persistent event loop
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    
-    # Create Flask app prima di usarla
-    app = create_app()
-    
-    # Initialize bot application with persistence
+def create_bot_application(app, loop):
+    """Crea l'applicazione Telegram sul loop indicato e registra gli handler"""
     application = Application.builder().token(TELEGRAM_TOKEN).build()
     # Utilizziamo un solo loop principale per tutte le operazioni
     application.loop = loop
@@ -145,158 +160,284 @@ def main():
     app.config['TELEGRAM_BOT'] = application.bot
     app.config['TELEGRAM_LOOP'] = loop
     
-    # Inizializza prima l'applicazione
-    loop.run_until_complete(application.initialize())
-    
-    # Poi configura gli handlers
     setup_handlers(application)
+    return application
+
+def start_services(app, application, loop):
+    """
+    Avvia database, store, MQTT e scheduler e li registra in app.config e bot_data.
+
+    Viene chiamata dal server di sviluppo (main) e dal lifespan del server ASGI
+    (asgi.py), sempre fuori dal loop del bot, che deve essere già in esecuzione.
+    """
+    # Load database configuration
+    db_config = ConfigLoader.load_database_config(".\\config\\database.yaml")
+    connection_string = ConfigLoader.build_connection_string(db_config)
+    
+    # Initialize schema registry and load schemas
+    schema_registry = SchemaRegistry()
+    schema_registry.load_schema(
+        schema_type="dispenser_medicine",
+        yaml_path=".\\src\\virtualization\\templates\\dispenser_medicine.yaml"
+    )
+    schema_registry.load_schema(
+        schema_type="user", 
+        yaml_path=".\\src\\virtualization\\templates\\user.yaml"
+    )
+    
+    # Initialize database service
+    db_service = DatabaseService(
+        connection_string=connection_string,
+        db_name=db_config["settings"]["name"],
+        schema_registry=schema_registry
+    )
+    db_service.connect()
+    try:
+        # Validatori dello SchemaRegistry installati sul server (prima degli indici, che creerebbero le collezioni)
+        CollectionBootstrapper(
+            db_service,
+            validation_level=DR_VALIDATION_LEVEL,
+            validation_action=DR_VALIDATION_ACTION,
+            collation_locale=DR_COLLATION_LOCALE or None,
+            clustered_id=DR_CLUSTERED_ID,
+        ).apply()
+    except Exception as e:
+        print(f"Errore nell'installazione dei validatori: {e}")
+    try:
+        # Indici dichiarati nei template YAML e di digital_twins: crea solo quelli mancanti
+        index_manager = IndexManager(db_service)
+        index_manager.apply()
+        if INDEX_SELF_CHECK:
+            index_manager.verify()
+    except Exception as e:
+        print(f"Errore nella creazione degli indici: {e}")
+    try:
+        # Sposta gli storici ancora incorporati nei dispenser nelle collezioni di telemetria
+        db_service.migrate_embedded_telemetry()
+    except Exception as e:
+        print(f"Errore nella migrazione della telemetria: {e}")
+    try:
+        # Rollup incrementali delle misure ambientali (statistiche dei DT)
+        rollup_store = get_rollup_store(db_service)
+        rollup_store.rebuild_if_needed()
+    except Exception as e:
+        print(f"Errore nell'inizializzazione dei rollup: {e}")
+    try:
+        # Riepiloghi giornalieri dell'aderenza, ricostruiti dagli eventi porta al primo avvio
+        adherence_store = get_adherence_store(db_service)
+        if adherence_store.is_empty():
+            adherence_store.rebuild()
+    except Exception as e:
+        print(f"Errore nell'inizializzazione dei riepiloghi di aderenza: {e}")
+    user_service = UserService(db_service)
+    
+    # Publisher MQTT persistente condiviso (reminder, messaggi bot, subscriber)
+    mqtt_publisher = get_default_publisher()
+    app.config['MQTT_PUBLISHER'] = mqtt_publisher
+
+    # Buffer write-behind per la telemetria ambientale
+    telemetry_buffer = TelemetryWriteBuffer(
+        db_service,
+        flush_interval_ms=TELEMETRY_FLUSH_INTERVAL_MS,
+        max_batch_samples=TELEMETRY_FLUSH_MAX_SAMPLES,
+        max_pending_samples=TELEMETRY_BUFFER_MAX_SAMPLES,
+    )
+    telemetry_buffer.start()
+    app.config['TELEMETRY_BUFFER'] = telemetry_buffer
+
+    # Initialize and start MQTT subscriber
+    if MQTT_SUBSCRIBER_MODE == "async":
+        # Il subscriber asyncio condivide il loop del bot (già avviato sul thread bot-loop)
+        from src.application.mqtt_async import AsyncMqttSubscriber
+        mqtt_subscriber = AsyncMqttSubscriber(
+            db_service=db_service, publisher=mqtt_publisher, telemetry_buffer=telemetry_buffer
+        )
+        mqtt_subscriber.start(loop)
+    else:
+        mqtt_subscriber = MqttSubscriber(
+            db_service=db_service, app=app, publisher=mqtt_publisher, telemetry_buffer=telemetry_buffer
+        )
+        mqtt_subscriber.start()
+    
+    # Store services in both Flask app config and Telegram bot data
+    app.config['DB_SERVICE'] = db_service
+    app.config['USER_SERVICE'] = user_service
+    app.config['MQTT_SUBSCRIBER'] = mqtt_subscriber
+    dt_factory = DTFactory(db_service, schema_registry, cache_size=DT_CACHE_SIZE)
+    dt_manager = DTManager(dt_factory)
     
-    webhook_url = None
+    # Collega MQTT_SUBSCRIBER con DTFactory
+    mqtt_subscriber.set_dt_factory(dt_factory)
+    
+    # Memorizza configurazioni in modo coerente e rimuovi il doppio loop
+    app.config['DT_FACTORY'] = dt_factory
+    app.config['DT_MANAGER'] = dt_manager
+    application.bot_data['dt_factory'] = dt_factory
+    application.bot_data['dt_manager'] = dt_manager
+    
+    # Memorizza configurazioni in modo coerente e rimuovi il doppio loop
+    application.bot_data['db_service'] = db_service
+    application.bot_data['user_service'] = user_service
+    application.bot_data['schema_registry'] = schema_registry
+    application.bot_data['mqtt_subscriber'] = mqtt_subscriber
+
+    # Inizializza e avvia lo scheduler dei servizi DT
+    # Scheduler a eventi: interval è la cadenza degli allarmi per una porta rimasta aperta
+    lease_manager = None
+    if SCHEDULER_SHARDS > 0:
+        # Più istanze: ognuna esegue solo i DT degli shard di cui possiede il lease
+        lease_store = (MongoLeaseStore(db_service.db) if SCHEDULER_LEASE_STORE == "mongo"
+                       else LocalLeaseStore())
+        lease_manager = ShardLeaseManager(lease_store, SCHEDULER_SHARDS, ttl=SCHEDULER_LEASE_TTL)
+    scheduler_service = SchedulerService(
+        dt_factory, db_service, interval=60,
+        workers=SCHEDULER_WORKERS, tick_deadline=SCHEDULER_TICK_DEADLINE,
+        lease_manager=lease_manager
+    )
+    scheduler_service.start()
+    
+    # Memorizza lo scheduler nella configurazione dell'app
+    app.config['SCHEDULER_SERVICE'] = scheduler_service
+
+    return db_service
+
+def stop_services(app):
+    """Ferma MQTT, scheduler e code in uscita, poi chiude il database"""
+    # Ferma la ricezione MQTT e scrive la telemetria ancora in memoria prima di chiudere il DB
+    mqtt_subscriber = app.config.get('MQTT_SUBSCRIBER')
+    if mqtt_subscriber:
+        print("Stopping MQTT subscriber...")
+        mqtt_subscriber.stop()
+        print("MQTT subscriber stopped.")
+
+    scheduler_service = app.config.get('SCHEDULER_SERVICE')
+    if scheduler_service:
+        print("Stopping DT service scheduler...")
+        scheduler_service.stop()
+        print("DT service scheduler stopped.")
+
+    telemetry_buffer = app.config.get('TELEMETRY_BUFFER')
+    if telemetry_buffer:
+        print("Flushing telemetry buffer...")
+        telemetry_buffer.stop()
+    stop_default_publisher()
+
+    # Consegna le notifiche Telegram ancora in coda
+    stop_notification_dispatcher()
+    stop_chart_renderer()
+
+    # Close database connection
+    db_service = app.config.get('DB_SERVICE')
+    if db_service and hasattr(db_service, 'is_connected') and db_service.is_connected():
+        print("Closing database connection...")
+        db_service.disconnect()
+        print("Database connection closed.")
+
+def resolve_webhook_url():
+    """URL pubblico del webhook: tunnel ngrok se configurato, altrimenti l'indirizzo locale"""
+    global http_tunnel, public_url
     if NGROK_TOKEN:
         try:
             conf.get_default().auth_token = NGROK_TOKEN
             conf.get_default().region = "eu"  # Set your region
             http_tunnel = ngrok.connect(SERVER_PORT, "http")
             public_url = http_tunnel.public_url
-            webhook_url = f"{public_url}{WEBHOOK_PATH}"
+            return f"{public_url}{WEBHOOK_PATH}"
         except Exception as e:
-            webhook_url = f"http://{SERVER_HOST}:{SERVER_PORT}{WEBHOOK_PATH}"
-    else:
-        webhook_url = f"http://{SERVER_HOST}:{SERVER_PORT}{WEBHOOK_PATH}"
+            pass
+    return f"http://{SERVER_HOST}:{SERVER_PORT}{WEBHOOK_PATH}"
+
+def disconnect_ngrok():
+    if http_tunnel and public_url:
+        print("Disconnecting ngrok tunnel...")
+        try:
+            ngrok.disconnect(public_url)
+            print("ngrok tunnel disconnected.")
+        except Exception as e:
+            print(f"Error disconnecting ngrok: {repr(e)}")
+        try:
+            ngrok.kill()
+            print("ngrok process terminated.")
+        except Exception as e:
+            print(f"Error terminating ngrok process: {repr(e)}")
+
+def main():
+    # Create a persistent event loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # Apply nest_asyncio (solo per il server di sviluppo, asgi.py usa il loop di uvicorn)
+    nest_asyncio.apply(loop)
+    
+    # Create Flask app prima di usarla
+    app = create_app()
+
+    # Pool di processi per i grafici, preriscaldato prima di ricevere richieste
+    try:
+        get_chart_renderer().start()
+    except Exception as e:
+        print(f"Errore nell'avvio del renderer dei grafici: {e}")
+    
+    # Initialize bot application
+    application = create_bot_application(app, loop)
+    loop.run_until_complete(application.initialize())
     
     # Set webhook
-    if webhook_url:
-        loop.run_until_complete(application.bot.set_webhook(webhook_url))
-    else:
-        return
+    webhook_url = resolve_webhook_url()
+    loop.run_until_complete(application.bot.set_webhook(webhook_url))
     
-    # Ora configura le routes passando l'applicazione Telegram
-    init_routes(application)
+    # Il loop del bot gira in modo continuo su un thread dedicato: il webhook vi
+    # accoda gli update e risponde subito, senza attendere la fine degli handler
+    loop_thread = threading.Thread(target=loop.run_forever, name="bot-loop", daemon=True)
+    loop_thread.start()
+    update_dispatcher = UpdateDispatcher(
+        application, loop, max_pending=UPDATE_QUEUE_SIZE, max_concurrent=UPDATE_MAX_CONCURRENCY
+    )
     
-    try:
-        # Load database configuration
-        db_config = ConfigLoader.load_database_config(".\\config\\database.yaml")
-        connection_string = ConfigLoader.build_connection_string(db_config)
-        
-        # Initialize schema registry and load schemas
-        schema_registry = SchemaRegistry()
-        schema_registry.load_schema(
-            schema_type="dispenser_medicine",
-            yaml_path=".\\src\\virtualization\\templates\\dispenser_medicine.yaml"
-        )
-        schema_registry.load_schema(
-            schema_type="user", 
-            yaml_path=".\\src\\virtualization\\templates\\user.yaml"
-        )
-        
-        # Initialize database service
-        db_service = DatabaseService(
-            connection_string=connection_string,
-            db_name=db_config["settings"]["name"],
-            schema_registry=schema_registry
-        )
-        db_service.connect()
-        user_service = UserService(db_service)
-        
-        # Initialize and start MQTT subscriber
-        mqtt_subscriber = MqttSubscriber(db_service=db_service, app=app)
-        mqtt_subscriber.start()
-        
-        # Store services in both Flask app config and Telegram bot data
-        app.config['DB_SERVICE'] = db_service
-        app.config['USER_SERVICE'] = user_service
-        app.config['MQTT_SUBSCRIBER'] = mqtt_subscriber
-        dt_factory = DTFactory(db_service, schema_registry)
-        dt_manager = DTManager(dt_factory)
-        
-        # Collega MQTT_SUBSCRIBER con DTFactory
-        mqtt_subscriber.set_dt_factory(dt_factory)
-        
-        # Memorizza configurazioni in modo coerente e rimuovi il doppio loop
-        app.config['DT_FACTORY'] = dt_factory
-        app.config['DT_MANAGER'] = dt_manager
-        application.bot_data['dt_factory'] = dt_factory
-        application.bot_data['dt_manager'] = dt_manager
-        
-        # Memorizza configurazioni in modo coerente e rimuovi il doppio loop
-        application.bot_data['db_service'] = db_service
-        application.bot_data['user_service'] = user_service
-        application.bot_data['schema_registry'] = schema_registry
-
-        # Inizializza e avvia lo scheduler dei servizi DT
-        scheduler_service = SchedulerService(dt_factory, db_service, interval=60)  # Aumenta a 60 secondi
-        scheduler_service.start()
-        
-        # Memorizza lo scheduler nella configurazione dell'app
-        app.config['SCHEDULER_SERVICE'] = scheduler_service
+    # Ora configura le routes passando l'applicazione Telegram e la coda degli update
+    init_routes(application, update_dispatcher)
     
+    try:
+        start_services(app, application, loop)
     except Exception as e:
-        if db_service and hasattr(db_service, 'is_connected') and db_service.is_connected():
-            db_service.disconnect()
-        if http_tunnel and public_url:
-            ngrok.disconnect(public_url)
-            ngrok.kill()
+        print(f"Errore nell'avvio dei servizi: {e}")
+        stop_services(app)
+        disconnect_ngrok()
         return
     
-    # Run Flask app
+    # Run Flask app (server di sviluppo; in produzione usare asgi.py)
     try:
         print(f"Starting Flask server on {SERVER_HOST}:{SERVER_PORT}")
         app.run(host=SERVER_HOST, port=SERVER_PORT, debug=False, use_reloader=False)
         
     except KeyboardInterrupt:
-        # Shutdown Telegram application
+        pass
+    finally:
+        # Werkzeug intercetta Ctrl+C e app.run ritorna normalmente: la chiusura va eseguita comunque
+        # Shutdown Telegram application (dopo aver elaborato gli update già accodati)
         print("Shutting down Telegram application...")
         try:
-            loop.run_until_complete(application.stop())
-            loop.run_until_complete(application.shutdown())
+            update_dispatcher.stop()
+            run_on_bot_loop(application.stop())
+            run_on_bot_loop(application.shutdown())
             print("Telegram application shut down.")
         except Exception as e:
             print(f"Error shutting down Telegram application: {repr(e)}")
-        
-        # Close database connection
-        if db_service and hasattr(db_service, 'is_connected') and db_service.is_connected():
-            print("Closing database connection...")
-            db_service.disconnect()
-            print("Database connection closed.")
+
+        # In modalità async il subscriber gira sul loop del bot: va fermato prima del loop
+        stop_services(app)
         
         # Close event loop
         if loop.is_running():
             print("Stopping event loop...")
             loop.call_soon_threadsafe(loop.stop)
+            loop_thread.join(timeout=5)
             print("Event loop stopped.")
         loop.close()
         
-        
-        if 'mqtt_subscriber' in locals() and mqtt_subscriber:
-            mqtt_subscriber.stop()
-        if hasattr(app.config, 'MQTT_SUBSCRIBER') and app.config['MQTT_SUBSCRIBER']:
-            print("Stopping MQTT subscriber...")
-            app.config['MQTT_SUBSCRIBER'].stop()
-            print("MQTT subscriber stopped.")
-            
-        # Arresta anche lo scheduler
-        if 'scheduler_service' in locals() and scheduler_service:
-            print("Stopping DT service scheduler...")
-            scheduler_service.stop()
-            print("DT service scheduler stopped.")
-            
-        
-        
         # Disconnect ngrok
-        if http_tunnel and public_url:
-            print("Disconnecting ngrok tunnel...")
-            try:
-                ngrok.disconnect(public_url)
-                print("ngrok tunnel disconnected.")
-            except Exception as e:
-                print(f"Error disconnecting ngrok: {repr(e)}")
-            try:
-                ngrok.kill()
-                print("ngrok process terminated.")
-            except Exception as e:
-                print(f"Error terminating ngrok process: {repr(e)}")
+        disconnect_ngrok()
         
         print("Cleanup completed.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,161 @@
+"""
+Server di produzione ASGI per il webhook Telegram e le API REST.
+
+    python asgi.py
+    uvicorn asgi:app --host 0.0.0.0 --port 88 --loop asyncio --lifespan on
+
+Il loop di uvicorn è anche il loop dell'applicazione Telegram. Il webhook è
+servito direttamente in asyncio e accodato all'UpdateDispatcher; le route
+Flask (API REST e le altre route del blueprint) girano su un pool di
+WSGI_THREADS thread. Il lifespan avvia e ferma database, subscriber MQTT e
+scheduler con le stesse funzioni del server di sviluppo (app.py).
+
+Va eseguito con un solo processo (ASGI_WORKERS = 1, niente --workers): lo
+stato di login in context.user_data di python-telegram-bot e l'ordine degli
+update di una chat sono tenuti nel processo, e le cache dei DT, dei
+collegamenti replica -> DT, dell'instradamento delle notifiche e dei limiti
+personalizzati non vengono invalidate tra processi. Per scalare servono prima
+una persistence condivisa di PTB e un'invalidazione delle cache tra processi;
+più istanze su host diversi vanno comunque configurate con SCHEDULER_SHARDS e
+MQTT_SHARED_GROUP.
+"""
+import asyncio
+import json
+
+from telegram import Update
+
+try:
+    import uvicorn
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    uvicorn = None
+    WSGIMiddleware = None
+
+import app as server
+from src.application.bot.update_dispatcher import UpdateDispatcher
+from config.settings import (
+    SERVER_HOST,
+    SERVER_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_BASE_URL,
+    UPDATE_QUEUE_SIZE,
+    UPDATE_MAX_CONCURRENCY,
+    ASGI_WORKERS,
+    WSGI_THREADS,
+)
+
+
+class TelegramASGI:
+    """Applicazione ASGI: webhook nativo asyncio, route Flask via WSGI e lifespan dei servizi"""
+
+    def __init__(self):
+        if WSGIMiddleware is None:
+            raise ImportError("asgi.py richiede i pacchetti 'uvicorn' e 'a2wsgi'")
+        if ASGI_WORKERS > 1:
+            raise RuntimeError(
+                "ASGI_WORKERS > 1 non è supportato: sessioni Telegram (user_data) e cache "
+                "dei DT sono per processo e non vengono condivise tra worker"
+            )
+        self.flask_app = server.create_app()
+        self.wsgi = WSGIMiddleware(self.flask_app, workers=WSGI_THREADS)
+        self.application = None
+        self.update_dispatcher = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif (scope["type"] == "http" and scope["method"] == "POST"
+              and scope["path"] == WEBHOOK_PATH and self.update_dispatcher is not None):
+            await self._webhook(receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def startup(self):
+        loop = asyncio.get_running_loop()
+
+        # Pool di processi per i grafici, preriscaldato prima di ricevere richieste
+        try:
+            await asyncio.to_thread(server.get_chart_renderer().start)
+        except Exception as e:
+            print(f"Errore nell'avvio del renderer dei grafici: {e}")
+
+        self.application = server.create_bot_application(self.flask_app, loop)
+        await self.application.initialize()
+        if WEBHOOK_BASE_URL:
+            await self.application.bot.set_webhook(f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+        self.update_dispatcher = UpdateDispatcher(
+            self.application, loop, max_pending=UPDATE_QUEUE_SIZE, max_concurrent=UPDATE_MAX_CONCURRENCY
+        )
+        server.init_routes(self.application, self.update_dispatcher)
+
+        # Database, MQTT e scheduler si avviano con chiamate bloccanti: fuori dal loop
+        await asyncio.to_thread(server.start_services, self.flask_app, self.application, loop)
+        print(f"ASGI: servizi avviati (webhook su {WEBHOOK_PATH})")
+
+    async def shutdown(self):
+        # Elabora gli update già accodati, poi ferma i servizi e l'applicazione Telegram
+        if self.update_dispatcher is not None:
+            await self.update_dispatcher.join()
+        await asyncio.to_thread(server.stop_services, self.flask_app)
+        if self.application is not None:
+            await self.application.shutdown()
+        print("ASGI: servizi fermati")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    print(f"ASGI: errore nell'avvio dei servizi: {e!r}")
+                    await send({"type": "lifespan.startup.failed", "message": repr(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                try:
+                    await self.shutdown()
+                except Exception as e:
+                    print(f"ASGI: errore nell'arresto dei servizi: {e!r}")
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _webhook(self, receive, send):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError):
+            await _respond(send, 400, b"Bad Request")
+            return
+        if self.update_dispatcher.submit(update):
+            await _respond(send, 200, b"OK")
+        else:
+            # Coda piena: Telegram riproverà a consegnare l'update
+            await _respond(send, 503, b"Busy")
+
+
+async def _respond(send, status, body):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+app = TelegramASGI()
+
+
+if __name__ == "__main__":
+    if uvicorn is None:
+        raise ImportError("asgi.py richiede i pacchetti 'uvicorn' e 'a2wsgi'")
+    # Loop asyncio standard: l'applicazione Telegram e il subscriber MQTT async lo condividono
+    uvicorn.run("asgi:app", host=SERVER_HOST, port=SERVER_PORT,
+                loop="asyncio", lifespan="on")
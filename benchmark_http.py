@@ -0,0 +1,96 @@
+"""
+Misura richieste al secondo e latenze del webhook Telegram e delle API REST.
+
+Esempi:
+    python benchmark_http.py --url http://localhost:88 --target webhook
+    python benchmark_http.py --url http://localhost:88 --target api --path /api/dt/ -c 32 -n 5000
+
+Il target "webhook" invia update sintetici senza messaggio (nessun handler
+li gestisce), quindi misura il costo di ricezione e accodamento e non quello
+degli handler; i tempi degli handler si leggono su /telegram/stats.
+Confrontare app.py (server di sviluppo Flask) e asgi.py a parità di parametri.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import statistics
+import threading
+import time
+from urllib.parse import urlparse
+
+
+def _worker(parsed, method, path, body_factory, requests_per_worker, results):
+    connection_class = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+    connection = connection_class(parsed.hostname, parsed.port, timeout=30)
+    latencies, errors = [], 0
+    for _ in range(requests_per_worker):
+        body = body_factory()
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = connection_class(parsed.hostname, parsed.port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+    results.append((latencies, errors))
+
+
+def run(url, target, path, concurrency, total):
+    parsed = urlparse(url)
+    if target == "webhook":
+        update_ids = itertools.count(int(time.time()))
+        lock = threading.Lock()
+
+        def body_factory():
+            with lock:
+                update_id = next(update_ids)
+            return json.dumps({"update_id": update_id})
+        method, path = "POST", path or "/telegram"
+    else:
+        def body_factory():
+            return None
+        method, path = "GET", path or "/api/dt/"
+
+    per_worker = max(1, total // concurrency)
+    results = []
+    threads = [
+        threading.Thread(target=_worker, args=(parsed, method, path, body_factory, per_worker, results))
+        for _ in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for worker_latencies, _ in results for latency in worker_latencies)
+    errors = sum(worker_errors for _, worker_errors in results)
+    print(f"{method} {url.rstrip('/')}{path}: {len(latencies)} richieste, {errors} errori, "
+          f"concorrenza {concurrency}, {elapsed:.2f}s")
+    if latencies:
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+        print(f"  {len(latencies) / elapsed:.1f} req/s")
+        print(f"  latenza ms: media {statistics.mean(latencies) * 1000:.1f}, p50 {percentile(0.5):.1f}, "
+              f"p95 {percentile(0.95):.1f}, p99 {percentile(0.99):.1f}, max {latencies[-1] * 1000:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark HTTP del webhook e delle API REST")
+    parser.add_argument("--url", default="http://localhost:88", help="Indirizzo del server")
+    parser.add_argument("--target", choices=["webhook", "api"], default="webhook")
+    parser.add_argument("--path", default=None, help="Percorso (default: /telegram o /api/dt/)")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="Connessioni parallele")
+    parser.add_argument("-n", "--requests", type=int, default=2000, help="Richieste totali")
+    args = parser.parse_args()
+    run(args.url, args.target, args.path, args.concurrency, args.requests)
@@ -22,7 +22,63 @@ MQTT_BROKER = os.getenv("MQTT_BROKER", "DEFAULT_MQTT_BROKER")
 MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
 MQTT_USERNAME = os.getenv("MQTT_USERNAME", "DEFAULT_MQTT_USERNAME")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD", "DEFAULT_MQTT_PASSWORD")
+# Worker che elaborano i messaggi in ingresso (ordinati per dispositivo) e dimensione delle code
+MQTT_WORKERS = int(os.getenv("MQTT_WORKERS", 4))
+MQTT_WORKER_QUEUE_SIZE = int(os.getenv("MQTT_WORKER_QUEUE_SIZE", 1000))
+# "thread": subscriber paho con worker pool; "async" (sperimentale): subscriber asyncio sul loop del bot,
+# gli handler (accesso al DB sincrono) restano eseguiti su thread del default executor
+MQTT_SUBSCRIBER_MODE = os.getenv("MQTT_SUBSCRIBER_MODE", "thread").lower()
+MQTT_ASYNC_MAX_INFLIGHT = int(os.getenv("MQTT_ASYNC_MAX_INFLIGHT", 1000))
+# Gruppo per le sottoscrizioni condivise ($share) tra più processi server; vuoto = disattivate
+MQTT_SHARED_GROUP = os.getenv("MQTT_SHARED_GROUP", "")
 
+# Telemetria ambientale: scrittura differita a lotti (flush ogni N ms o M campioni)
+TELEMETRY_FLUSH_INTERVAL_MS = int(os.getenv("TELEMETRY_FLUSH_INTERVAL_MS", 1000))
+TELEMETRY_FLUSH_MAX_SAMPLES = int(os.getenv("TELEMETRY_FLUSH_MAX_SAMPLES", 500))
+TELEMETRY_BUFFER_MAX_SAMPLES = int(os.getenv("TELEMETRY_BUFFER_MAX_SAMPLES", 10000))
+
+
+# Digital Twin Configuration
+# Numero massimo di istanze DigitalTwin tenute in cache (LRU)
+DT_CACHE_SIZE = int(os.getenv("DT_CACHE_SIZE", 256))
+# Durata (secondi) della cache dei destinatari delle notifiche
+NOTIFICATION_ROUTE_TTL = int(os.getenv("NOTIFICATION_ROUTE_TTL", 30))
+# Coda delle notifiche Telegram: worker, limiti (msg/s globali e per chat), tentativi e capienza
+NOTIFICATION_WORKERS = int(os.getenv("NOTIFICATION_WORKERS", 4))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+NOTIFICATION_MAX_RETRIES = int(os.getenv("NOTIFICATION_MAX_RETRIES", 5))
+NOTIFICATION_QUEUE_SIZE = int(os.getenv("NOTIFICATION_QUEUE_SIZE", 10000))
+# Scheduler: thread che eseguono in parallelo i controlli scaduti e tempo massimo di attesa per tick
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", 8))
+SCHEDULER_TICK_DEADLINE = float(os.getenv("SCHEDULER_TICK_DEADLINE", 30))
+# Modalità partizionata per più istanze: 0 = disattivata, altrimenti numero di shard dei DT
+SCHEDULER_SHARDS = int(os.getenv("SCHEDULER_SHARDS", 0))
+# "mongo": lease condivisi nella collezione scheduler_leases; "local": solo in memoria
+SCHEDULER_LEASE_STORE = os.getenv("SCHEDULER_LEASE_STORE", "mongo").lower()
+SCHEDULER_LEASE_TTL = float(os.getenv("SCHEDULER_LEASE_TTL", 30))
+# Allarmi ambientali: secondi tra due notifiche dello stesso allarme e prima dell'escalation
+ALERT_COOLDOWN_SECONDS = int(os.getenv("ALERT_COOLDOWN_SECONDS", 1800))
+ALERT_ESCALATE_SECONDS = int(os.getenv("ALERT_ESCALATE_SECONDS", 3600))
+# Grafici: processi dedicati al rendering e numero di immagini tenute in cache
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", 2))
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 128))
+# Fuso orario (es. "Europe/Rome") degli orari di assunzione; vuoto = ora locale del server
+SCHEDULE_TIMEZONE = os.getenv("SCHEDULE_TIMEZONE", "")
+# Verifica all'avvio (explain) che le query frequenti usino un indice e non un COLLSCAN
+INDEX_SELF_CHECK = os.getenv("INDEX_SELF_CHECK", "true").lower() in ("1", "true", "yes")
+# Validatori $jsonSchema delle collezioni DR: livello ("moderate", "strict", "off") e azione ("error", "warn")
+DR_VALIDATION_LEVEL = os.getenv("DR_VALIDATION_LEVEL", "moderate")
+DR_VALIDATION_ACTION = os.getenv("DR_VALIDATION_ACTION", "error")
+# Solo per le collezioni DR create da zero: collation (es. "it") e _id clustered (MongoDB >= 5.3)
+DR_COLLATION_LOCALE = os.getenv("DR_COLLATION_LOCALE", "")
+DR_CLUSTERED_ID = os.getenv("DR_CLUSTERED_ID", "false").lower() in ("1", "true", "yes")
+# Webhook Telegram: update in attesa prima di rispondere 503 e handler eseguiti in parallelo
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_MAX_CONCURRENCY = int(os.getenv("UPDATE_MAX_CONCURRENCY", 32))
+# Server ASGI (asgi.py): processi uvicorn (solo 1 supportato, vedi asgi.py) e thread che eseguono le route Flask
+ASGI_WORKERS = int(os.getenv("ASGI_WORKERS", 1))
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", 16))
 
 # Server Configuration
 SERVER_HOST = "0.0.0.0"
@@ -30,6 +86,8 @@ SERVER_PORT = 88
 
 # Webhook Configuration
 WEBHOOK_PATH = "/telegram"
+# URL pubblico del server ASGI (es. dietro un reverse proxy): se impostato, asgi.py registra il webhook
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
 
 # --- Database Configuration ---
 try:
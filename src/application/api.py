@@ -1,6 +1,8 @@
 from flask import Blueprint, request, jsonify, current_app
 from datetime import datetime
 from bson import ObjectId
+from src.services.rollups import WINDOWS
+from src.services import telemetry_arrays
 
 # Create blueprints for different API groups
 dt_api = Blueprint('dt_api', __name__, url_prefix='/api/dt')
@@ -94,11 +96,29 @@ def get_dt_stats(dt_id):
         params = request.args.to_dict()
         dr_type = params.get('dr_type')
         measure_type = params.get('measure_type')
-
-        stats = current_app.config['DT_FACTORY'].get_dt_instance(dt_id).execute_service(
+        window = params.get('window', 'all')
+        if window not in WINDOWS:
+            return jsonify({'error': f"Invalid window, expected one of: {', '.join(WINDOWS)}"}), 400
+
+        dt_instance = current_app.config['DT_FACTORY'].get_dt_instance(dt_id)
+
+        # Arbitrary time range or downsampled series: computed on the telemetry arrays
+        if any(key in params for key in ('start', 'end', 'points')):
+            try:
+                points = int(params['points']) if 'points' in params else None
+            except ValueError:
+                return jsonify({'error': 'points must be an integer'}), 400
+            stats = _range_stats(
+                dt_instance.digital_replicas, dr_type, measure_type,
+                params.get('start'), params.get('end'), points
+            )
+            return jsonify(stats), 200
+
+        stats = dt_instance.execute_service(
             'AggregationService',
             dr_type=dr_type,
-            attribute=measure_type
+            attribute=measure_type,
+            window=window
         )
 
         return jsonify(stats), 200
@@ -106,6 +126,37 @@ def get_dt_stats(dt_id):
         return jsonify({'error': str(e)}), 500
 
 
+def _range_stats(replicas, dr_type, measure_type, start, end, points):
+    """Statistics (and optionally an LTTB-downsampled series) of the DRs' environmental telemetry"""
+    db_service = current_app.config['DB_SERVICE']
+    by_type = {}
+    for dr in replicas:
+        if dr_type is not None and dr.get('type') != dr_type:
+            continue
+        for series_type, series in telemetry_arrays.load_series(db_service, dr['_id'], start=start, end=end).items():
+            if measure_type is None or series_type == measure_type:
+                by_type.setdefault(series_type, []).append(series)
+
+    stats = {}
+    for series_type, parts in by_type.items():
+        series = telemetry_arrays.merge(parts)
+        summary = telemetry_arrays.summarize(series)
+        if not summary:
+            continue
+        summary['last_time'] = summary['last_time'].isoformat()
+        if points:
+            sampled = telemetry_arrays.lttb(series, points)
+            summary['series'] = [
+                {'timestamp': t.isoformat(), 'value': v}
+                for t, v in zip(telemetry_arrays.to_datetimes(sampled.times), sampled.values.tolist())
+            ]
+        stats[series_type] = summary
+
+    if not stats:
+        return {"error": f"No measurements found for attribute {measure_type}"}
+    return stats
+
+
 @dt_api.route('/<dt_id>/services', methods=['POST'])
 def add_service_to_dt(dt_id):
     """Add a service to Digital Twin"""
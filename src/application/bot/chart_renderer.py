@@ -0,0 +1,211 @@
+import asyncio
+import io
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Hashable, Optional
+
+from src.services import telemetry_arrays
+
+
+def _init_worker() -> None:
+    """Inizializza un processo del pool: backend Agg e pyplot importati una sola volta"""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import matplotlib.dates  # noqa: F401
+
+    # Il primo rendering carica font e cache di matplotlib: lo si paga all'avvio
+    fig = plt.figure(figsize=(1, 1))
+    fig.savefig(io.BytesIO(), format="png")
+    plt.close(fig)
+
+
+def _ping() -> bool:
+    return True
+
+
+def render_environmental_chart(spec: Dict) -> bytes:
+    """
+    Disegna il grafico di temperatura e umidità (eseguita nei processi del pool).
+
+    Args:
+        spec: title, temperature/humidity (Series già ridotte o None) e i relativi limiti
+
+    Returns:
+        bytes: Immagine PNG
+    """
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    temp_data = spec.get("temperature")
+    humidity_data = spec.get("humidity")
+    temp_limits = spec.get("temperature_limits") or [18.0, 30.0]
+    humidity_limits = spec.get("humidity_limits") or [30.0, 70.0]
+
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 8), sharex=True)
+    fig.suptitle(f"Dati Ambientali - {spec.get('title', '')}", fontsize=16)
+
+    # Plot temperatura
+    if temp_data is not None and len(temp_data) > 1:
+        ax1.plot(telemetry_arrays.to_datetimes(temp_data.times), temp_data.values, 'r-', label='Temperatura')
+        ax1.set_ylabel('Temperatura (°C)')
+        ax1.set_title('Temperatura')
+        ax1.grid(True)
+
+        # Linee orizzontali per i limiti personalizzati
+        ax1.axhline(y=temp_limits[0], color='blue', linestyle='--', alpha=0.7,
+                    label=f'Min ({temp_limits[0]}°C)')
+        ax1.axhline(y=temp_limits[1], color='red', linestyle='--', alpha=0.7,
+                    label=f'Max ({temp_limits[1]}°C)')
+        ax1.legend()
+
+    # Plot umidità
+    if humidity_data is not None and len(humidity_data) > 1:
+        ax2.plot(telemetry_arrays.to_datetimes(humidity_data.times), humidity_data.values, 'b-', label='Umidità')
+        ax2.set_ylabel('Umidità (%)')
+        ax2.set_xlabel('Data/Ora')
+        ax2.set_title('Umidità')
+        ax2.grid(True)
+
+        ax2.axhline(y=humidity_limits[0], color='blue', linestyle='--', alpha=0.7,
+                    label=f'Min ({humidity_limits[0]}%)')
+        ax2.axhline(y=humidity_limits[1], color='red', linestyle='--', alpha=0.7,
+                    label=f'Max ({humidity_limits[1]}%)')
+        ax2.legend()
+
+    # Asse x leggibile e griglia secondaria
+    fig.autofmt_xdate()
+    ax2.xaxis.set_major_formatter(mdates.DateFormatter('%d/%m %H:%M'))
+    ax1.grid(which='minor', alpha=0.2)
+    ax2.grid(which='minor', alpha=0.2)
+    fig.tight_layout()
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=100)
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def series_version(*series) -> tuple:
+    """Versione dei dati di un grafico: cambia quando arriva un nuovo campione"""
+    return tuple(
+        (len(s), str(s.times[-1]), float(s.values[-1])) if s is not None and len(s) else (0,)
+        for s in series
+    )
+
+
+class ChartRenderer:
+    """
+    Pool di processi per il rendering dei grafici, fuori dal loop asyncio del bot.
+
+    I processi vengono avviati (con ``spawn``) e preriscaldati all'avvio, così
+    la prima richiesta non paga l'import di matplotlib. Le immagini sono tenute
+    in una cache LRU per chiave (dispositivo, filtro, versione dei dati): le
+    richieste ripetute dello stesso grafico non vengono ridisegnate, e quelle
+    contemporanee per la stessa chiave condividono un unico rendering.
+    """
+
+    def __init__(self, workers: int = 2, cache_size: int = 128):
+        self.workers = workers
+        self.cache_size = cache_size
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._cache: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.metrics = {"rendered": 0, "cache_hits": 0, "shared": 0, "errors": 0}
+
+    def start(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                return
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+            pool = self._pool
+        # Avvia subito tutti i processi, ognuno esegue l'inizializzazione
+        for future in [pool.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+        print(f"ChartRenderer: avviato con {self.workers} processi")
+
+    def stop(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self._cache.clear()
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+            print("ChartRenderer: fermato")
+
+    async def render(self, key: Hashable, spec: Dict) -> bytes:
+        """PNG del grafico descritto da ``spec``, dalla cache se già disegnato per ``key``"""
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.metrics["cache_hits"] += 1
+                return cached
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.metrics["shared"] += 1
+            pool = self._pool
+
+        if pending is not None:
+            return await asyncio.shield(pending)
+        if pool is None:
+            # Avvio ritardato: il preriscaldamento non deve bloccare il loop del bot
+            await asyncio.to_thread(self.start)
+            pool = self._pool
+
+        future = asyncio.wrap_future(pool.submit(render_environmental_chart, spec))
+        with self._lock:
+            self._pending[key] = future
+        try:
+            image = await future
+        except Exception:
+            with self._lock:
+                self.metrics["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+        with self._lock:
+            self.metrics["rendered"] += 1
+            self._cache[key] = image
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return image
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.metrics)
+            stats["cached"] = len(self._cache)
+            stats["pending"] = len(self._pending)
+        return stats
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_chart_renderer() -> ChartRenderer:
+    """Renderer condiviso dal processo (il pool parte con start() o al primo grafico)"""
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                from config.settings import CHART_WORKERS, CHART_CACHE_SIZE
+                _renderer = ChartRenderer(workers=CHART_WORKERS, cache_size=CHART_CACHE_SIZE)
+    return _renderer
+
+
+def stop_chart_renderer() -> None:
+    """Ferma il pool di rendering condiviso (se è stato avviato)"""
+    global _renderer
+    with _renderer_lock:
+        if _renderer is not None:
+            _renderer.stop()
+            _renderer = None
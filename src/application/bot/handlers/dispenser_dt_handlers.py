@@ -52,15 +52,14 @@ async def add_dispenser_to_dt_handler(update: Update, context: ContextTypes.DEFA
         dt_name = dt.get('name', 'Sconosciuto')
 
         # Verifica se il dispenser è già collegato ad altri Digital Twin
-        collection = db_service.db["digital_twins"]
-        query = {"digital_replicas": {"$elemMatch": {"id": dispenser_id, "type": "dispenser_medicine"}}}
         connected_dts = []
         
-        for connected_dt in collection.find(query):
-            connected_dt_id = str(connected_dt.get("_id"))
+        for connected_dt_id in dt_factory.find_dts_with_dr("dispenser_medicine", dispenser_id):
             # Non includere il DT di destinazione se già c'è
             if connected_dt_id != dt_id:
-                connected_dts.append(connected_dt)
+                connected_dt = dt_factory.get_dt(connected_dt_id)
+                if connected_dt:
+                    connected_dts.append(connected_dt)
         
         # Se il dispenser è già collegato ad altri DT, rimuoverlo da quelli
         transfer_message = ""
@@ -69,15 +68,9 @@ async def add_dispenser_to_dt_handler(update: Update, context: ContextTypes.DEFA
                 old_dt_id = str(old_dt.get("_id"))
                 old_dt_name = old_dt.get('name', 'Digital Twin')
                 
-                # Rimuovi la digital replica dal documento DT
-                digital_replicas = old_dt.get('digital_replicas', [])
-                updated_replicas = [dr for dr in digital_replicas if not (dr.get('id') == dispenser_id and dr.get('type') == "dispenser_medicine")]
-                
-                # Aggiorna il documento DT con le digital replicas filtrate
-                collection.update_one(
-                    {"_id": old_dt_id},
-                    {"$set": {"digital_replicas": updated_replicas}}
-                )
+                # Rimuovi la digital replica passando dalla factory, così anche
+                # l'istanza DT in cache resta coerente
+                dt_factory.remove_digital_replica(old_dt_id, dispenser_id)
                 
                 transfer_message = f"⚠️ Il dispenser era collegato a '{old_dt_name}' ed è stato spostato."
                 print(f"Dispenser {dispenser_id} rimosso dal Digital Twin {old_dt_id} e spostato a {dt_id}")
@@ -145,6 +138,20 @@ async def list_dt_devices_handler(update: Update, context: ContextTypes.DEFAULT_
             )
             return
             
+        # Dettagli di tutti i dispenser collegati con un'unica query
+        try:
+            dispensers_by_id = {
+                d["_id"]: d for d in dt_factory.db_service.get_drs_bulk(
+                    'dispenser_medicine',
+                    [device.get('id') for device in digital_replicas if device.get('type') == 'dispenser_medicine'],
+                    projection=["data.medicine_name", "data.dosage", "data.interval"]
+                )
+            }
+            details_error = None
+        except Exception as e:
+            dispensers_by_id = {}
+            details_error = e
+
         # Componi il messaggio con i dispositivi
         msg = f"📱 Dispositivi collegati al Digital Twin '{dt.get('name')}':\n\n"
         
@@ -162,7 +169,9 @@ async def list_dt_devices_handler(update: Update, context: ContextTypes.DEFAULT_
             # Ottieni dettagli aggiuntivi per i dispenser
             if device_type == 'dispenser_medicine':
                 try:
-                    dispenser = dt_factory.db_service.get_dr('dispenser_medicine', device_id)
+                    if details_error:
+                        raise details_error
+                    dispenser = dispensers_by_id.get(device_id)
                     if dispenser:
                         medicine_data = dispenser.get('data', {})
                         medicine_name = str(medicine_data.get('medicine_name', 'Nome sconosciuto')).replace("*", "\\*").replace("_", "\\_").replace("`", "\\`")
@@ -8,6 +8,8 @@ import numpy as np
 import matplotlib.dates as mdates
 import re
 import matplotlib.patches as mpatches
+from src.services import dr_views
+from src.services.medication_schedule import get_compiled_schedule
 
 async def show_door_events_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -39,7 +41,7 @@ async def show_door_events_handler(update: Update, context: ContextTypes.DEFAULT
     db_service = context.application.bot_data['db_service']
     
     # Verifica che l'utente abbia accesso a questo dispenser
-    dispenser = db_service.get_dr("dispenser_medicine", dispenser_id)
+    dispenser = dr_views.get_schedule(db_service, dispenser_id)
     if not dispenser or dispenser.get("user_db_id") != user_db_id:
         await update.message.reply_text("❌ Dispenser non trovato o non hai i permessi per accedervi.")
         return
@@ -47,12 +49,6 @@ async def show_door_events_handler(update: Update, context: ContextTypes.DEFAULT
     # Recupera il nome del dispenser
     dispenser_name = dispenser.get("data", {}).get("name", f"Dispenser {dispenser_id}")
     
-    # Ottieni i dati sugli eventi della porta
-    door_events = dispenser.get("data", {}).get("door_events", [])
-    if not door_events:
-        await update.message.reply_text(f"ℹ️ Nessun evento di apertura/chiusura registrato per '{dispenser_name}'.")
-        return
-    
     # Gestione parametri aggiuntivi (numero di eventi o intervallo date)
     limit = 100  # Valore predefinito
     start_date = None
@@ -84,6 +80,15 @@ async def show_door_events_handler(update: Update, context: ContextTypes.DEFAULT
             await update.message.reply_text("❌ Formato date non valido. Usa DD-MM-YYYY o YYYY-MM-DD.")
             return
     
+    # Ottieni gli eventi della porta (solo l'intervallo richiesto o gli ultimi `limit`)
+    if start_date and end_date:
+        door_events = db_service.query_telemetry("door_events", dispenser_id, start=start_date)
+    else:
+        door_events = db_service.query_telemetry("door_events", dispenser_id, limit=limit)
+    if not door_events:
+        await update.message.reply_text(f"ℹ️ Nessun evento di apertura/chiusura registrato per '{dispenser_name}'.")
+        return
+    
     # Converti le stringhe ISO in datetime objects per ordinamento e filtraggio
     for event in door_events:
         if isinstance(event.get("timestamp"), str):
@@ -115,9 +120,12 @@ async def show_door_events_handler(update: Update, context: ContextTypes.DEFAULT
     # Prepara il messaggio di testo con i dati sommari
     msg = f"🚪 *Eventi Porta - {dispenser_name}*\n\n"
     
-    # Ottieni medicine_time per riferimento
+    # Ottieni gli orari di assunzione per riferimento
     medicine_time = dispenser.get("data", {}).get("medicine_time", {})
-    if medicine_time:
+    schedule = get_compiled_schedule(dispenser)
+    if schedule:
+        msg += f"⏰ *Orario assunzione configurato:* {', '.join(w.label for w in schedule.windows)}\n\n"
+    elif medicine_time:
         start_time = medicine_time.get("start", "non impostato")
         end_time = medicine_time.get("end", "non impostato")
         msg += f"⏰ *Orario assunzione configurato:* {start_time} - {end_time}\n\n"
@@ -173,26 +181,12 @@ async def show_door_events_handler(update: Update, context: ContextTypes.DEFAULT
             fig.suptitle(f'Eventi Porta - {dispenser_name}', fontsize=16)
             
             # Aggiungi linea per l'intervallo di tempo configurato se disponibile
-            if medicine_time and medicine_time.get("start") and medicine_time.get("end"):
-                start_time = medicine_time.get("start")
-                end_time = medicine_time.get("end")
-                
-                # Crea rettangolo che rappresenta l'intervallo di tempo corretto
-                today = datetime.now().strftime("%Y-%m-%d")
-                start_dt = datetime.strptime(f"{today} {start_time}", "%Y-%m-%d %H:%M")
-                end_dt = datetime.strptime(f"{today} {end_time}", "%Y-%m-%d %H:%M")
-                
-                # Estendi l'intervallo a tutti i giorni nel grafico
-                for event in door_events:
-                    event_date = event["datetime"].strftime("%Y-%m-%d")
-                    event_time = event["datetime"].strftime("%H:%M")
-                    
-                    # Crea datetime per questo giorno con orario di inizio e fine
-                    day_start = datetime.strptime(f"{event_date} {start_time}", "%Y-%m-%d %H:%M")
-                    day_end = datetime.strptime(f"{event_date} {end_time}", "%Y-%m-%d %H:%M")
-                    
-                    # Aggiungi rettangolo evidenziato per questo giorno
-                    ax.axvspan(day_start, day_end, alpha=0.2, color='green', label='Orario regolare')
+            if schedule:
+                # Rettangoli delle finestre di assunzione, una volta per ogni giorno nel grafico
+                for event_date in sorted({event["datetime"].date() for event in door_events}):
+                    for day_start, day_end in zip(schedule.occurrences(event_date, "start"),
+                                                  schedule.occurrences(event_date, "end")):
+                        ax.axvspan(day_start, day_end, alpha=0.2, color='green', label='Orario regolare')
             
             # Separa eventi regolari e irregolari per diversa visualizzazione
             regular_opens = [e["datetime"] for e in door_events if e.get("state") == "open" and e.get("regularity") == "regular"]
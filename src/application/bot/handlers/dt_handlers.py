@@ -19,7 +19,7 @@ async def create_dt_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Ottieni il DTManager dalla configurazione dell'app
-    dt_manager = current_app.config["DT_MANAGER"]
+    dt_manager = context.application.bot_data["dt_manager"]
     
     await update.message.reply_text(f"⏳ Creazione del Digital Twin '{dt_name}' in corso...")
 
@@ -2,12 +2,13 @@ from telegram import Update, InputFile
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
+import asyncio
 import io
-import numpy as np
-import matplotlib.dates as mdates
 import re
 from telegram.ext import ConversationHandler
+from src.services import dr_views
+from src.services import telemetry_arrays
+from src.application.bot import chart_renderer
 async def show_environmental_data_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Mostra i dati ambientali (temperatura e umidità) di un dispenser
@@ -93,7 +94,9 @@ async def show_environmental_data_handler(update: Update, context: ContextTypes.
             return
         
         # Ottieni il dispenser
-        dispenser = db_service.get_dr("dispenser_medicine", dispenser_id)
+        dispenser = db_service.get_dr(
+            "dispenser_medicine", dispenser_id, projection=dr_views.OWNER_FIELDS + dr_views.LIMITS_FIELDS
+        )
         if not dispenser:
             await update.message.reply_text(f"❌ Dispenser con ID `{dispenser_id}` non trovato.")
             return
@@ -102,91 +105,64 @@ async def show_environmental_data_handler(update: Update, context: ContextTypes.
             await update.message.reply_text("❌ Non sei autorizzato a visualizzare questo dispenser.")
             return
         
-        # Ottieni i dati ambientali
-        env_data = dispenser.get("data", {}).get("environmental_data", [])
+        # Ottieni i dati ambientali come array per tipo di misura. Senza intervallo
+        # servono solo gli ultimi N campioni per tipo (temperatura + umidità)
+        env_series = await asyncio.to_thread(
+            telemetry_arrays.load_series,
+            db_service, dispenser_id,
+            start=start_date.isoformat() if start_date else None,
+            end=end_date.isoformat() if end_date else None,
+            limit=None if start_date else num_values * 2
+        )
         dispenser_name = dispenser.get("data", {}).get("name", dispenser_id)
         
-        if not env_data:
+        if not env_series:
             await update.message.reply_text(f"ℹ️ Nessun dato ambientale disponibile per '{dispenser_name}' (ID: `{dispenser_id}`).")
             return
         
-        # Filtra per tipo
-        temp_data = [m for m in env_data if m.get("type") == "temperature"]
-        humidity_data = [m for m in env_data if m.get("type") == "humidity"]
-        
-        # Converti le stringhe ISO in datetime objects per ordinamento e filtraggio
-        for data_list in [temp_data, humidity_data]:
-            for item in data_list:
-                if isinstance(item.get("timestamp"), str):
-                    try:
-                        item["datetime"] = datetime.fromisoformat(item["timestamp"].replace('Z', '+00:00'))
-                    except ValueError:
-                        # Fallback se il formato non è ISO
-                        try:
-                            item["datetime"] = datetime.strptime(item["timestamp"], "%Y-%m-%d %H:%M:%S")
-                        except:
-                            item["datetime"] = datetime.now()  # Valore di fallback
-                else:
-                    item["datetime"] = datetime.now()
-        
-        # Ordina per timestamp
-        temp_data.sort(key=lambda x: x.get("datetime", datetime.now()))
-        humidity_data.sort(key=lambda x: x.get("datetime", datetime.now()))
+        temp_data = env_series.get("temperature", telemetry_arrays.empty_series())
+        humidity_data = env_series.get("humidity", telemetry_arrays.empty_series())
         
-        # Filtra per intervallo di date se specificato
+        # Il filtro per data è già applicato dalla query; altrimenti prendi gli ultimi N valori
         if start_date and end_date:
-            temp_data = [m for m in temp_data if start_date <= m.get("datetime").date() < end_date]
-            humidity_data = [m for m in humidity_data if start_date <= m.get("datetime").date() < end_date]
             filter_message = f"Filtraggio per intervallo: dal {start_date.strftime('%d/%m/%Y')} al {(end_date - timedelta(days=1)).strftime('%d/%m/%Y')}"
         else:
-            # Altrimenti prendi gli ultimi N valori
-            temp_data = temp_data[-num_values:] if len(temp_data) > num_values else temp_data
-            humidity_data = humidity_data[-num_values:] if len(humidity_data) > num_values else humidity_data
-            filter_message = f"Mostrando gli ultimi {min(num_values, len(temp_data))} valori di temperatura e {min(num_values, len(humidity_data))} di umidità"
+            temp_data = telemetry_arrays.tail(temp_data, num_values)
+            humidity_data = telemetry_arrays.tail(humidity_data, num_values)
+            filter_message = f"Mostrando gli ultimi {len(temp_data)} valori di temperatura e {len(humidity_data)} di umidità"
+        
+        temp_stats = telemetry_arrays.summarize(temp_data)
+        humidity_stats = telemetry_arrays.summarize(humidity_data)
         
         # Prepara il messaggio
         msg = f"📊 *Dati ambientali per '{dispenser_name}'*\n\n"
         
         # Ultima temperatura
-        if temp_data:
-            last_temp = temp_data[-1]
-            temp_value = last_temp.get("value", "N/A")
-            temp_time = last_temp.get("datetime").strftime("%d/%m/%Y %H:%M:%S")
-            msg += f"🌡️ *Temperatura*: {temp_value}°C (aggiornata: {temp_time})\n"
+        if temp_stats:
+            temp_time = temp_stats["last_time"].strftime("%d/%m/%Y %H:%M:%S")
+            msg += f"🌡️ *Temperatura*: {temp_stats['last_value']}°C (aggiornata: {temp_time})\n"
         else:
             msg += "🌡️ *Temperatura*: Dati non disponibili\n"
         
         # Ultima umidità
-        if humidity_data:
-            last_humidity = humidity_data[-1]
-            humidity_value = last_humidity.get("value", "N/A")
-            humidity_time = last_humidity.get("datetime").strftime("%d/%m/%Y %H:%M:%S")
-            msg += f"💧 *Umidità*: {humidity_value}% (aggiornata: {humidity_time})\n\n"
+        if humidity_stats:
+            humidity_time = humidity_stats["last_time"].strftime("%d/%m/%Y %H:%M:%S")
+            msg += f"💧 *Umidità*: {humidity_stats['last_value']}% (aggiornata: {humidity_time})\n\n"
         else:
             msg += "💧 *Umidità*: Dati non disponibili\n\n"
         
         # Statistiche sui dati
-        if temp_data:
-            temp_values = [m.get("value", 0) for m in temp_data if isinstance(m.get("value"), (int, float))]
-            if temp_values:
-                avg_temp = sum(temp_values) / len(temp_values)
-                min_temp = min(temp_values)
-                max_temp = max(temp_values)
-                msg += f"📈 *Statistiche Temperatura*:\n"
-                msg += f"  • Media: {avg_temp:.1f}°C\n"
-                msg += f"  • Min: {min_temp:.1f}°C (in questo periodo)\n"
-                msg += f"  • Max: {max_temp:.1f}°C (in questo periodo)\n"
+        if temp_stats:
+            msg += f"📈 *Statistiche Temperatura*:\n"
+            msg += f"  • Media: {temp_stats['mean']:.1f}°C\n"
+            msg += f"  • Min: {temp_stats['min']:.1f}°C (in questo periodo)\n"
+            msg += f"  • Max: {temp_stats['max']:.1f}°C (in questo periodo)\n"
         
-        if humidity_data:
-            humidity_values = [m.get("value", 0) for m in humidity_data if isinstance(m.get("value"), (int, float))]
-            if humidity_values:
-                avg_humidity = sum(humidity_values) / len(humidity_values)
-                min_humidity = min(humidity_values)
-                max_humidity = max(humidity_values)
-                msg += f"\n📊 *Statistiche Umidità*:\n"
-                msg += f"  • Media: {avg_humidity:.1f}%\n"
-                msg += f"  • Min: {min_humidity:.1f}% (in questo periodo)\n"
-                msg += f"  • Max: {max_humidity:.1f}% (in questo periodo)\n"
+        if humidity_stats:
+            msg += f"\n📊 *Statistiche Umidità*:\n"
+            msg += f"  • Media: {humidity_stats['mean']:.1f}%\n"
+            msg += f"  • Min: {humidity_stats['min']:.1f}% (in questo periodo)\n"
+            msg += f"  • Max: {humidity_stats['max']:.1f}% (in questo periodo)\n"
         
         msg += f"\n*{filter_message}*"
         
@@ -198,65 +174,25 @@ async def show_environmental_data_handler(update: Update, context: ContextTypes.
             # Notifica l'utente che stiamo generando il grafico
             chart_msg = await update.message.reply_text("⏳ Generazione grafico in corso...")
             
-            # Ottieni i limiti personalizzati
+            # Il grafico viene disegnato nel pool di processi, fuori dal loop del bot
+            temp_plot = telemetry_arrays.lttb(temp_data)
+            hum_plot = telemetry_arrays.lttb(humidity_data)
             custom_temp_limits = dispenser.get("data", {}).get("temperature_limits", [18.0, 30.0])
             custom_humidity_limits = dispenser.get("data", {}).get("humidity_limits", [30.0, 70.0])
-            
-            # Crea il grafico
-            fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 8), sharex=True)
-            fig.suptitle(f'Dati Ambientali - {dispenser_name}', fontsize=16)
-            
-            # Plot temperatura
-            if len(temp_data) > 1:
-                temp_times = [m.get("datetime") for m in temp_data]
-                temp_values = [m.get("value") for m in temp_data]
-                ax1.plot(temp_times, temp_values, 'r-', label='Temperatura')
-                ax1.set_ylabel('Temperatura (°C)')
-                ax1.set_title('Temperatura')
-                ax1.grid(True)
-                
-                # Aggiungi linee orizzontali per i limiti personalizzati
-                ax1.axhline(y=custom_temp_limits[0], color='blue', linestyle='--', alpha=0.7, 
-                          label=f'Min ({custom_temp_limits[0]}°C)')
-                ax1.axhline(y=custom_temp_limits[1], color='red', linestyle='--', alpha=0.7, 
-                          label=f'Max ({custom_temp_limits[1]}°C)')
-                ax1.legend()
-            
-            # Plot umidità
-            if len(humidity_data) > 1:
-                hum_times = [m.get("datetime") for m in humidity_data]
-                hum_values = [m.get("value") for m in humidity_data]
-                ax2.plot(hum_times, hum_values, 'b-', label='Umidità')
-                ax2.set_ylabel('Umidità (%)')
-                ax2.set_xlabel('Data/Ora')
-                ax2.set_title('Umidità')
-                ax2.grid(True)
-                
-                # Aggiungi linee orizzontali per i limiti personalizzati
-                ax2.axhline(y=custom_humidity_limits[0], color='blue', linestyle='--', alpha=0.7, 
-                          label=f'Min ({custom_humidity_limits[0]}%)')
-                ax2.axhline(y=custom_humidity_limits[1], color='red', linestyle='--', alpha=0.7, 
-                          label=f'Max ({custom_humidity_limits[1]}%)')
-                ax2.legend()
-            
-            # Formatta l'asse x per mostrare date/ore in modo leggibile
-            fig.autofmt_xdate()
-            plt.gcf().autofmt_xdate()
-            ax2.xaxis.set_major_formatter(mdates.DateFormatter('%d/%m %H:%M'))
-            
-            # Aggiungi una griglia secondaria per migliorare la leggibilità
-            ax1.grid(which='minor', alpha=0.2)
-            ax2.grid(which='minor', alpha=0.2)
-            
-            plt.tight_layout()
-            
-            # Salva il grafico in un buffer di memoria
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', dpi=100)
-            buf.seek(0)
-            
-            # Chiudi la figura per liberare memoria
-            plt.close(fig)
+            chart_key = (
+                dispenser_id,
+                (start_date, end_date) if start_date else num_values,
+                chart_renderer.series_version(temp_data, humidity_data),
+                tuple(custom_temp_limits or ()), tuple(custom_humidity_limits or ()),
+            )
+            image = await chart_renderer.get_chart_renderer().render(chart_key, {
+                "title": dispenser_name,
+                "temperature": temp_plot,
+                "humidity": hum_plot,
+                "temperature_limits": custom_temp_limits,
+                "humidity_limits": custom_humidity_limits,
+            })
+            buf = io.BytesIO(image)
             
             # Invia il grafico
             await update.message.reply_photo(
@@ -276,27 +212,6 @@ async def show_environmental_data_handler(update: Update, context: ContextTypes.
         traceback.print_exc()
         await update.message.reply_text(f"❌ Si è verificato un errore durante il recupero dei dati ambientali: {e}")
 
-def find_dts_with_dr(self, dr_type, dr_id):
-    """Trova tutti i Digital Twin che contengono una certa Digital Replica"""
-    try:
-        # Query diretta più semplice con il campo corretto
-        collection = self.db_service.db["digital_twins"]
-        query = {"digital_replicas": {"$elemMatch": {"id": dr_id, "type": dr_type}}}
-        matching_dts = []
-        
-        for dt in collection.find(query):
-            matching_dts.append(str(dt.get("_id")))
-        
-        print(f"DEBUG: Trovati {len(matching_dts)} DT con {dr_type}={dr_id}: {matching_dts}")
-        return matching_dts
-        
-    except Exception as e:
-        print(f"Errore nella ricerca dei DT con DR {dr_id}: {e}")
-        import traceback
-        traceback.print_exc()
-        return []
-
-
 async def set_environmental_limits_handler(update, context):
     """
     Imposta i limiti di temperatura o umidità per un dispenser specifico.
@@ -342,23 +257,8 @@ async def set_environmental_limits_handler(update, context):
         # Esegui l'aggiornamento sul database
         db_service.update_dr("dispenser_medicine", dispenser_id, update_operation)
 
-        # Aggiorna anche le istanze dei Digital Twin attualmente in esecuzione in memoria
-        try:
-            dt_factory = context.application.bot_data.get('dt_factory')
-            if dt_factory:
-                dts_with_dispenser = find_dts_with_dr(dt_factory, "dispenser_medicine", dispenser_id)
-                for dt_id in dts_with_dispenser:
-                    dt_instance = dt_factory.get_dt_instance(dt_id)
-                    if dt_instance:
-                        env_service = dt_instance.get_service("EnvironmentalMonitoringService")
-                        if env_service:
-                            if limit_type == "temp":
-                                env_service.temperature_range = [min_value, max_value]
-                            else:
-                                env_service.humidity_range = [min_value, max_value]
-                            print(f"Servizio ambientale del DT {dt_id} aggiornato in memoria.")
-        except Exception as e:
-            print(f"ATTENZIONE: Errore nell'aggiornamento dei servizi DT in memoria: {e}")
+        # Niente modifiche in memoria ai servizi dei DT in cache: i limiti sono per dispenser,
+        # letti dal database e invalidati dal listener delle modifiche
 
         await update.message.reply_text(
             f"✅ Limiti di {limit_name} per il dispenser '{dispenser_id}' aggiornati con successo:\n"
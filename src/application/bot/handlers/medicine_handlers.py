@@ -1,13 +1,16 @@
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
-from src.virtualization.digital_replica.dr_factory import DRFactory
+from src.virtualization.digital_replica.dr_factory import get_dr_factory
 from flask import current_app
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime
 import ssl
 import re
 from src.services.database_service import DatabaseService
+from src.services import dr_views
+from src.services.adherence import TAKEN, LATE, MISSED, NO_DATA, adherence_rate, get_adherence_store, local_days
+from src.services.medication_schedule import invalidate_schedule, parse_minutes
 import paho.mqtt.client as mqtt
 import ssl
 from config.settings import MQTT_TOPIC_ASSOC
@@ -54,93 +57,32 @@ async def create_medicine_handler(update: Update, context: ContextTypes.DEFAULT_
     # -----------------------------------------
 
     # --- Creazione associazione condizionale via MQTT ---
+    mqtt_subscriber = context.application.bot_data.get('mqtt_subscriber')
+    if not mqtt_subscriber:
+        await update.message.reply_text("❌ Client MQTT non inizializzato. Impossibile procedere.")
+        return
+
     await update.message.reply_text(f"⏳ In attesa di conferma dal dispenser '{dispenser_id}'...\nPremi il pulsante sul dispenser entro 30 secondi.")
-    
-    # Crea un oggetto Event per la sincronizzazione
-    mqtt_response_received = asyncio.Event()
-    mqtt_message_value = None
-    
-    # Callback per gestire i messaggi MQTT in arrivo
-    def on_mqtt_message(client, userdata, msg):
-        nonlocal mqtt_message_value
-        try:
-            payload = msg.payload.decode('utf-8').strip()
-            print(f"MQTT: Ricevuto messaggio '{payload}' sul topic '{msg.topic}'")
-            
-            # Aggiorna il valore del messaggio
-            mqtt_message_value = payload
 
-            # se il topic è quello di associazione
-            if msg.topic == f"{dispenser_id}/{MQTT_TOPIC_ASSOC}":
-                # Importante: imposta l'evento SOLO se il messaggio è "1"
-                # Questo sblocca immediatamente l'attesa senza aspettare altri messaggi
-                if payload == "1":
-                    mqtt_response_received.set()
-                print(f"MQTT: Confermata associazione per {dispenser_id}")
-            else:
-                print(f"MQTT: Messaggio '{payload}' non valido per associazione, continuo ad attendere...")
-        except Exception as e:
-            print(f"MQTT: Errore nell'elaborazione del messaggio: {e}")
-    
-    # Configura il client MQTT temporaneo per questa operazione
-    mqtt_subscriber = current_app.config.get('MQTT_SUBSCRIBER')
-    
+    # Il subscriber è già sottoscritto a +/assoc: l'attesa viene risolta dal suo
+    # dispatch quando arriva "1" da questo dispenser, senza toccare gli altri messaggi
     try:
-        # Verifica che il client MQTT interno sia inizializzato
-        if not mqtt_subscriber.client:
-            await update.message.reply_text("❌ Client MQTT non inizializzato. Impossibile procedere.")
-            return
-            
-        # Associa la callback per la gestione dei messaggi
-        mqtt_subscriber.client.on_message = on_mqtt_message
-        
-        # Sottoscrivi al topic corretto
-        mqtt_subscriber.client.subscribe(f"{dispenser_id}/{MQTT_TOPIC_ASSOC}")
-        
-        # Il loop è già avviato nel MqttSubscriber, non serve chiamare loop_start
-        
-        # Aspetta il messaggio MQTT per 30 secondi
-        try:
-            # Invece di aspettare il timeout completo anche quando riceviamo il messaggio
-            # controlliamo periodicamente se l'evento è stato impostato
-            start_time = asyncio.get_event_loop().time()
-            max_wait = 30.0  # Timeout massimo in secondi
-            check_interval = 0.5  # Controlla ogni mezzo secondo
-            
-            while not mqtt_response_received.is_set():
-                # Aspetta un breve intervallo
-                await asyncio.sleep(check_interval)
-                
-                # Controlla se abbiamo superato il timeout
-                elapsed = asyncio.get_event_loop().time() - start_time
-                if elapsed > max_wait:
-                    await update.message.reply_text(f"⏱️ Timeout: nessuna conferma ricevuta dal dispenser entro 30 secondi. Operazione annullata.")
-                    return
-            
-            # Se siamo usciti dal ciclo, l'evento è stato impostato
-            # Verifica se il messaggio ricevuto è "1"
-            if mqtt_message_value != "1":
-                await update.message.reply_text(f"❌ Ricevuta risposta non valida dal dispenser. Operazione annullata.")
-                return
-                
-        except Exception as e:
-            await update.message.reply_text(f"❌ Errore durante l'attesa della conferma: {e}")
-            return
-    finally:
-        # Ripristina la gestione messaggi originale e annulla la sottoscrizione
-        if mqtt_subscriber and mqtt_subscriber.client:
-            # Ripristina l'handler originale
-            mqtt_subscriber.client.on_message = mqtt_subscriber.on_message
-            
-            # Annulla la sottoscrizione
-            mqtt_subscriber.client.unsubscribe(f"{dispenser_id}/{MQTT_TOPIC_ASSOC}")
-            # Non fermiamo il loop perché è gestito dalla classe MqttSubscriber
-    
+        await mqtt_subscriber.wait_for_message(
+            dispenser_id, MQTT_TOPIC_ASSOC, timeout=30.0, accept=lambda payload: payload == "1"
+        )
+    except asyncio.TimeoutError:
+        await update.message.reply_text(f"⏱️ Timeout: nessuna conferma ricevuta dal dispenser entro 30 secondi. Operazione annullata.")
+        return
+    except Exception as e:
+        await update.message.reply_text(f"❌ Errore durante l'attesa della conferma: {e}")
+        return
+    print(f"MQTT: Confermata associazione per {dispenser_id}")
+
     # Se siamo qui, significa che abbiamo ricevuto "1" dal topic
     await update.message.reply_text(f"✅ Confermato! Associazione con il dispenser riuscita.")
     
     # --- Prosegui con la creazione del dispenser nel DB ---
-    dr_factory = DRFactory(".\\src\\virtualization\\templates\\dispenser_medicine.yaml")
+    dr_factory = get_dr_factory(".\\src\\virtualization\\templates\\dispenser_medicine.yaml")
     try:
         new_dispenser = dr_factory.create_dr("dispenser_medicine", {
             "data": {"name": nome},
@@ -175,7 +117,7 @@ async def list_my_medicines_handler(update: Update, context: ContextTypes.DEFAUL
         return
 
     try:
-        my_dispensers = db.query_drs("dispenser_medicine", {"user_db_id": user_db_id})
+        my_dispensers = dr_views.list_owned_dispensers(db, user_db_id)
 
         if not my_dispensers:
             await update.message.reply_text("ℹ️ Non hai dispenser registrati.")
@@ -255,21 +197,17 @@ async def show_weekly_adherence_handler(update: Update, context: ContextTypes.DE
             )
             return
         
-        # Ottieni i dispenser collegati al DT
-        dispensers = []
-        for dispenser_id in dispenser_ids:
-            dispenser = db_service.get_dr("dispenser_medicine", dispenser_id)
-            if dispenser:
-                dispensers.append(dispenser)
+        # Ottieni i dispenser collegati al DT con un'unica query
+        dispensers = db_service.get_drs_bulk(
+            "dispenser_medicine", dispenser_ids, projection=dr_views.SCHEDULE_FIELDS
+        )
         
         if not dispensers:
             await update.message.reply_text("ℹ️ Non ci sono dispensatori validi collegati a questo Digital Twin.")
             return
         
-        # Calcola le date degli ultimi 7 giorni
-        today = datetime.now().date()
-        days = [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
-        days.reverse()  # Dal più vecchio al più recente
+        # Date degli ultimi 7 giorni (dal più vecchio al più recente) nel fuso degli orari
+        days = local_days(dispensers[0], 7)
         
         # Formattazione giorni per intestazione
         short_days = [(datetime.strptime(day, "%Y-%m-%d").strftime("%d/%m")) for day in days]
@@ -290,6 +228,11 @@ async def show_weekly_adherence_handler(update: Update, context: ContextTypes.DE
         separator = "-" * medicine_col_width + "-|-" + "-|-".join("-" * day_col_width for _ in short_days) + "\n"
         msg += separator
         
+        # Riepiloghi giornalieri degli ultimi 30 giorni locali di ogni dispenser (una riga per
+        # dispenser e giorno) con un'unica query: gli ultimi 7 per la tabella, tutti per la percentuale
+        monthly_statuses = get_adherence_store(db_service).get_local_statuses(dispensers, 30)
+        status_icons = {TAKEN: "✅", LATE: "🕒", MISSED: "❌", NO_DATA: "⌛"}
+        
         for dispenser in dispensers:
             # Accesso al nome del dispenser
             dispenser_name = dispenser.get("data", {}).get("name", "???")
@@ -299,58 +242,21 @@ async def show_weekly_adherence_handler(update: Update, context: ContextTypes.DE
             else:
                 name_display = dispenser_name.ljust(medicine_col_width)
             
-            # Ottieni i dati necessari
-            door_events = dispenser.get("data", {}).get("door_events", [])
-            medicine_time = dispenser.get("data", {}).get("medicine_time", {})
-            start_time = medicine_time.get("start", "08:00")
-            end_time = medicine_time.get("end", "20:00")
-            
-            # Controlla l'aderenza per ogni giorno
-            day_status = []
-            for day in days:
-                # Filtra gli eventi della porta per questo giorno
-                day_events = [e for e in door_events if e.get("timestamp", "").startswith(day)]
-                
-                if not day_events:
-                    # Nessun dato disponibile per questo giorno
-                    day_status.append("⌛")
-                else:
-                    # Controlla se c'è stata almeno una coppia apertura-chiusura nell'intervallo
-                    open_events = False
-                    close_events = False
-                    
-                    for event in day_events:
-                        # Ottieni l'orario dall'evento con gestione degli errori
-                        try:
-                            timestamp = event.get("timestamp", "")
-                            if "T" in timestamp:
-                                event_time = timestamp.split("T")[1][:5]  # Estrae HH:MM
-                            else:
-                                continue  # Salta eventi con formato timestamp errato
-                                
-                            # Verifica se l'evento è nell'intervallo configurato
-                            if start_time <= event_time <= end_time:
-                                # Controlla lo stato dell'evento (usa "state" invece di "status")
-                                event_state = event.get("state", "")
-                                if event_state == "open":
-                                    open_events = True
-                                elif event_state == "closed":
-                                    close_events = True
-                        except Exception as e:
-                            print(f"Errore nell'elaborazione dell'evento porta: {e}")
-                    
-                    # Se abbiamo sia apertura che chiusura nell'intervallo, è un'assunzione corretta
-                    if open_events and close_events:
-                        day_status.append("✅")
-                    else:
-                        day_status.append("❌")
+            day_status = [status_icons[status] for status in monthly_statuses[dispenser["_id"]][-len(days):]]
             
             # Aggiungi la riga per questo dispenser
             msg += name_display + " | "
             msg += " | ".join(status.center(day_col_width) for status in day_status) + "\n"
         
         msg += "```\n"
-        msg += "\n✅ = Assunzione corretta, ❌ = Non assunto, ⌛ = Dati non disponibili"
+        msg += "\n✅ = Assunzione corretta, 🕒 = In ritardo, ❌ = Non assunto, ⌛ = Dati non disponibili"
+        
+        # Aderenza degli ultimi 30 giorni
+        msg += "\n\n📅 *Aderenza ultimi 30 giorni:*"
+        for dispenser in dispensers:
+            monthly_rate = adherence_rate(monthly_statuses[dispenser["_id"]])
+            rate = f"{monthly_rate}%" if monthly_rate is not None else "n.d."
+            msg += f"\n• {dispenser.get('data', {}).get('name', '???')}: {rate}"
         
         await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN)
 
@@ -395,13 +301,8 @@ async def set_medicine_time_handler(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text("❌ Formato orario non valido. Usa HH:MM (es. 19:50).")
         return
         
-    # Converti in oggetti datetime per confronto
-    now = datetime.now()
-    start_dt = datetime.strptime(f"{now.strftime('%Y-%m-%d')} {start_time}", "%Y-%m-%d %H:%M")
-    end_dt = datetime.strptime(f"{now.strftime('%Y-%m-%d')} {end_time}", "%Y-%m-%d %H:%M")
-    
     # Controlla che l'orario di inizio sia prima dell'orario di fine
-    if start_dt >= end_dt:
+    if parse_minutes(start_time) >= parse_minutes(end_time):
         await update.message.reply_text("❌ L'orario di inizio deve essere anteriore all'orario di fine.")
         return
     
@@ -432,8 +333,9 @@ async def set_medicine_time_handler(update: Update, context: ContextTypes.DEFAUL
             }
         }
         
-        # Aggiorna il database
+        # Aggiorna il database e scarta gli orari compilati del dispenser
         db_service.update_dr("dispenser_medicine", dispenser_id, update_operation)
+        invalidate_schedule(dispenser_id)
         
         # Aggiorna anche i Digital Twin collegati
         dt_factory = context.application.bot_data.get('dt_factory')
@@ -510,29 +412,14 @@ async def delete_dispenser_handler(update: Update, context: ContextTypes.DEFAULT
         dispenser_name = dispenser.get('data', {}).get('name', 'Dispenser')
         
         # Trova tutti i Digital Twin a cui è collegato il dispenser
-        # Usa la stessa logica di MqttSubscriber._find_dts_with_dr
-        collection = db_service.db["digital_twins"]
-        query = {"digital_replicas": {"$elemMatch": {"id": dispenser_id, "type": "dispenser_medicine"}}}
-        connected_dts = []
-        
-        for dt in collection.find(query):
-            connected_dts.append(str(dt.get("_id")))
+        connected_dts = dt_factory.find_dts_with_dr("dispenser_medicine", dispenser_id)
         
         # Rimuovi il dispenser da tutti i Digital Twin trovati
         for dt_id in connected_dts:
             try:
-                dt_doc = dt_factory.get_dt(dt_id)
-                dt_name = dt_doc.get('name', 'Digital Twin')
-                
-                # Rimuovi la digital replica dal documento DT
-                digital_replicas = dt_doc.get('digital_replicas', [])
-                updated_replicas = [dr for dr in digital_replicas if not (dr.get('id') == dispenser_id and dr.get('type') == 'dispenser_medicine')]
-                
-                # Aggiorna il documento DT con le digital replicas filtrate
-                collection.update_one(
-                    {"_id": dt_id},
-                    {"$set": {"digital_replicas": updated_replicas}}
-                )
+                # Rimuovi la digital replica passando dalla factory, così anche
+                # l'istanza DT in cache resta coerente
+                dt_factory.remove_digital_replica(dt_id, dispenser_id)
                 
                 print(f"Dispenser {dispenser_id} rimosso dal Digital Twin {dt_id}")
             except Exception as e:
@@ -2,6 +2,7 @@ import bcrypt
 from telegram import Update
 from telegram.ext import ContextTypes
 from src.application.user_service import UserService
+from src.application.bot.notification_router import invalidate_notification_routes
 from typing import Dict, Set
 
 from telegram.constants import ParseMode
@@ -85,6 +86,7 @@ async def login_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         {"$addToSet": {"metadata.active_telegram_ids": telegram_id}}
                     )
                     print(f"DEBUG: Update risultato: {result.modified_count} documenti modificati")
+                    invalidate_notification_routes([dt_id])
                     
                     # Ottieni il nome del DT per il messaggio di benvenuto
                     dt = dt_collection.find_one({"_id": dt_id})
@@ -121,6 +123,7 @@ async def login_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         {"$addToSet": {"metadata.active_telegram_ids": telegram_id}}
                     )
                     print(f"DEBUG: Update risultato: {result.modified_count} documenti modificati")
+                invalidate_notification_routes([dt_doc.get("_id") for dt_doc in user_dt_docs])
                 
                 await update.message.reply_text(
                     f"✅ Login effettuato con successo come supervisore *{username}*.",
@@ -168,6 +171,7 @@ async def logout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                 {"_id": dt_id},
                                 {"$pull": {"metadata.active_telegram_ids": telegram_id}}
                             )
+                            invalidate_notification_routes([dt_id])
                 else:
                     # Per i supervisori, usa il comportamento esistente
                     dt_collection = db_service.db["digital_twins"]
@@ -180,6 +184,7 @@ async def logout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             {"_id": dt_id},
                             {"$pull": {"metadata.active_telegram_ids": telegram_id}}
                         )
+                    invalidate_notification_routes([str(dt_doc["_id"]) for dt_doc in user_dt_docs])
         except Exception as e:
             print(f"Errore nella rimozione degli ID Telegram: {e}")
             import traceback
@@ -0,0 +1,286 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+
+# Corsie di priorità: le emergenze superano sempre gli avvisi e i messaggi di routine
+PRIORITY_EMERGENCY = 0
+PRIORITY_ALERT = 1
+PRIORITY_ROUTINE = 2
+
+TELEGRAM_API_URL = "https://api.telegram.org/bot{token}/sendMessage"
+
+
+class TokenBucket:
+    """Token bucket: ``rate`` token al secondo, al massimo ``capacity`` accumulati"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        """Secondi da attendere prima che sia disponibile un token (0 se disponibile)"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+    def block(self, seconds: float, now: float) -> None:
+        """Sospende il bucket (es. retry_after di una risposta 429)"""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def is_idle(self, now: float) -> bool:
+        return now >= self.blocked_until and self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+class NotificationDispatcher:
+    """
+    Coda centralizzata dei messaggi Telegram in uscita.
+
+    I messaggi vengono inviati da ``workers`` thread su una ``requests.Session``
+    persistente, rispettando il limite globale del bot (``global_rate`` msg/s)
+    e quello per chat (``chat_rate`` msg/s) con dei token bucket. Una chat
+    limitata non blocca le altre: il suo messaggio viene rimandato e si passa al
+    successivo. Le risposte 429 sospendono la chat per il ``retry_after``
+    indicato da Telegram; errori 5xx e di rete vengono ritentati con backoff
+    esponenziale fino a ``max_retries`` volte.
+    """
+
+    def __init__(self, token: str, workers: int = 4, global_rate: float = 30, chat_rate: float = 1,
+                 max_retries: int = 5, queue_size: int = 10000, timeout: float = 10, session=None):
+        self.token = token
+        self.workers = workers
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self._url = TELEGRAM_API_URL.format(token=token)
+        self._condition = threading.Condition()
+        self._ready = []    # (priority, seq, job)
+        self._delayed = []  # (ready_at, seq, job)
+        self._sequence = itertools.count()
+        self._global_bucket = TokenBucket(global_rate)
+        self._chat_buckets: Dict[str, TokenBucket] = {}
+        self._in_flight = 0
+        self._threads = []
+        self.running = False
+        self.metrics = {
+            "enqueued": 0, "sent": 0, "failed": 0, "retried": 0,
+            "rate_limited": 0, "dropped": 0, "max_latency_seconds": 0.0,
+        }
+
+    def start(self) -> None:
+        with self._condition:
+            if self.running:
+                return
+            self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"telegram-sender-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"NotificationDispatcher: avviato con {self.workers} worker")
+
+    def stop(self, timeout: float = 10) -> None:
+        """Attende (fino a ``timeout`` secondi) la consegna dei messaggi in coda e ferma i worker"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while (self._ready or self._delayed or self._in_flight) and time.monotonic() < deadline:
+                self._condition.wait(max(0.0, min(0.5, deadline - time.monotonic())))
+            pending = len(self._ready) + len(self._delayed)
+            self.running = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=self.timeout)
+        self._threads = []
+        self.session.close()
+        print(f"NotificationDispatcher: fermato, messaggi non consegnati: {pending}")
+
+    def submit(self, chat_id, text: str, priority: int = PRIORITY_ROUTINE,
+               label: str = "Notifica", parse_mode: Optional[str] = "Markdown") -> bool:
+        """
+        Accoda un messaggio per una chat.
+
+        Returns:
+            bool: False se la coda è piena e il messaggio è stato scartato
+        """
+        job = {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": parse_mode,
+            "priority": priority,
+            "label": label,
+            "attempts": 0,
+            "enqueued_at": time.monotonic(),
+        }
+        with self._condition:
+            if len(self._ready) + len(self._delayed) >= self.queue_size and priority != PRIORITY_EMERGENCY:
+                self.metrics["dropped"] += 1
+                print(f"NotificationDispatcher: coda piena, scartato messaggio per {chat_id}")
+                return False
+            heapq.heappush(self._ready, (priority, next(self._sequence), job))
+            self.metrics["enqueued"] += 1
+            self._condition.notify()
+        return True
+
+    def stats(self) -> Dict:
+        with self._condition:
+            stats = dict(self.metrics)
+            stats["queued"] = len(self._ready)
+            stats["delayed"] = len(self._delayed)
+            stats["in_flight"] = self._in_flight
+        return stats
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                job = self._next_job()
+                if job is None:
+                    return
+                self._in_flight += 1
+            try:
+                self._deliver(job)
+            finally:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+    def _next_job(self):
+        """Estrae il prossimo messaggio inviabile, attendendo token e ritardi (chiamato col lock)"""
+        while self.running:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, job = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (job["priority"], next(self._sequence), job))
+
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._condition.wait(timeout)
+                continue
+
+            global_wait = self._global_bucket.wait_time(now)
+            if global_wait > 0:
+                self._condition.wait(global_wait)
+                continue
+
+            _, _, job = heapq.heappop(self._ready)
+            chat_bucket = self._chat_bucket(str(job["chat_id"]), now)
+            chat_wait = chat_bucket.wait_time(now)
+            if chat_wait > 0:
+                # La chat è al limite: il messaggio aspetta senza bloccare le altre chat
+                heapq.heappush(self._delayed, (now + chat_wait, next(self._sequence), job))
+                continue
+
+            self._global_bucket.consume()
+            chat_bucket.consume()
+            return job
+        return None
+
+    def _chat_bucket(self, chat_id: str, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {
+                    key: b for key, b in self._chat_buckets.items() if not b.is_idle(now)
+                }
+            bucket = TokenBucket(self.chat_rate)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _deliver(self, job: Dict) -> None:
+        data = {"chat_id": job["chat_id"], "text": job["text"]}
+        if job["parse_mode"]:
+            data["parse_mode"] = job["parse_mode"]
+
+        retry_after = None
+        try:
+            response = self.session.post(self._url, json=data, timeout=self.timeout)
+            status, detail = response.status_code, response.text
+        except requests.RequestException as e:
+            status, detail = None, str(e)
+
+        if status == 200:
+            latency = time.monotonic() - job["enqueued_at"]
+            with self._condition:
+                self.metrics["sent"] += 1
+                self.metrics["max_latency_seconds"] = max(self.metrics["max_latency_seconds"], round(latency, 3))
+            print(f"✅ {job['label']} inviata all'ID Telegram: {job['chat_id']}")
+            return
+
+        if status == 429:
+            try:
+                retry_after = float(response.json().get("parameters", {}).get("retry_after", 1))
+            except ValueError:
+                retry_after = 1.0
+            with self._condition:
+                self.metrics["rate_limited"] += 1
+                self._chat_bucket(str(job["chat_id"]), time.monotonic()).block(retry_after, time.monotonic())
+        elif status is not None and status < 500:
+            # Errore definitivo (chat inesistente, bot bloccato, Markdown non valido...)
+            with self._condition:
+                self.metrics["failed"] += 1
+            print(f"❌ Errore nell'invio notifica a {job['chat_id']}: {status} - {detail}")
+            return
+
+        job["attempts"] += 1
+        if job["attempts"] > self.max_retries:
+            with self._condition:
+                self.metrics["failed"] += 1
+            print(f"❌ Notifica a {job['chat_id']} scartata dopo {self.max_retries} tentativi: {status} - {detail}")
+            return
+
+        delay = retry_after if retry_after is not None else min(60, 2 ** (job["attempts"] - 1))
+        with self._condition:
+            self.metrics["retried"] += 1
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._sequence), job))
+            self._condition.notify()
+        print(f"⏳ Invio a {job['chat_id']} ritentato tra {delay:.1f}s (stato: {status})")
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_notification_dispatcher() -> NotificationDispatcher:
+    """Dispatcher condiviso dal processo, avviato al primo utilizzo"""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                from config.settings import (
+                    TELEGRAM_TOKEN, NOTIFICATION_WORKERS, TELEGRAM_GLOBAL_RATE,
+                    TELEGRAM_CHAT_RATE, NOTIFICATION_MAX_RETRIES, NOTIFICATION_QUEUE_SIZE
+                )
+                dispatcher = NotificationDispatcher(
+                    TELEGRAM_TOKEN,
+                    workers=NOTIFICATION_WORKERS,
+                    global_rate=TELEGRAM_GLOBAL_RATE,
+                    chat_rate=TELEGRAM_CHAT_RATE,
+                    max_retries=NOTIFICATION_MAX_RETRIES,
+                    queue_size=NOTIFICATION_QUEUE_SIZE,
+                )
+                dispatcher.start()
+                _dispatcher = dispatcher
+    return _dispatcher
+
+
+def stop_notification_dispatcher(timeout: float = 10) -> None:
+    """Consegna i messaggi in coda e ferma il dispatcher condiviso (se è stato avviato)"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is not None:
+            _dispatcher.stop(timeout)
+            _dispatcher = None
@@ -0,0 +1,169 @@
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# ID Telegram usato quando non esiste alcun destinatario attivo
+FALLBACK_TELEGRAM_ID = 157933243
+
+_DT_PROJECTION = {"name": 1, "metadata.active_telegram_ids": 1}
+
+
+class NotificationRouter:
+    """
+    Risolve i destinatari di una notifica: dispositivo -> Digital Twin -> ID Telegram attivi.
+
+    I DT che contengono il dispositivo vengono letti dall'indice inverso del
+    DTFactory; nomi e ID Telegram attivi arrivano da un'unica query proiettata
+    su ``_id`` e restano in una cache con TTL breve, invalidata a login/logout.
+    """
+
+    def __init__(self, db_service, dt_factory=None, ttl_seconds: float = 30):
+        self.db_service = db_service
+        self.dt_factory = dt_factory
+        self.ttl_seconds = ttl_seconds
+        self._dt_cache: Dict[str, Tuple[float, Dict]] = {}
+        self._user_cache: Dict[str, Tuple[float, List[str]]] = {}
+        self._lock = threading.Lock()
+
+    def resolve_device(self, device_id: str, dr_type: str = "dispenser_medicine",
+                       user_db_id: Optional[str] = None) -> Dict:
+        """
+        Destinatari di una notifica relativa a un dispositivo.
+
+        Se il dispositivo non appartiene a nessun DT si ripiega sui DT del
+        proprietario (``user_db_id``) e, in ultima istanza, sull'ID di fallback.
+
+        Returns:
+            Dict con ``dt_ids``, ``dt_name`` (nome del primo DT o None) e ``telegram_ids``
+        """
+        dt_ids = self._find_device_dts(dr_type, device_id)
+        if not dt_ids and user_db_id:
+            dt_ids = self._find_user_dts(user_db_id)
+        return self._build_recipients(dt_ids)
+
+    def resolve_dt(self, dt_id: str) -> Dict:
+        """Destinatari di una notifica destinata a un singolo Digital Twin"""
+        return self._build_recipients([dt_id])
+
+    def resolve_user(self, user_db_id: str) -> Dict:
+        """Destinatari di una notifica destinata a tutti i DT di un utente"""
+        return self._build_recipients(self._find_user_dts(user_db_id))
+
+    def invalidate(self, dt_ids: Optional[Iterable[str]] = None) -> None:
+        """Svuota la cache (solo per i DT indicati, se specificati)"""
+        with self._lock:
+            if dt_ids is None:
+                self._dt_cache.clear()
+                self._user_cache.clear()
+            else:
+                for dt_id in dt_ids:
+                    self._dt_cache.pop(str(dt_id), None)
+
+    def _find_device_dts(self, dr_type: str, device_id: str) -> List[str]:
+        if self.dt_factory:
+            return self.dt_factory.find_dts_with_dr(dr_type, device_id)
+        # Senza factory si usa l'indice multikey su digital_replicas
+        dt_collection = self.db_service.db["digital_twins"]
+        query = {"digital_replicas": {"$elemMatch": {"id": device_id, "type": dr_type}}}
+        return [str(dt["_id"]) for dt in dt_collection.find(query, {"_id": 1})]
+
+    def _find_user_dts(self, user_db_id: str) -> List[str]:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._user_cache.get(user_db_id)
+            if cached and cached[0] > now:
+                return list(cached[1])
+
+        dt_collection = self.db_service.db["digital_twins"]
+        dt_docs = list(dt_collection.find({"metadata.user_id": user_db_id}, _DT_PROJECTION))
+        dt_ids = [str(dt_doc["_id"]) for dt_doc in dt_docs]
+
+        expires = now + self.ttl_seconds
+        with self._lock:
+            self._user_cache[user_db_id] = (expires, dt_ids)
+            for dt_doc in dt_docs:
+                self._dt_cache[str(dt_doc["_id"])] = (expires, self._summarize(dt_doc))
+        return dt_ids
+
+    def _load_dts(self, dt_ids: List[str]) -> Dict[str, Dict]:
+        """Riassunti dei DT richiesti: cache prima, poi un'unica query $in per i mancanti"""
+        now = time.monotonic()
+        summaries = {}
+        missing = []
+        with self._lock:
+            for dt_id in dt_ids:
+                cached = self._dt_cache.get(dt_id)
+                if cached and cached[0] > now:
+                    summaries[dt_id] = cached[1]
+                else:
+                    missing.append(dt_id)
+
+        if missing:
+            dt_collection = self.db_service.db["digital_twins"]
+            loaded = {
+                str(dt_doc["_id"]): self._summarize(dt_doc)
+                for dt_doc in dt_collection.find({"_id": {"$in": missing}}, _DT_PROJECTION)
+            }
+            expires = now + self.ttl_seconds
+            with self._lock:
+                for dt_id, summary in loaded.items():
+                    self._dt_cache[dt_id] = (expires, summary)
+            summaries.update(loaded)
+        return summaries
+
+    def _build_recipients(self, dt_ids: List[str]) -> Dict:
+        summaries = self._load_dts(dt_ids) if dt_ids else {}
+
+        telegram_ids: List[int] = []
+        seen: Set[int] = set()
+        for dt_id in dt_ids:
+            for telegram_id in summaries.get(dt_id, {}).get("telegram_ids", []):
+                if telegram_id not in seen:
+                    seen.add(telegram_id)
+                    telegram_ids.append(telegram_id)
+
+        if not telegram_ids:
+            print(f"ATTENZIONE: Nessun ID Telegram valido trovato per {dt_ids}, uso fallback {FALLBACK_TELEGRAM_ID}")
+            telegram_ids = [FALLBACK_TELEGRAM_ID]
+
+        dt_name = None
+        for dt_id in dt_ids:
+            if dt_id in summaries:
+                dt_name = summaries[dt_id]["name"]
+                break
+
+        return {"dt_ids": list(dt_ids), "dt_name": dt_name, "telegram_ids": telegram_ids}
+
+    @staticmethod
+    def _summarize(dt_doc: Dict) -> Dict:
+        telegram_ids = []
+        for id_val in dt_doc.get("metadata", {}).get("active_telegram_ids", []):
+            try:
+                if id_val:  # Verifica che non sia None o vuoto
+                    telegram_ids.append(int(id_val))
+            except (ValueError, TypeError):
+                print(f"AVVISO: Impossibile convertire ID Telegram '{id_val}' a intero")
+        return {"name": dt_doc.get("name"), "telegram_ids": telegram_ids}
+
+
+_router: Optional[NotificationRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_notification_router(db_service, dt_factory=None) -> NotificationRouter:
+    """Restituisce il router condiviso, creandolo al primo utilizzo"""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                from config.settings import NOTIFICATION_ROUTE_TTL
+                _router = NotificationRouter(db_service, dt_factory, ttl_seconds=NOTIFICATION_ROUTE_TTL)
+    if dt_factory is not None and _router.dt_factory is None:
+        _router.dt_factory = dt_factory
+    return _router
+
+
+def invalidate_notification_routes(dt_ids: Optional[Iterable[str]] = None) -> None:
+    """Da chiamare quando cambiano gli ID Telegram attivi (login/logout)"""
+    if _router is not None:
+        _router.invalidate(dt_ids)
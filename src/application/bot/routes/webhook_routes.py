@@ -1,22 +1,57 @@
-from flask import Blueprint, request
+import asyncio
+from flask import Blueprint, request, jsonify
 from telegram import Update
+from src.application.bot.notification_dispatcher import get_notification_dispatcher
+from src.services.alert_state import get_alert_engine
 webhook = Blueprint("webhook", __name__)
 application = None
+update_dispatcher = None
 
-def init_routes(app):
-    """Initialize the routes with the Telegram application instance"""
-    global application
+def init_routes(app, dispatcher=None):
+    """Initialize the routes with the Telegram application instance and its update queue"""
+    global application, update_dispatcher
     application = app
+    update_dispatcher = dispatcher
 
 @webhook.route("/telegram", methods=["POST"])
 def telegram_webhook():
     """Webhook endpoint for receiving updates from Telegram"""
     if request.method == "POST":
         update = Update.de_json(request.get_json(), application.bot)
-        application.loop.run_until_complete(application.process_update(update))
+        if update_dispatcher is None:
+            run_on_bot_loop(application.process_update(update))
+        elif not update_dispatcher.submit(update):
+            # Coda piena: Telegram riproverà a consegnare l'update
+            return "Busy", 503
     return "OK"
 
+@webhook.route("/telegram/stats", methods=["GET"])
+def telegram_stats():
+    """Profondità della coda degli update e latenza degli handler"""
+    if update_dispatcher is None:
+        return jsonify({"error": "Coda degli update non attiva"}), 404
+    return jsonify(update_dispatcher.stats())
+
+@webhook.route("/telegram/notifications/stats", methods=["GET"])
+def notification_stats():
+    """Coda delle notifiche in uscita: consegne, ritentativi, rate limit e latenza"""
+    return jsonify(get_notification_dispatcher().stats())
+
+@webhook.route("/alerts", methods=["GET"])
+def active_alerts():
+    """Allarmi attivi (opzionalmente di un solo dispositivo) e contatori del motore degli allarmi"""
+    alert_engine = get_alert_engine()
+    alerts = alert_engine.active_alerts(request.args.get("device_id"))
+    return jsonify({"alerts": alerts, "stats": alert_engine.stats()})
+
+def run_on_bot_loop(coro):
+    """Esegue una coroutine sul loop del bot, anche se gira in un altro thread"""
+    loop = application.loop
+    if loop.is_running():
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    return loop.run_until_complete(coro)
+
 @webhook.route("/")
 def index():
     """Root endpoint to check if the bot is active"""
-    return "Bot is up and running!"
\ No newline at end of file
+    return "Bot is up and running!"
@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Dict, Hashable
+
+from src.services.rollups import RunningStats
+
+
+class UpdateDispatcher:
+    """
+    Coda degli update Telegram ricevuti dal webhook.
+
+    Il webhook accoda l'update e risponde subito; l'elaborazione avviene sul
+    loop del bot (thread dedicato con app.py, loop di uvicorn con asgi.py).
+    Update di chat diverse sono elaborati in parallelo (al massimo
+    ``max_concurrent`` handler insieme), quelli della stessa chat uno dopo
+    l'altro nell'ordine di arrivo. Oltre ``max_pending`` update in attesa il
+    webhook risponde 503 e Telegram ritenta più tardi.
+    """
+
+    def __init__(self, application, loop, max_pending: int = 1000, max_concurrent: int = 32):
+        self.application = application
+        self.loop = loop
+        self.max_pending = max_pending
+        self.max_concurrent = max_concurrent
+        self._chats: Dict[Hashable, deque] = {}
+        self._tasks = set()
+        self._semaphore = None
+        self._pending = 0
+        self._running = 0
+        self._lock = threading.Lock()
+        self._latency = RunningStats()
+        self._wait = RunningStats()
+        self.metrics = {"received": 0, "processed": 0, "errors": 0, "rejected": 0, "max_pending": 0}
+
+    def submit(self, update) -> bool:
+        """
+        Accoda un update (chiamabile da qualsiasi thread).
+
+        Returns:
+            bool: False se la coda è piena e l'update va rifiutato
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.metrics["rejected"] += 1
+                return False
+            self._pending += 1
+            self.metrics["received"] += 1
+            self.metrics["max_pending"] = max(self.metrics["max_pending"], self._pending)
+        self.loop.call_soon_threadsafe(self._enqueue, update, time.monotonic())
+        return True
+
+    def stop(self, timeout: float = 30) -> None:
+        """Attende che gli update già accodati siano elaborati (da un thread diverso dal loop)"""
+        if not self.loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.join(), self.loop).result(timeout)
+        except Exception as e:
+            print(f"UpdateDispatcher: update ancora in coda alla chiusura: {self.stats()['pending']} ({e!r})")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.metrics)
+            stats["pending"] = self._pending
+            stats["running"] = self._running
+            stats["active_chats"] = len(self._chats)
+            stats["handler_latency"] = self._latency.to_dict()
+            stats["queue_wait"] = self._wait.to_dict()
+        return stats
+
+    @staticmethod
+    def _chat_key(update) -> Hashable:
+        chat = update.effective_chat
+        # Gli update senza chat (es. inline query) non hanno vincoli di ordine
+        return chat.id if chat is not None else ("update", update.update_id)
+
+    def _enqueue(self, update, received_at: float) -> None:
+        """Eseguito sul loop del bot: accoda l'update nella coda della sua chat"""
+        key = self._chat_key(update)
+        queue = self._chats.get(key)
+        if queue is not None:
+            queue.append((update, received_at))
+            return
+        queue = self._chats[key] = deque([(update, received_at)])
+        task = self.loop.create_task(self._drain(key, queue))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key: Hashable, queue: deque) -> None:
+        """Elabora in ordine gli update di una chat finché la sua coda non è vuota"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        try:
+            while queue:
+                update, received_at = queue.popleft()
+                async with self._semaphore:
+                    started = time.monotonic()
+                    with self._lock:
+                        self._running += 1
+                        self._wait.add(started - received_at)
+                    failed = False
+                    try:
+                        await self.application.process_update(update)
+                    except Exception as e:
+                        failed = True
+                        print(f"UpdateDispatcher: errore nell'elaborazione dell'update {update.update_id}: {e!r}")
+                    finally:
+                        with self._lock:
+                            self._running -= 1
+                            self._pending -= 1
+                            self._latency.add(time.monotonic() - started)
+                            self.metrics["errors" if failed else "processed"] += 1
+        finally:
+            self._chats.pop(key, None)
+
+    async def join(self) -> None:
+        """Versione da usare sul loop del bot: attende che le code delle chat si svuotino"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
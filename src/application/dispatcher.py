@@ -0,0 +1,145 @@
+import queue
+import threading
+import zlib
+from typing import Any, Callable, Dict, List, Optional
+
+_STOP = object()
+
+
+class PartitionedWorkerPool:
+    """
+    Pool di thread con code limitate, partizionato per chiave.
+
+    Ogni chiave (es. l'ID del dispositivo) viene assegnata sempre allo stesso
+    worker tramite hash, così i messaggi di uno stesso dispositivo restano in
+    ordine mentre dispositivi diversi vengono gestiti in parallelo. Se la coda
+    di una partizione è piena, ``submit`` attende al massimo ``put_timeout``
+    secondi e poi scarta il messaggio, aggiornando le metriche di backpressure
+    (anche per etichetta, es. il topic).
+
+    I lavori ``critical`` (es. emergenze) non occupano posti della coda limitata
+    e non vengono mai scartati né fatti attendere: entrano nella stessa coda
+    della partizione, quindi restano in ordine con gli altri messaggi del dispositivo.
+    """
+
+    def __init__(self, handler: Callable[..., Any], num_workers: int = 4,
+                 queue_size: int = 1000, put_timeout: float = 0.5, name: str = "worker"):
+        self.handler = handler
+        self.num_workers = max(1, int(num_workers))
+        self.queue_size = max(1, int(queue_size))
+        self.put_timeout = put_timeout
+        self.name = name
+        self._queues: List[queue.Queue] = []
+        self._slots: List[threading.Semaphore] = []  # posti liberi di ogni coda per i lavori non critici
+        self._threads: List[threading.Thread] = []
+        self._running = False
+        self._lock = threading.Lock()
+        self._metrics = {
+            "enqueued": 0,
+            "processed": 0,
+            "failed": 0,
+            "dropped": 0,
+            "blocked": 0,
+            "critical": 0,
+            "max_depth": 0,
+        }
+        self._dropped_by_label: Dict[str, int] = {}
+
+    def start(self) -> None:
+        with self._lock:
+            if self._running:
+                return
+            # Code senza limite: la capienza per i lavori non critici è data dai semafori
+            self._queues = [queue.Queue() for _ in range(self.num_workers)]
+            self._slots = [threading.Semaphore(self.queue_size) for _ in range(self.num_workers)]
+            self._threads = []
+            for index, work_queue in enumerate(self._queues):
+                thread = threading.Thread(
+                    target=self._run, args=(work_queue, self._slots[index]), name=f"{self.name}-{index}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            self._running = True
+
+    def partition(self, key: str) -> int:
+        return zlib.crc32(str(key).encode("utf-8")) % self.num_workers
+
+    def submit(self, key: str, *args, critical: bool = False, label: Optional[str] = None) -> bool:
+        """
+        Accoda un lavoro nella partizione della chiave.
+
+        Args:
+            key: Chiave di partizionamento (es. ID del dispositivo)
+            *args: Argomenti passati all'handler
+            critical: Lavoro da non scartare mai, anche con la coda piena
+            label: Etichetta per le metriche degli scarti (es. il topic)
+
+        Returns:
+            bool: False se il pool non è attivo o la coda è rimasta piena (messaggio scartato)
+        """
+        if not self._running:
+            return False
+
+        index = self.partition(key)
+        work_queue, slots = self._queues[index], self._slots[index]
+        if critical:
+            self._count("critical")
+        elif not slots.acquire(blocking=False):
+            self._count("blocked")
+            if not slots.acquire(timeout=self.put_timeout):
+                with self._lock:
+                    self._metrics["dropped"] += 1
+                    if label is not None:
+                        self._dropped_by_label[label] = self._dropped_by_label.get(label, 0) + 1
+                print(f"{self.name}: coda piena per la chiave {key}, messaggio scartato")
+                return False
+        work_queue.put((critical, args))
+
+        depth = work_queue.qsize()
+        with self._lock:
+            self._metrics["enqueued"] += 1
+            if depth > self._metrics["max_depth"]:
+                self._metrics["max_depth"] = depth
+        return True
+
+    def stop(self, timeout: float = 10) -> None:
+        """Smette di accettare lavori e attende che le code vengano svuotate"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+
+        for work_queue in self._queues:
+            # Il marcatore di stop viene accodato dopo i lavori pendenti (drain)
+            work_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        print(f"{self.name}: pool fermato, code svuotate")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._metrics)
+            stats["dropped_by_label"] = dict(self._dropped_by_label)
+        stats["workers"] = self.num_workers
+        stats["queue_size"] = self.queue_size
+        stats["queue_depths"] = [work_queue.qsize() for work_queue in self._queues]
+        return stats
+
+    def _count(self, metric: str) -> None:
+        with self._lock:
+            self._metrics[metric] += 1
+
+    def _run(self, work_queue: queue.Queue, slots: threading.Semaphore) -> None:
+        while True:
+            item = work_queue.get()
+            if item is _STOP:
+                break
+            critical, args = item
+            if not critical:
+                slots.release()
+            try:
+                self.handler(*args)
+                self._count("processed")
+            except Exception as e:
+                self._count("failed")
+                print(f"{self.name}: errore nella gestione del lavoro: {e}")
@@ -1,15 +1,19 @@
+import asyncio
 import paho.mqtt.client as mqtt
 import ssl
 import threading
 import time
 import json
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from datetime import datetime
-import json
 from config.settings import (
     MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD,
     MQTT_TOPIC_TAKEN, MQTT_TOPIC_DOOR, MQTT_TOPIC_EMERGENCY,
-    MQTT_TOPIC_ENVIRONMENTAL, MQTT_TOPIC_ASSOC
+    MQTT_TOPIC_ENVIRONMENTAL, MQTT_TOPIC_ASSOC,
+    MQTT_WORKERS, MQTT_WORKER_QUEUE_SIZE, MQTT_SHARED_GROUP
 )
+from src.application.dispatcher import PartitionedWorkerPool
+from src.services import dr_views
 
 BROKER_URL = MQTT_BROKER
 BROKER_PORT = MQTT_PORT
@@ -17,6 +21,312 @@ MQTT_USERNAME = MQTT_USERNAME
 MQTT_PASSWORD = MQTT_PASSWORD
 
 
+def subscription_topic(suffix: str) -> str:
+    """
+    Filtro di sottoscrizione per un tipo di topic dei dispositivi.
+
+    Con MQTT_SHARED_GROUP i messaggi vengono suddivisi tra i processi server del
+    gruppo ($share); il topic di associazione resta non condiviso perché la
+    conferma deve arrivare al processo che la sta attendendo.
+    """
+    if MQTT_SHARED_GROUP and suffix != MQTT_TOPIC_ASSOC:
+        return f"$share/{MQTT_SHARED_GROUP}/+/{suffix}"
+    return f"+/{suffix}"
+
+
+class DeviceReplyRegistry:
+    """
+    Attese di un messaggio da un dispositivo (es. la conferma di associazione).
+
+    Chi attende registra una Future asyncio per la coppia (device_id, topic);
+    il normale dispatch del subscriber la risolve quando il messaggio arriva,
+    senza sostituire la callback on_message e senza polling. Più attese
+    contemporanee (anche sullo stesso dispositivo) sono indipendenti.
+    """
+
+    def __init__(self):
+        self._waiters = {}  # (device_id, topic_suffix) -> [(loop, future, accept)]
+        self._lock = threading.Lock()
+
+    def expect(self, device_id, topic_suffix, accept=None):
+        """Registra un'attesa sul loop corrente e restituisce la Future del payload"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._waiters.setdefault((device_id, topic_suffix), []).append((loop, future, accept))
+        return future
+
+    def discard(self, device_id, topic_suffix, future):
+        """Rimuove un'attesa (scaduta o annullata)"""
+        key = (device_id, topic_suffix)
+        with self._lock:
+            waiters = [w for w in self._waiters.get(key, []) if w[1] is not future]
+            if waiters:
+                self._waiters[key] = waiters
+            else:
+                self._waiters.pop(key, None)
+
+    async def wait(self, device_id, topic_suffix, timeout, accept=None):
+        """
+        Attende il prossimo payload accettato dal dispositivo sul topic indicato.
+
+        Raises:
+            asyncio.TimeoutError: se nessun messaggio arriva entro ``timeout`` secondi
+        """
+        future = self.expect(device_id, topic_suffix, accept)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.discard(device_id, topic_suffix, future)
+
+    def resolve(self, device_id, topic_suffix, payload):
+        """Consegna un messaggio alle attese corrispondenti (chiamabile da qualsiasi thread)"""
+        key = (device_id, topic_suffix)
+        with self._lock:
+            waiters = self._waiters.get(key)
+            if not waiters:
+                return False
+            matched = [w for w in waiters if w[2] is None or w[2](payload)]
+            remaining = [w for w in waiters if w not in matched]
+            if remaining:
+                self._waiters[key] = remaining
+            else:
+                del self._waiters[key]
+        for loop, future, _ in matched:
+            loop.call_soon_threadsafe(_set_future_result, future, payload)
+        return bool(matched)
+
+    def pending(self):
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+
+def _set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+class MqttPublisher:
+    """
+    Client MQTT persistente dedicato alla pubblicazione.
+
+    La connessione TLS viene aperta una sola volta e mantenuta dal loop di rete
+    di paho, che si occupa anche della riconnessione automatica. Ogni publish
+    restituisce una Future risolta alla conferma del broker (PUBACK/PUBCOMP),
+    così chi invia molti messaggi non deve attendere il completamento di ciascuno.
+    Le Future non confermate entro ``ack_timeout`` secondi (broker irraggiungibile
+    a lungo, conferma mai arrivata) vengono risolte con False.
+    """
+
+    def __init__(self, broker_url=BROKER_URL, broker_port=BROKER_PORT,
+                 username=MQTT_USERNAME, password=MQTT_PASSWORD,
+                 reconnect_min_delay=1, reconnect_max_delay=60, max_inflight=100, ack_timeout=120):
+        self.broker_url = broker_url
+        self.broker_port = broker_port
+        self.username = username
+        self.password = password
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.max_inflight = max_inflight
+        self.ack_timeout = ack_timeout
+        self.client = None
+        self.is_running = False
+        self.connected = threading.Event()
+        self._pending = {}  # mid -> (Future in attesa di conferma, scadenza monotonic)
+        self._next_sweep = 0.0
+        self._acked_early = {}  # mid confermati prima della registrazione della Future -> istante
+        self._lock = threading.RLock()
+
+    def start(self):
+        """Apre la connessione persistente (non bloccante)"""
+        with self._lock:
+            if self.is_running:
+                return
+
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+            self.client.username_pw_set(self.username, self.password)
+            self.client.on_connect = self.on_connect
+            self.client.on_disconnect = self.on_disconnect
+            self.client.on_publish = self.on_publish
+
+            # Configura TLS
+            self.client.tls_set(cert_reqs=ssl.CERT_NONE)
+            self.client.tls_insecure_set(True)
+
+            self.client.reconnect_delay_set(self.reconnect_min_delay, self.reconnect_max_delay)
+            self.client.max_inflight_messages_set(self.max_inflight)
+
+            print(f"MQTT Publisher: Connessione a {self.broker_url}:{self.broker_port}...")
+            self.client.connect_async(self.broker_url, self.broker_port, 60)
+            self.client.loop_start()
+            self.is_running = True
+
+    def stop(self):
+        """Chiude la connessione e risolve come fallite le pubblicazioni ancora in attesa"""
+        with self._lock:
+            if not self.is_running:
+                return
+            self.is_running = False
+            pending = [future for future, _ in self._pending.values()]
+            self._pending.clear()
+            self._acked_early.clear()
+
+        for future in pending:
+            if not future.done():
+                future.set_result(False)
+
+        if self.client:
+            self.client.disconnect()
+            self.client.loop_stop()
+        self.connected.clear()
+        print("MQTT Publisher: Fermato e disconnesso")
+
+    def on_connect(self, client, userdata, flags, rc):
+        self._expire_pending()
+        if rc == 0:
+            self.connected.set()
+            print(f"MQTT Publisher: Connesso al broker {self.broker_url}")
+        else:
+            print(f"MQTT Publisher: Fallita connessione al broker, codice {rc}")
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        self._expire_pending()
+        if rc != 0:
+            # I messaggi QoS 1/2 restano in coda e vengono ritrasmessi alla riconnessione
+            print(f"MQTT Publisher: Disconnessione inattesa (codice {rc}), riconnessione automatica in corso")
+
+    # Una conferma anticipata viene consumata dalla publish che l'ha generata subito dopo il
+    # ritorno di client.publish(); oltre questo tempo è la conferma tardiva di una publish
+    # scaduta e va scartata, perché il mid (16 bit) verrà riassegnato
+    EARLY_ACK_TTL = 1.0
+
+    def on_publish(self, client, userdata, mid):
+        with self._lock:
+            entry = self._pending.pop(mid, None)
+            if entry is None:
+                self._prune_early_acks()
+                self._acked_early[mid] = time.monotonic()
+        if entry is None:
+            self._expire_pending()
+            return
+        future = entry[0]
+        if not future.done():
+            future.set_result(True)
+        self._expire_pending()
+
+    def _expire_pending(self):
+        """Risolve con False le Future in attesa da più di ack_timeout secondi (al più una volta al secondo)"""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_sweep or not self._pending:
+                return
+            self._next_sweep = now + 1.0
+            expired = [mid for mid, (_, deadline) in self._pending.items() if deadline <= now]
+            futures = [self._pending.pop(mid)[0] for mid in expired]
+        if futures:
+            print(f"MQTT Publisher: {len(futures)} pubblicazioni senza conferma entro {self.ack_timeout}s")
+        for future in futures:
+            if not future.done():
+                future.set_result(False)
+
+    def _prune_early_acks(self):
+        """Rimuove le conferme anticipate mai consumate (chiamato col lock)"""
+        if self._acked_early:
+            expired = time.monotonic() - self.EARLY_ACK_TTL
+            for mid in [mid for mid, acked_at in self._acked_early.items() if acked_at < expired]:
+                del self._acked_early[mid]
+
+    def publish_async(self, message: str, topic: str, qos: int = 2) -> Future:
+        """
+        Pubblica un messaggio senza attendere la conferma del broker.
+
+        Args:
+            message: Messaggio da inviare
+            topic: Topic su cui pubblicare
+            qos: Quality of Service (0, 1 o 2)
+
+        Returns:
+            Future: risolta con True alla conferma del broker, False se l'invio fallisce
+        """
+        future = Future()
+        if not self.is_running:
+            self.start()
+
+        # publish() va chiamato fuori dal lock: paho invoca on_publish tenendo il proprio
+        # mutex interno, e la conferma può quindi arrivare prima della registrazione
+        result = self.client.publish(topic, message, qos=qos)
+        # Senza connessione (avvio o riconnessione) paho accoda comunque i messaggi QoS 1/2
+        # e li trasmette alla riconnessione: la Future resta in attesa della conferma
+        queued = result.rc == mqtt.MQTT_ERR_SUCCESS or (result.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0)
+        if not queued:
+            print(f"MQTT Publisher: Invio su '{topic}' rifiutato (codice {result.rc})")
+            future.set_result(False)
+            return future
+
+        replaced = None
+        with self._lock:
+            if self._acked_early.pop(result.mid, None) is not None:
+                future.set_result(True)
+            else:
+                # mid (16 bit) riassegnato mentre una publish precedente era ancora in attesa:
+                # la sua conferma non è più distinguibile, viene considerata fallita
+                replaced = self._pending.get(result.mid)
+                self._pending[result.mid] = (future, time.monotonic() + self.ack_timeout)
+        future.mid = result.mid
+        if replaced is not None:
+            print(f"MQTT Publisher: mid {result.mid} riassegnato, la publish precedente è considerata fallita")
+            if not replaced[0].done():
+                replaced[0].set_result(False)
+        self._expire_pending()
+        return future
+
+    def publish(self, message: str, topic: str, qos: int = 2, timeout: float = 5) -> bool:
+        """Pubblica un messaggio e attende la conferma del broker (al massimo ``timeout`` secondi)"""
+        future = self.publish_async(message, topic, qos)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self.discard(future)
+            return False
+
+    def discard(self, future: Future) -> None:
+        """Smette di attendere la conferma di una publish (es. dopo un timeout)"""
+        mid = getattr(future, "mid", None)
+        with self._lock:
+            entry = self._pending.get(mid) if mid is not None else None
+            removed = entry is not None and entry[0] is future
+            if removed:
+                del self._pending[mid]
+        # Se non era più in attesa, la conferma è arrivata nel frattempo e la risolve on_publish
+        if removed and not future.done():
+            future.set_result(False)
+
+
+_default_publisher = None
+_default_publisher_lock = threading.Lock()
+
+
+def get_default_publisher() -> MqttPublisher:
+    """Publisher condiviso dal processo, avviato al primo utilizzo"""
+    global _default_publisher
+    if _default_publisher is None:
+        with _default_publisher_lock:
+            if _default_publisher is None:
+                publisher = MqttPublisher()
+                publisher.start()
+                _default_publisher = publisher
+    return _default_publisher
+
+
+def stop_default_publisher():
+    """Chiude il publisher condiviso (se è stato avviato)"""
+    global _default_publisher
+    with _default_publisher_lock:
+        if _default_publisher is not None:
+            _default_publisher.stop()
+            _default_publisher = None
+
 
 # --- Funzione di utilità per inviare messaggi MQTT ---
 def send_mqtt_message(message: str, topic: str, qos: int = 2):
@@ -31,25 +341,9 @@ def send_mqtt_message(message: str, topic: str, qos: int = 2):
     Returns:
         bool: True se l'invio è avvenuto con successo, False altrimenti
     """
-    import paho.mqtt.client as mqtt
-    import ssl
-    from config.settings import MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD
-    
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
-    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-    client.tls_set(cert_reqs=ssl.CERT_NONE)
-    client.tls_insecure_set(True)
-    
     try:
-        print(f"MQTT: Connessione a {MQTT_BROKER}:{MQTT_PORT}...")
-        client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        client.loop_start()
-        
         print(f"MQTT: Invio messaggio '{message}' su '{topic}'")
-        result = client.publish(topic, message, qos=qos)
-        result.wait_for_publish(timeout=5)
-        
-        success = result.is_published()
+        success = get_default_publisher().publish(message, topic, qos=qos)
         if success:
             print(f"MQTT: Messaggio inviato con successo")
         else:
@@ -59,18 +353,20 @@ def send_mqtt_message(message: str, topic: str, qos: int = 2):
     except Exception as e:
         print(f"MQTT: Errore di connessione/invio: {repr(e)}")
         return False
-    finally:
-        try:
-            client.loop_stop()
-            client.disconnect()
-        except:
-            pass
+
+
+def send_mqtt_message_async(message: str, topic: str, qos: int = 2) -> Future:
+    """Come send_mqtt_message, ma restituisce subito una Future con l'esito dell'invio"""
+    print(f"MQTT: Invio asincrono '{message}' su '{topic}'")
+    return get_default_publisher().publish_async(message, topic, qos=qos)
 
 
 
 class MqttSubscriber:
     def __init__(self, broker_url=BROKER_URL, broker_port=BROKER_PORT, 
-                 username=MQTT_USERNAME, password=MQTT_PASSWORD, db_service=None, app=None):
+                 username=MQTT_USERNAME, password=MQTT_PASSWORD, db_service=None, app=None,
+                 publisher=None, workers=MQTT_WORKERS, queue_size=MQTT_WORKER_QUEUE_SIZE,
+                 telemetry_buffer=None):
         self.broker_url = broker_url
         self.broker_port = broker_port
         self.username = username
@@ -80,6 +376,24 @@ class MqttSubscriber:
         self.is_running = False
         self.thread = None
         self.app = app  # Memorizza il riferimento all'app Flask
+        self._publisher = publisher
+        self.telemetry_buffer = telemetry_buffer  # scrittura differita dei dati ambientali
+        self.replies = DeviceReplyRegistry()  # attese dei messaggi di conferma dei dispositivi
+        # Il loop di rete si limita ad accodare: l'elaborazione avviene nei worker
+        self.dispatcher = PartitionedWorkerPool(
+            self._dispatch_message, num_workers=workers, queue_size=queue_size, name="mqtt-worker"
+        )
+
+    @property
+    def publisher(self):
+        """Publisher persistente usato per i messaggi in uscita (condiviso di default)"""
+        if self._publisher is None:
+            self._publisher = get_default_publisher()
+        return self._publisher
+
+    def publish(self, message, topic, qos=2):
+        """Pubblica tramite la connessione persistente, restituisce una Future"""
+        return self.publisher.publish_async(message, topic, qos)
         
     def set_dt_factory(self, dt_factory):
         """Imposta il DTFactory per accedere ai Digital Twin"""
@@ -92,23 +406,23 @@ class MqttSubscriber:
             print(f"MQTT Subscriber: Connesso al broker {self.broker_url}")
             
             # Sottoscrizioni principali usando QoS 2
-            client.subscribe(f"+/{MQTT_TOPIC_DOOR}", qos=2)
+            client.subscribe(subscription_topic(MQTT_TOPIC_DOOR), qos=2)
             print(f"MQTT Subscriber: Sottoscritto ai topic */{MQTT_TOPIC_DOOR} con QoS 2")
             
-            client.subscribe(f"+/{MQTT_TOPIC_EMERGENCY}", qos=2)
+            client.subscribe(subscription_topic(MQTT_TOPIC_EMERGENCY), qos=2)
             print(f"MQTT Subscriber: Sottoscritto ai topic */{MQTT_TOPIC_EMERGENCY} con QoS 2")
             
-            client.subscribe(f"+/{MQTT_TOPIC_ENVIRONMENTAL}", qos=2)
+            client.subscribe(subscription_topic(MQTT_TOPIC_ENVIRONMENTAL), qos=2)
             print(f"MQTT Subscriber: Sottoscritto ai topic */{MQTT_TOPIC_ENVIRONMENTAL} con QoS 2")
             
-            client.subscribe(f"+/{MQTT_TOPIC_ASSOC}", qos=2)
+            client.subscribe(subscription_topic(MQTT_TOPIC_ASSOC), qos=2)
             print(f"MQTT Subscriber: Sottoscritto ai topic */{MQTT_TOPIC_ASSOC} con QoS 2")
             
         else:
             print(f"MQTT Subscriber: Fallita connessione al broker, codice {rc}")
 
     def on_message(self, client, userdata, msg):
-        """Callback when a message is received"""
+        """Callback when a message is received: parse the topic and enqueue by device"""
         try:
             topic = msg.topic
             payload = msg.payload.decode('utf-8').strip()
@@ -119,20 +433,36 @@ class MqttSubscriber:
 
             print(f"MQTT: Ricevuto '{payload}' sul topic '{topic}', ID dispositivo: {device_id}")
 
-            
+            # Emergenze e conferme di associazione non vengono mai scartate per backpressure
+            critical = topic_suffix in (MQTT_TOPIC_EMERGENCY, MQTT_TOPIC_ASSOC)
+            self.dispatcher.submit(device_id, device_id, topic_suffix, payload,
+                                   critical=critical, label=topic_suffix)
+        except Exception as e:
+            print(f"MQTT Subscriber: Errore nella gestione del messaggio: {e}")
+
+    def get_dispatch_stats(self):
+        """Metriche delle code dei worker (accodati, elaborati, scartati anche per topic, profondità)"""
+        stats = self.dispatcher.stats()
+        stats["dropped_by_topic"] = stats.pop("dropped_by_label")
+        stats["pending_replies"] = self.replies.pending()
+        return stats
+
+    async def wait_for_message(self, device_id, topic_suffix, timeout, accept=None):
+        """Attende un messaggio del dispositivo sul topic indicato (vedi DeviceReplyRegistry.wait)"""
+        return await self.replies.wait(device_id, topic_suffix, timeout, accept)
+
+    def _dispatch_message(self, device_id, topic_suffix, payload):
+        """Elabora un messaggio nel worker assegnato al dispositivo"""
+        try:
+            # Conferme attese da un comando (es. associazione del dispositivo)
+            if topic_suffix == MQTT_TOPIC_ASSOC:
+                if not self.replies.resolve(device_id, topic_suffix, payload):
+                    print(f"MQTT: Messaggio di associazione da {device_id} senza richieste in attesa")
+
             # Gestione eventi porta con delega al servizio
-            if topic_suffix == MQTT_TOPIC_DOOR:
-                # Trova i DT collegati a questo dispositivo
-                dts_with_dispenser = self._find_dts_with_dr("dispenser_medicine", device_id)
-                
-                # Cerca un DT che abbia il servizio porta
-                door_service = None
-                for dt_id in dts_with_dispenser:
-                    dt_instance = self.dt_factory.get_dt_instance(dt_id)
-                    if dt_instance:
-                        door_service = dt_instance.get_service("DoorEventService")
-                        if door_service:
-                            break
+            elif topic_suffix == MQTT_TOPIC_DOOR:
+                # Cerca un DT collegato al dispositivo che abbia il servizio porta
+                door_service = self._find_dt_service(device_id, "DoorEventService")
                             
                 # Se abbiamo trovato un servizio, lo utilizziamo
                 if door_service:
@@ -154,17 +484,8 @@ class MqttSubscriber:
                 try:
                     env_data = json.loads(payload)
 
-                    # Trova tutti i DT collegati a questo dispositivo
-                    dts_with_dispenser = self._find_dts_with_dr("dispenser_medicine", device_id)
-
-                    # Cerca un DT che abbia il servizio ambientale
-                    env_service = None
-                    for dt_id in dts_with_dispenser:
-                        dt_instance = self.dt_factory.get_dt_instance(dt_id)
-                        if dt_instance:
-                            env_service = dt_instance.get_service("EnvironmentalMonitoringService")
-                            if env_service:
-                                break
+                    # Cerca un DT collegato al dispositivo che abbia il servizio ambientale
+                    env_service = self._find_dt_service(device_id, "EnvironmentalMonitoringService")
                                 
                     # Se abbiamo trovato un servizio, lo utilizziamo
                     if env_service:
@@ -172,7 +493,8 @@ class MqttSubscriber:
                             self.db_service, 
                             self.dt_factory, 
                             device_id, 
-                            env_data
+                            env_data,
+                            telemetry_buffer=self.telemetry_buffer
                         )
                     else:
                         print(f"MQTT: Nessun servizio ambientale trovato per il dispositivo {device_id}")
@@ -190,6 +512,8 @@ class MqttSubscriber:
             print("MQTT Subscriber: già in esecuzione")
             return
             
+        self.dispatcher.start()
+
         def run_subscriber():
             self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
             self.client.username_pw_set(self.username, self.password)
@@ -237,9 +561,14 @@ class MqttSubscriber:
             self.client.disconnect()
             print("MQTT Subscriber: Fermato e disconnesso")
 
+        # Nessun nuovo messaggio in arrivo: elabora quelli già accodati
+        self.dispatcher.stop()
+
     def connect(self):
         """Connect to the MQTT broker"""
         try:
+            self.dispatcher.start()
+
             # Configura il client MQTT
             self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
             self.client.username_pw_set(self.username, self.password)
@@ -255,11 +584,11 @@ class MqttSubscriber:
             
             # Sottoscrivi ai topic necessari usando le variabili di configurazione
             self.client.subscribe([
-                (f"+/{MQTT_TOPIC_TAKEN}", 0),             # Monitoraggio assunzione medicinali
-                (f"+/{MQTT_TOPIC_DOOR}", 0),               # Stato della porta del dispenser
-                (f"+/{MQTT_TOPIC_EMERGENCY}", 0),         # Topic per richieste di emergenza
-                (f"+/{MQTT_TOPIC_ENVIRONMENTAL}", 0),     # Topic per dati ambientali combinati
-                (f"+/{MQTT_TOPIC_ASSOC}", 0),             # Topic per associazione dispositivi
+                (subscription_topic(MQTT_TOPIC_TAKEN), 0),          # Monitoraggio assunzione medicinali
+                (subscription_topic(MQTT_TOPIC_DOOR), 0),           # Stato della porta del dispenser
+                (subscription_topic(MQTT_TOPIC_EMERGENCY), 0),      # Topic per richieste di emergenza
+                (subscription_topic(MQTT_TOPIC_ENVIRONMENTAL), 0),  # Topic per dati ambientali combinati
+                (subscription_topic(MQTT_TOPIC_ASSOC), 0),          # Topic per associazione dispositivi
             ])
             
             print("MQTT Subscriber: Connessione effettuata e sottoscrizioni configurate")
@@ -273,7 +602,7 @@ class MqttSubscriber:
         """Gestisce una richiesta di aiuto di emergenza"""
         try:
             # Verifica se esiste il dispositivo
-            dispenser = self.db_service.get_dr("dispenser_medicine", device_id)
+            dispenser = dr_views.get_owner(self.db_service, device_id)
             if not dispenser:
                 print(f"Dispositivo {device_id} non trovato")
                 return
@@ -307,16 +636,21 @@ class MqttSubscriber:
         except Exception as e:
             print(f"Errore nella gestione dell'emergenza: {e}")
 
+    def _find_dt_service(self, device_id, service_name):
+        """Restituisce il servizio richiesto dal primo DT collegato al dispositivo che lo possiede"""
+        for dt_id in self._find_dts_with_dr("dispenser_medicine", device_id):
+            dt_instance = self.dt_factory.get_dt_instance(dt_id)
+            if dt_instance:
+                service = dt_instance.get_service(service_name)
+                if service:
+                    return service
+        return None
+
     def _find_dts_with_dr(self, dr_type, dr_id):
         """Trova tutti i Digital Twin che contengono una certa Digital Replica"""
         try:
-            # Query diretta più semplice con il campo corretto
-            collection = self.db_service.db["digital_twins"]
-            query = {"digital_replicas": {"$elemMatch": {"id": dr_id, "type": dr_type}}}
-            matching_dts = []
-            
-            for dt in collection.find(query):
-                matching_dts.append(str(dt.get("_id")))
+            # Risoluzione tramite l'indice inverso del DTFactory (nessuna query per messaggio)
+            matching_dts = self.dt_factory.find_dts_with_dr(dr_type, dr_id)
             
             print(f"DEBUG: Trovati {len(matching_dts)} DT con {dr_type}={dr_id}: {matching_dts}")
             return matching_dts
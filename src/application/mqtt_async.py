@@ -0,0 +1,246 @@
+import asyncio
+import json
+import ssl
+from config.settings import (
+    MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD,
+    MQTT_TOPIC_DOOR, MQTT_TOPIC_EMERGENCY, MQTT_TOPIC_ENVIRONMENTAL, MQTT_TOPIC_ASSOC,
+    MQTT_ASYNC_MAX_INFLIGHT
+)
+
+from src.services import dr_views
+from src.application.mqtt import DeviceReplyRegistry, subscription_topic
+
+try:
+    import aiomqtt
+except ImportError:  # dipendenza necessaria solo con MQTT_SUBSCRIBER_MODE=async
+    aiomqtt = None
+
+
+class AsyncMqttSubscriber:
+    """
+    Subscriber MQTT basato su asyncio, eseguito sullo stesso loop del bot Telegram
+    (modalità sperimentale, MQTT_SUBSCRIBER_MODE=async).
+
+    I topic vengono consumati come stream asincrono; ogni dispositivo ha una propria
+    coda servita da un task, così l'ordine dei messaggi di un dispositivo è
+    preservato. Il numero di messaggi in elaborazione è limitato da
+    ``max_inflight``: oltre quella soglia la lettura dallo stream si sospende.
+
+    Rispetto alla modalità "thread" elimina il thread di rete di paho e il worker
+    pool, ma non i passaggi su thread: i servizi usano pymongo (sincrono), quindi
+    ogni handler ``*_async`` esegue la versione sincrona con asyncio.to_thread nel
+    default executor, che limita di fatto il parallelismo.
+    """
+
+    def __init__(self, broker_url=MQTT_BROKER, broker_port=MQTT_PORT,
+                 username=MQTT_USERNAME, password=MQTT_PASSWORD, db_service=None,
+                 publisher=None, max_inflight=MQTT_ASYNC_MAX_INFLIGHT, reconnect_interval=5,
+                 telemetry_buffer=None):
+        if aiomqtt is None:
+            raise ImportError("MQTT_SUBSCRIBER_MODE=async richiede il pacchetto 'aiomqtt'")
+        self.broker_url = broker_url
+        self.broker_port = broker_port
+        self.username = username
+        self.password = password
+        self.db_service = db_service
+        self.dt_factory = None
+        self.publisher = publisher
+        self.telemetry_buffer = telemetry_buffer  # scrittura differita dei dati ambientali
+        self.max_inflight = max_inflight
+        self.reconnect_interval = reconnect_interval
+        self.client = None  # il client paho non è esposto in questa modalità
+        self.is_running = False
+        self.loop = None
+        self._task = None
+        self._inflight = None
+        self._device_queues = {}
+        self._device_tasks = set()
+        self.replies = DeviceReplyRegistry()  # attese dei messaggi di conferma dei dispositivi
+        self.metrics = {"received": 0, "processed": 0, "failed": 0}
+
+    def set_dt_factory(self, dt_factory):
+        """Imposta il DTFactory per accedere ai Digital Twin"""
+        self.dt_factory = dt_factory
+        print("MQTT Async Subscriber: DTFactory collegato con successo")
+
+    def start(self, loop):
+        """Avvia il subscriber sul loop indicato (che deve essere già in esecuzione)"""
+        if self.is_running:
+            print("MQTT Async Subscriber: già in esecuzione")
+            return
+        self.loop = loop
+        self.is_running = True
+        asyncio.run_coroutine_threadsafe(self._start(), loop).result()
+        print("MQTT Async Subscriber: Avviato sul loop del bot")
+
+    async def _start(self):
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self, timeout=10):
+        """Ferma la ricezione e attende il completamento dei messaggi già accodati"""
+        if not self.is_running:
+            return
+        self.is_running = False
+        try:
+            asyncio.run_coroutine_threadsafe(self.stop_async(), self.loop).result(timeout=timeout)
+        except Exception as e:
+            print(f"MQTT Async Subscriber: Errore durante l'arresto: {e}")
+        print("MQTT Async Subscriber: Fermato e disconnesso")
+
+    async def stop_async(self):
+        self.is_running = False
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._device_tasks:
+            await asyncio.gather(*self._device_tasks, return_exceptions=True)
+
+    def get_dispatch_stats(self):
+        stats = dict(self.metrics)
+        stats["devices_in_flight"] = len(self._device_queues)
+        stats["pending_replies"] = self.replies.pending()
+        return stats
+
+    async def wait_for_message(self, device_id, topic_suffix, timeout, accept=None):
+        """Attende un messaggio del dispositivo sul topic indicato (vedi DeviceReplyRegistry.wait)"""
+        return await self.replies.wait(device_id, topic_suffix, timeout, accept)
+
+    async def run(self):
+        """Connessione, sottoscrizione e consumo dei messaggi, con riconnessione automatica"""
+        tls_params = aiomqtt.TLSParameters(cert_reqs=ssl.CERT_NONE)
+        while self.is_running:
+            try:
+                print(f"MQTT Async Subscriber: Connessione a {self.broker_url}:{self.broker_port}...")
+                async with aiomqtt.Client(
+                    self.broker_url, self.broker_port,
+                    username=self.username, password=self.password,
+                    tls_params=tls_params, tls_insecure=True,
+                ) as client:
+                    for suffix in (MQTT_TOPIC_DOOR, MQTT_TOPIC_EMERGENCY, MQTT_TOPIC_ENVIRONMENTAL, MQTT_TOPIC_ASSOC):
+                        await client.subscribe(subscription_topic(suffix), qos=2)
+                        print(f"MQTT Async Subscriber: Sottoscritto ai topic */{suffix} con QoS 2")
+
+                    async for message in client.messages:
+                        await self._enqueue(message)
+            except aiomqtt.MqttError as e:
+                if self.is_running:
+                    print(f"MQTT Async Subscriber: Connessione persa ({e}), nuovo tentativo tra {self.reconnect_interval}s")
+                    await asyncio.sleep(self.reconnect_interval)
+
+    async def _enqueue(self, message):
+        """Analizza il topic e accoda il messaggio nella coda del dispositivo"""
+        topic = message.topic.value
+        payload = message.payload.decode('utf-8').strip()
+        device_id = topic.split('/')[0]
+        topic_suffix = "/".join(topic.split('/')[1:])
+        print(f"MQTT: Ricevuto '{payload}' sul topic '{topic}', ID dispositivo: {device_id}")
+        self.metrics["received"] += 1
+
+        # Backpressure: sospende la lettura dallo stream se troppi messaggi sono in elaborazione
+        await self._inflight.acquire()
+        queue = self._device_queues.get(device_id)
+        if queue is None:
+            queue = asyncio.Queue()
+            self._device_queues[device_id] = queue
+            task = asyncio.create_task(self._drain_device(device_id, queue))
+            self._device_tasks.add(task)
+            task.add_done_callback(self._device_tasks.discard)
+        queue.put_nowait((topic_suffix, payload))
+
+    async def _drain_device(self, device_id, queue):
+        """Elabora in ordine i messaggi di un dispositivo; termina quando la coda è vuota"""
+        while True:
+            try:
+                topic_suffix, payload = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                # Nessun await tra il controllo e la rimozione: non ci sono race sul loop
+                del self._device_queues[device_id]
+                return
+            try:
+                await self._dispatch_message(device_id, topic_suffix, payload)
+                self.metrics["processed"] += 1
+            except Exception as e:
+                self.metrics["failed"] += 1
+                print(f"MQTT Async Subscriber: Errore nella gestione del messaggio: {e}")
+            finally:
+                self._inflight.release()
+
+    async def _dispatch_message(self, device_id, topic_suffix, payload):
+        # Conferme attese da un comando (es. associazione): non richiedono i DT
+        if topic_suffix == MQTT_TOPIC_ASSOC:
+            if not self.replies.resolve(device_id, topic_suffix, payload):
+                print(f"MQTT: Messaggio di associazione da {device_id} senza richieste in attesa")
+            return
+
+        if self.dt_factory is None:
+            print("MQTT Async Subscriber: DTFactory non ancora collegato, messaggio ignorato")
+            return
+
+        if topic_suffix == MQTT_TOPIC_DOOR:
+            door_service = await self._find_dt_service(device_id, "DoorEventService")
+            if door_service:
+                await door_service.handle_door_status_update_async(
+                    self.db_service, self.dt_factory, device_id, payload
+                )
+
+        elif topic_suffix == MQTT_TOPIC_EMERGENCY:
+            if payload == "1":
+                print(f"🚨 EMERGENZA rilevata dal dispositivo: {device_id}")
+                await self._handle_emergency_request(device_id)
+            else:
+                print(f"MQTT Async Subscriber: Payload non valido per emergenza: '{payload}'")
+
+        elif topic_suffix == MQTT_TOPIC_ENVIRONMENTAL:
+            try:
+                env_data = json.loads(payload)
+            except json.JSONDecodeError:
+                print(f"MQTT Async Subscriber: Payload dati ambientali non valido (non è JSON): '{payload}'")
+                return
+            env_service = await self._find_dt_service(device_id, "EnvironmentalMonitoringService")
+            if env_service:
+                await env_service.handle_environmental_data_async(
+                    self.db_service, self.dt_factory, device_id, env_data,
+                    telemetry_buffer=self.telemetry_buffer
+                )
+            else:
+                print(f"MQTT: Nessun servizio ambientale trovato per il dispositivo {device_id}")
+
+    async def _handle_emergency_request(self, device_id):
+        """Gestisce una richiesta di aiuto di emergenza"""
+        dispenser = await asyncio.to_thread(dr_views.get_owner, self.db_service, device_id)
+        if not dispenser:
+            print(f"Dispositivo {device_id} non trovato")
+            return
+
+        for dt_id in self.dt_factory.find_dts_with_dr("dispenser_medicine", device_id):
+            try:
+                dt_instance = await asyncio.to_thread(self.dt_factory.get_dt_instance, dt_id)
+                if not dt_instance:
+                    print(f"Istanza DT non trovata per {dt_id}")
+                    continue
+                emergency_service = dt_instance.get_service("EmergencyRequestService")
+                if not emergency_service:
+                    print(f"EmergencyRequestService non trovato nel DT {dt_id}")
+                    continue
+                dt = await asyncio.to_thread(self.dt_factory.get_dt, dt_id)
+                dt_name = dt.get("name", "Digital Twin") if dt else "Digital Twin"
+                emergency_service.db_service = self.db_service
+                emergency_service.dt_factory = self.dt_factory
+                await emergency_service.execute_async(device_id, dt_id, dt_name)
+            except Exception as e:
+                print(f"Errore nella gestione dell'emergenza per DT {dt_id}: {e}")
+
+    async def _find_dt_service(self, device_id, service_name):
+        """Restituisce il servizio richiesto dal primo DT collegato al dispositivo che lo possiede"""
+        # Indice in memoria: nessuna query; la costruzione del DT (se non in cache) va su un thread
+        for dt_id in self.dt_factory.find_dts_with_dr("dispenser_medicine", device_id):
+            dt_instance = await asyncio.to_thread(self.dt_factory.get_dt_instance, dt_id)
+            if dt_instance:
+                service = dt_instance.get_service(service_name)
+                if service:
+                    return service
+        return None
@@ -1,13 +1,13 @@
 # filepath: src\services\user_service.py
 import bcrypt
 from src.services.database_service import DatabaseService
-from src.virtualization.digital_replica.dr_factory import DRFactory
+from src.virtualization.digital_replica.dr_factory import get_dr_factory
 from typing import Optional, Dict, Any
 
 class UserService:
     def __init__(self, db_service: DatabaseService):
         self.db_service = db_service
-        self.dr_factory = DRFactory(".\\src\\virtualization\\templates\\user.yaml")
+        self.dr_factory = get_dr_factory(".\\src\\virtualization\\templates\\user.yaml")
 
     def create_user(self, username: str, password: str, role: str = "supervisor", dt_id: str = None) -> str:
         """
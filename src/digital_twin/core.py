@@ -12,7 +12,19 @@ class DigitalTwin:
 
     def add_digital_replica(self, dr_instance: Any) -> None:
         """Aggiunge una Digital Replica al twin"""
-        self.digital_replicas.append(dr_instance)
+        # Copy-on-write: chi sta iterando la lista precedente non vede modifiche a metà
+        self.digital_replicas = self.digital_replicas + [dr_instance]
+
+    def replace_digital_replica(self, dr_instance: Any) -> None:
+        """Sostituisce la Digital Replica con lo stesso _id (o la aggiunge se assente)"""
+        dr_id = dr_instance.get("_id")
+        replicas = [dr for dr in self.digital_replicas if dr.get("_id") != dr_id]
+        replicas.append(dr_instance)
+        self.digital_replicas = replicas
+
+    def remove_digital_replica(self, dr_id: str) -> None:
+        """Rimuove una Digital Replica dal twin"""
+        self.digital_replicas = [dr for dr in self.digital_replicas if dr.get("_id") != dr_id]
 
     def add_service(self, service):
         """Add a service to the DT"""
@@ -67,8 +79,13 @@ class DigitalTwin:
                 return True
         return False
 
-    def execute_medication_reminders(self):
-        """Esegue i promemoria medicinali orchestrando il servizio"""
+    def execute_medication_reminders(self, dispenser_ids=None):
+        """
+        Esegue i promemoria medicinali orchestrando il servizio
+
+        Args:
+            dispenser_ids: se indicato, limita il controllo a questi dispenser
+        """
 
         # Ottieni il servizio
         reminder_service = self.get_service("MedicationReminderService")
@@ -81,7 +98,7 @@ class DigitalTwin:
         }
 
         # Per ogni dispenser nel DT
-        for dispenser in self.get_replicas_by_type("dispenser_medicine"):
+        for dispenser in self.get_replicas_by_type("dispenser_medicine", dispenser_ids):
             # Il DT fornisce i dati al servizio
             results["promemoria_verificati"] += 1
 
@@ -194,7 +211,7 @@ class DigitalTwin:
         # Il DT gestisce direttamente l'invio della notifica
         self.send_notification(device_id, message, "environmental")
 
-    def execute_door_monitoring(self, threshold_minutes=1, db_service=None, dt_factory=None):
+    def execute_door_monitoring(self, threshold_minutes=1, db_service=None, dt_factory=None, dispenser_ids=None):
         """
         Esegue il monitoraggio delle porte aperte orchestrando il servizio di dominio.
         
@@ -202,6 +219,7 @@ class DigitalTwin:
             threshold_minutes (int): Soglia in minuti per generare un allarme.
             db_service: Istanza del servizio di database (dipendenza iniettata).
             dt_factory: Istanza della factory dei Digital Twin (dipendenza iniettata).
+            dispenser_ids: Se indicato, limita il controllo a questi dispenser.
         """
         # Ottieni il servizio specifico per la logica di dominio
         door_service = self.get_service("DoorEventService")
@@ -213,7 +231,7 @@ class DigitalTwin:
         }
     
         # Itera su tutte le repliche di tipo "dispenser"
-        for dispenser_replica in self.get_replicas_by_type("dispenser_medicine"):
+        for dispenser_replica in self.get_replicas_by_type("dispenser_medicine", dispenser_ids):
             # Il DT fornisce i dati della replica al servizio per l'analisi
             alerts = door_service.check_door_alerts(dispenser_replica, threshold_minutes)
     
@@ -244,16 +262,27 @@ class DigitalTwin:
         if db_service and dt_factory:
             # Importazione locale per evitare dipendenze circolari a livello di modulo
             from src.application.bot.notifications import send_door_open_alert
-            
+            from src.services.alert_state import ESCALATE, get_alert_engine
+
+            # Il controllo viene ripetuto a ogni giro dello scheduler: il motore degli
+            # allarmi lascia passare solo la prima notifica, i promemoria e l'escalation
+            action = get_alert_engine(db_service).evaluate(device_id, "door_open", True, value=minutes)
+            if action is None:
+                return
+
             send_door_open_alert(
                 db_service=db_service, 
                 dt_factory=dt_factory, 
                 device_id=device_id, 
-                minutes_open=minutes
+                minutes_open=minutes,
+                escalated=action == ESCALATE
             )
-    def get_replicas_by_type(self, dr_type):
-        """Ottiene tutte le Digital Replica di un certo tipo"""
-        return [dr for dr in self.digital_replicas if dr.get("type") == dr_type]
+    def get_replicas_by_type(self, dr_type, dr_ids=None):
+        """Ottiene tutte le Digital Replica di un certo tipo (eventualmente solo quelle con gli ID indicati)"""
+        return [
+            dr for dr in self.digital_replicas
+            if dr.get("type") == dr_type and (dr_ids is None or dr.get("_id") in dr_ids)
+        ]
 
     def execute_emergency_request(self, device_id, timestamp=None):
         """Gestisce una richiesta di emergenza orchestrando il servizio"""
@@ -312,26 +341,15 @@ class DigitalTwin:
                 replica["data"]["emergency_active"] = is_active
                 replica["data"]["last_emergency_request"] = timestamp.isoformat()
 
-                # Aggiungi l'evento alla lista degli eventi di emergenza
-                if "emergency_requests" not in replica["data"]:
-                    replica["data"]["emergency_requests"] = []
-
-                replica["data"]["emergency_requests"].append({
-                    "timestamp": timestamp.isoformat(),
-                    "status": "active",
-                    "resolved_at": None
-                })
-
                 # Persisti le modifiche nel DB se possibile
+                # (lo storico delle richieste va nella serie temporale, non nella replica)
                 if hasattr(self, 'db_service') and self.db_service:
+                    self.db_service.append_telemetry("emergency_requests", device_id, {
+                        "timestamp": timestamp.isoformat(),
+                        "status": "active",
+                        "resolved_at": None
+                    })
                     update_operation = {
-                        "$push": {
-                            "data.emergency_requests": {
-                                "timestamp": timestamp.isoformat(),
-                                "status": "active",
-                                "resolved_at": None
-                            }
-                        },
                         "$set": {
                             "data.emergency_active": is_active,
                             "data.last_emergency_request": timestamp.isoformat()
@@ -0,0 +1,106 @@
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+
+class ReplicaIndex:
+    """
+    In-memory reverse index from a Digital Replica to the Digital Twins that
+    reference it: (dr_type, dr_id) -> [dt_id].
+
+    The index is loaded lazily with a single scan of the twin references and is
+    then kept current by DTFactory on every structural mutation, so resolving
+    the owners of a device costs a dictionary lookup instead of a query.
+    """
+
+    def __init__(self, loader: Callable[[], Iterable[Dict]]):
+        """
+        Args:
+            loader: callable returning twin documents with at least ``_id`` and
+                ``digital_replicas`` (used for the initial load and reloads)
+        """
+        self._loader = loader
+        self._owners: Dict[Tuple[str, str], Dict[str, None]] = {}
+        self._refs: Dict[str, Set[Tuple[str, str]]] = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                self._load()
+
+    def _load(self) -> None:
+        self._owners.clear()
+        self._refs.clear()
+        for dt_doc in self._loader():
+            dt_id = str(dt_doc.get("_id"))
+            self._refs[dt_id] = set()
+            for dr_ref in dt_doc.get("digital_replicas", []):
+                self._add(dt_id, dr_ref.get("type"), dr_ref.get("id"))
+        self._loaded = True
+
+    def reload(self) -> None:
+        """Rebuild the index from the database"""
+        with self._lock:
+            self._load()
+
+    def _add(self, dt_id: str, dr_type: str, dr_id: str) -> None:
+        self._owners.setdefault((dr_type, dr_id), {})[dt_id] = None
+        self._refs.setdefault(dt_id, set()).add((dr_type, dr_id))
+
+    def lookup(self, dr_type: str, dr_id: str) -> List[str]:
+        """Return the ids of the twins containing the given replica"""
+        self._ensure_loaded()
+        with self._lock:
+            return list(self._owners.get((dr_type, dr_id), ()))
+
+    def replica_ids(self, dr_type: str) -> List[str]:
+        """Return the ids of the replicas of a type referenced by at least one twin"""
+        self._ensure_loaded()
+        with self._lock:
+            return [dr_id for ref_type, dr_id in self._owners if ref_type == dr_type]
+
+    def twin_refs(self, dt_id: str) -> List[Tuple[str, str]]:
+        """Return the (dr_type, dr_id) references held by a twin"""
+        self._ensure_loaded()
+        with self._lock:
+            return list(self._refs.get(dt_id, ()))
+
+    def add(self, dt_id: str, dr_type: str, dr_id: str) -> None:
+        self._ensure_loaded()
+        with self._lock:
+            self._add(dt_id, dr_type, dr_id)
+
+    def remove(self, dt_id: str, dr_id: str, dr_type: Optional[str] = None) -> None:
+        """Remove a replica reference from a twin (every type if dr_type is None)"""
+        self._ensure_loaded()
+        with self._lock:
+            refs = self._refs.get(dt_id, set())
+            for ref in [r for r in refs if r[1] == dr_id and (dr_type is None or r[0] == dr_type)]:
+                refs.discard(ref)
+                owners = self._owners.get(ref)
+                if owners is not None:
+                    owners.pop(dt_id, None)
+                    if not owners:
+                        del self._owners[ref]
+
+    def set_twin(self, dt_id: str, dr_refs: Iterable[Dict]) -> None:
+        """Replace every reference held by a twin"""
+        self._ensure_loaded()
+        with self._lock:
+            self.remove_twin(dt_id)
+            self._refs[dt_id] = set()
+            for dr_ref in dr_refs:
+                self._add(dt_id, dr_ref.get("type"), dr_ref.get("id"))
+
+    def remove_twin(self, dt_id: str) -> None:
+        self._ensure_loaded()
+        with self._lock:
+            for ref in self._refs.pop(dt_id, set()):
+                owners = self._owners.get(ref)
+                if owners is not None:
+                    owners.pop(dt_id, None)
+                    if not owners:
+                        del self._owners[ref]
@@ -0,0 +1,140 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Set, Tuple
+
+from src.digital_twin.core import DigitalTwin
+
+
+class DTInstanceCache:
+    """
+    Size-bounded LRU cache of fully built DigitalTwin instances, keyed by dt_id.
+
+    Entries are never rebuilt on a hit: structural changes (replicas/services)
+    are patched in place by DTFactory, while replica documents that changed in
+    the database are only marked stale and re-fetched one by one on the next
+    access.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max(1, int(max_size))
+        self._entries: "OrderedDict[str, DigitalTwin]" = OrderedDict()
+        self._stale: Dict[str, Set[Tuple[str, str]]] = {}
+        self._generations: Dict[str, int] = {}
+        self._replica_versions: Dict[str, int] = {}
+        self._sequence = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, dt_id: str) -> Optional[DigitalTwin]:
+        """Return the cached instance (marking it most recently used) or None"""
+        with self._lock:
+            dt = self._entries.get(dt_id)
+            if dt is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(dt_id)
+            self.hits += 1
+            return dt
+
+    def generation(self, dt_id: str) -> Tuple[int, int]:
+        """Invalidation marker of a twin, captured before a rebuild starts"""
+        with self._lock:
+            return self._generations.get(dt_id, 0), self._sequence
+
+    def put(self, dt_id: str, dt: DigitalTwin, generation: Optional[Tuple[int, int]] = None) -> bool:
+        """
+        Store a freshly built instance.
+
+        If ``generation`` is given and the twin was invalidated while it was
+        being built, the instance is discarded; replicas that changed during
+        the build are kept but marked stale.
+        """
+        with self._lock:
+            stale = set()
+            if generation is not None:
+                twin_generation, sequence = generation
+                if twin_generation != self._generations.get(dt_id, 0):
+                    return False
+                stale = {
+                    (dr.get("type"), dr.get("_id"))
+                    for dr in dt.digital_replicas
+                    if self._replica_versions.get(dr.get("_id"), 0) > sequence
+                }
+            self._entries[dt_id] = dt
+            self._entries.move_to_end(dt_id)
+            if stale:
+                self._stale[dt_id] = stale
+            else:
+                self._stale.pop(dt_id, None)
+            while len(self._entries) > self.max_size:
+                evicted_id, _ = self._entries.popitem(last=False)
+                self._stale.pop(evicted_id, None)
+                self.evictions += 1
+            return True
+
+    def peek(self, dt_id: str) -> Optional[DigitalTwin]:
+        """Return the cached instance without touching LRU order or counters"""
+        with self._lock:
+            return self._entries.get(dt_id)
+
+    def patch(self, dt_id: str, mutate: Callable[[DigitalTwin], None]) -> bool:
+        """
+        Apply a structural change to a cached instance in place.
+
+        The twin's generation is bumped so that a rebuild started before the
+        change cannot overwrite the patched entry with older data.
+        """
+        with self._lock:
+            self._generations[dt_id] = self._generations.get(dt_id, 0) + 1
+            dt = self._entries.get(dt_id)
+            if dt is None:
+                return False
+            try:
+                mutate(dt)
+            except Exception as e:
+                # Meglio ricostruire al prossimo accesso che servire un'istanza incoerente
+                print(f"DTInstanceCache: patch fallita per {dt_id}, entry invalidata: {e}")
+                self._entries.pop(dt_id, None)
+                self._stale.pop(dt_id, None)
+                return False
+            return True
+
+    def invalidate(self, dt_id: str) -> None:
+        """Drop a twin from the cache"""
+        with self._lock:
+            self._entries.pop(dt_id, None)
+            self._stale.pop(dt_id, None)
+            self._generations[dt_id] = self._generations.get(dt_id, 0) + 1
+
+    def mark_replica_stale(self, dr_type: str, dr_id: str) -> None:
+        """Flag a replica as changed in every cached twin that contains it"""
+        with self._lock:
+            self._sequence += 1
+            self._replica_versions[dr_id] = self._sequence
+            for dt_id, dt in self._entries.items():
+                if any(dr.get("_id") == dr_id for dr in dt.digital_replicas):
+                    self._stale.setdefault(dt_id, set()).add((dr_type, dr_id))
+
+    def pop_stale(self, dt_id: str) -> Set[Tuple[str, str]]:
+        """Return and clear the set of stale replicas of a cached twin"""
+        with self._lock:
+            return self._stale.pop(dt_id, set())
+
+    def clear(self) -> None:
+        with self._lock:
+            for dt_id in self._entries:
+                self._generations[dt_id] = self._generations.get(dt_id, 0) + 1
+            self._entries.clear()
+            self._stale.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
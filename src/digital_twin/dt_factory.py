@@ -1,18 +1,46 @@
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
 from datetime import datetime
 from bson import ObjectId
 from src.services.database_service import DatabaseService
 from src.virtualization.digital_replica.schema_registry import SchemaRegistry
 from src.digital_twin.core import DigitalTwin
+from src.digital_twin.dt_cache import DTInstanceCache
+from src.digital_twin.dr_index import ReplicaIndex
+from src.services.index_manager import DIGITAL_TWIN_INDEXES, ensure_indexes
 
 
 class DTFactory:
     """Factory class for creating and managing Digital Twins"""
 
-    def __init__(self, db_service: DatabaseService, schema_registry: SchemaRegistry):
+    def __init__(self, db_service: DatabaseService, schema_registry: SchemaRegistry,
+                 cache_size: int = 256):
         self.db_service = db_service
         self.schema_registry = schema_registry
         self._init_dt_collection()
+        self._service_classes: Dict[str, type] = {}
+        self._instance_cache = DTInstanceCache(max_size=cache_size)
+        # Indice inverso replica -> DT, caricato al primo utilizzo
+        self.replica_index = ReplicaIndex(self._load_replica_refs)
+        # Le scritture sulle repliche marcano come obsolete le istanze in cache
+        self.db_service.add_change_listener(self._on_replica_changed)
+        self._link_listeners: List[Callable[[str, str], None]] = []
+
+    def add_link_listener(self, listener: Callable[[str, str], None]) -> None:
+        """
+        Register a callback invoked when a replica is linked to or unlinked from a twin.
+
+        The callback receives (dr_type, dr_id); use find_dts_with_dr to read the
+        twins that reference the replica after the change.
+        """
+        self._link_listeners.append(listener)
+
+    def _notify_links(self, refs) -> None:
+        for dr_type, dr_id in refs:
+            for listener in list(self._link_listeners):
+                try:
+                    listener(dr_type, dr_id)
+                except Exception as e:
+                    print(f"ERROR in DR link listener: {e}")
 
     def create_dt(self, name: str, description: str = "") -> str:
         """
@@ -41,6 +69,7 @@ class DTFactory:
         try:
             dt_collection = self.db_service.db["digital_twins"]
             result = dt_collection.insert_one(dt_data)
+            self.replica_index.set_twin(str(result.inserted_id), [])
             return str(result.inserted_id)
         except Exception as e:
             raise Exception(f"Failed to create Digital Twin: {str(e)}")
@@ -70,6 +99,14 @@ class DTFactory:
                     "$set": {"metadata.updated_at": datetime.utcnow()},
                 },
             )
+
+            self.replica_index.add(dt_id, dr_type, dr_id)
+            self._notify_links([(dr_type, dr_id)])
+
+            # Patch the cached instance with the replica we already fetched
+            self._instance_cache.patch(
+                dt_id, lambda dt: dt.add_digital_replica(dr)
+            )
         except Exception as e:
             raise Exception(f"Failed to add Digital Replica: {str(e)}")
 
@@ -110,11 +147,8 @@ class DTFactory:
             module_name = module_mapping[service_name]
 
             try:
-                service_module = __import__(module_name, fromlist=[service_name])
-                service_class = getattr(service_module, service_name)
-
                 # Verifica che il servizio esista prima di aggiungerlo
-                service = service_class()
+                service = self._build_service(service_name, service_config or {})
 
                 service_data = {
                     "name": service_name,
@@ -130,6 +164,8 @@ class DTFactory:
                         "$set": {"metadata.updated_at": datetime.utcnow()},
                     },
                 )
+
+                self._instance_cache.patch(dt_id, lambda dt: dt.add_service(service))
             except (ImportError, AttributeError) as e:
                 raise ValueError(
                     f"Failed to load service {service_name} from module {module_name}: {str(e)}"
@@ -206,6 +242,12 @@ class DTFactory:
     
             if result.matched_count == 0:
                 raise ValueError(f"Digital Twin not found: {dt_id}")
+
+            if "digital_replicas" in update_data:
+                previous = self.replica_index.twin_refs(dt_id)
+                self.replica_index.set_twin(dt_id, update_data["digital_replicas"])
+                self._notify_links(set(previous) | set(self.replica_index.twin_refs(dt_id)))
+            self._instance_cache.invalidate(dt_id)
     
         except Exception as e:
             raise Exception(f"Failed to update Digital Twin: {str(e)}")
@@ -220,6 +262,10 @@ class DTFactory:
         try:
             dt_collection = self.db_service.db["digital_twins"]
             result = dt_collection.delete_one({"_id": dt_id})
+            previous = self.replica_index.twin_refs(dt_id)
+            self.replica_index.remove_twin(dt_id)
+            self._instance_cache.invalidate(dt_id)
+            self._notify_links(previous)
     
             if result.deleted_count == 0:
                 raise ValueError(f"Digital Twin not found: {dt_id}")
@@ -251,6 +297,13 @@ class DTFactory:
                     }
                 }
             )
+
+            removed = [ref for ref in self.replica_index.twin_refs(dt_id) if ref[1] == dr_id]
+            self.replica_index.remove(dt_id, dr_id)
+            self._notify_links(removed)
+            self._instance_cache.patch(
+                dt_id, lambda dt: dt.remove_digital_replica(dr_id)
+            )
         except Exception as e:
             raise Exception(f"Failed to remove Digital Replica: {str(e)}")
 
@@ -278,6 +331,10 @@ class DTFactory:
                     }
                 }
             )
+
+            self._instance_cache.patch(
+                dt_id, lambda dt: dt.remove_service(service_name)
+            )
         except Exception as e:
             raise Exception(f"Failed to remove service: {str(e)}")
 
@@ -290,10 +347,8 @@ class DTFactory:
             db = self.db_service.db
             if "digital_twins" not in db.list_collection_names():
                 db.create_collection("digital_twins")
-                dt_collection = db["digital_twins"]
-                dt_collection.create_index("name", unique=True)
-                dt_collection.create_index("metadata.created_at")
-                dt_collection.create_index("metadata.updated_at")
+            # Only missing indexes are created, so existing collections are covered too
+            ensure_indexes(db["digital_twins"], DIGITAL_TWIN_INDEXES)
         except Exception as e:
             raise Exception(f"Failed to initialize DT collection: {str(e)}")
 
@@ -307,12 +362,13 @@ class DTFactory:
             dt = DigitalTwin()
             print(f"Created new DT instance for {dt_data.get('name', 'unnamed')}")
 
-            # Add Digital Replicas
-            for dr_ref in dt_data.get("digital_replicas", []):
-                dr = self.db_service.get_dr(dr_ref["type"], dr_ref["id"])
-                if dr:
-                    dt.add_digital_replica(dr)
-                    print(f"Added DR: {dr_ref['type']} - {dr_ref['id']}")
+            # Add Digital Replicas (one query per replica type)
+            replicas = self._load_replicas(
+                (dr_ref["type"], dr_ref["id"]) for dr_ref in dt_data.get("digital_replicas", [])
+            )
+            for (dr_type, dr_id), dr in replicas.items():
+                dt.add_digital_replica(dr)
+                print(f"Added DR: {dr_type} - {dr_id}")
 
             # Add Services
             print("\nLoading services...")
@@ -325,24 +381,11 @@ class DTFactory:
 
                 if service_name in service_mapping:
                     try:
-                        module_name = service_mapping[service_name]
-                        print(f"Loading module: {module_name}")
-
-                        service_module = __import__(
-                            module_name, fromlist=[service_name]
+                        service = self._build_service(
+                            service_name, service_data.get("config")
                         )
-                        print(f"Module loaded successfully")
-
-                        service_class = getattr(service_module, service_name)
-                        print(f"Got service class: {service_class}")
-
-                        service = service_class()
                         print(f"Service instance created")
 
-                        if hasattr(service, "configure") and "config" in service_data:
-                            service.configure(service_data["config"])
-                            print(f"Service configured with: {service_data['config']}")
-
                         dt.add_service(service)
                         print(f"Service added to DT")
                         print(f"Current DT services: {dt.list_services()}")
@@ -370,13 +413,99 @@ class DTFactory:
             Optional[DigitalTwin]: Digital Twin instance if found, None otherwise
         """
         try:
+            cached = self._instance_cache.get(dt_id)
+            if cached is not None:
+                self._refresh_stale_replicas(dt_id, cached)
+                return cached
+
+            generation = self._instance_cache.generation(dt_id)
+
             # Get DT data from database
             dt_data = self.get_dt(dt_id)
             if not dt_data:
                 return None
 
-            # Create and return DT instance
-            return self.create_dt_from_data(dt_data)
+            # Create, cache and return DT instance
+            dt = self.create_dt_from_data(dt_data)
+            self._instance_cache.put(dt_id, dt, generation)
+            return dt
 
         except Exception as e:
             raise Exception(f"Failed to get DT instance: {str(e)}")
+
+    def find_dts_with_dr(self, dr_type: str, dr_id: str) -> List[str]:
+        """
+        Find the Digital Twins that contain a given Digital Replica
+
+        Args:
+            dr_type: Type of Digital Replica
+            dr_id: Digital Replica ID
+
+        Returns:
+            List[str]: IDs of the Digital Twins referencing the replica
+        """
+        try:
+            return self.replica_index.lookup(dr_type, dr_id)
+        except Exception as e:
+            raise Exception(f"Failed to find Digital Twins for replica: {str(e)}")
+
+    def _load_replica_refs(self) -> List[Dict]:
+        """Load the replica references of every twin (ReplicaIndex loader)"""
+        dt_collection = self.db_service.db["digital_twins"]
+        return list(dt_collection.find({}, {"digital_replicas": 1}))
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        """Hit/miss/eviction counters of the DigitalTwin instance cache"""
+        return self._instance_cache.stats()
+
+    def _build_service(self, service_name: str, service_config: Optional[Dict] = None):
+        """Instantiate (and configure) a service, resolving its class only once"""
+        service_class = self._service_classes.get(service_name)
+        if service_class is None:
+            module_name = self._get_service_module_mapping()[service_name]
+            service_module = __import__(module_name, fromlist=[service_name])
+            service_class = getattr(service_module, service_name)
+            self._service_classes[service_name] = service_class
+
+        service = service_class()
+        if hasattr(service, "configure") and service_config is not None:
+            service.configure(service_config)
+        return service
+
+    def _on_replica_changed(self, dr_type: str, dr_id: str, changed_fields=None) -> None:
+        """DatabaseService listener: mark cached copies of the replica as stale"""
+        self._instance_cache.mark_replica_stale(dr_type, dr_id)
+
+    def _load_replicas(self, refs) -> Dict[tuple, Dict]:
+        """
+        Fetch the referenced Digital Replicas grouping the IDs by type
+
+        Args:
+            refs: Iterable of (dr_type, dr_id) pairs
+
+        Returns:
+            Dict: (dr_type, dr_id) -> replica for the existing ones, in reference order
+        """
+        refs = list(refs)
+        ids_by_type: Dict[str, List[str]] = {}
+        for dr_type, dr_id in refs:
+            ids_by_type.setdefault(dr_type, []).append(dr_id)
+
+        loaded = {}
+        for dr_type, dr_ids in ids_by_type.items():
+            for dr in self.db_service.get_drs_bulk(dr_type, dr_ids):
+                loaded[(dr_type, dr["_id"])] = dr
+        return {ref: loaded[ref] for ref in dict.fromkeys(refs) if ref in loaded}
+
+    def _refresh_stale_replicas(self, dt_id: str, dt: DigitalTwin) -> None:
+        """Re-fetch only the replicas of a cached twin that changed since it was built"""
+        stale = self._instance_cache.pop_stale(dt_id)
+        if not stale:
+            return
+        refreshed = self._load_replicas(stale)
+        for dr_type, dr_id in stale:
+            dr = refreshed.get((dr_type, dr_id))
+            if dr:
+                dt.replace_digital_replica(dr)
+            else:
+                dt.remove_digital_replica(dr_id)
@@ -125,9 +125,7 @@ class DTManager:
                     "channels": ["telegram", "app_notification"]
                 }),
                 # FR-2: Door Open/Close Detection
-                ("DoorEventService", {
-                    "notification_threshold": 30
-                }),
+                ("DoorEventService", {}),
                 # FR-6: Emergency Help Request
                 ("EmergencyRequestService", {
                     "emergency_contacts": ["supervisor"],
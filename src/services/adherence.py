@@ -0,0 +1,243 @@
+"""
+Riepilogo giornaliero dell'aderenza di ogni dispenser.
+
+Ogni evento porta aggiorna con un'unica operazione atomica la riga del giorno
+(collezione ``adherence_daily``, ``_id`` = "<dispenser>:<YYYY-MM-DD>"), così
+i report settimanali e mensili leggono al più una riga per giorno invece di
+scorrere tutti gli eventi porta.
+"""
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from src.services import dr_views
+from src.services.medication_schedule import CompiledSchedule, DoseWindow, get_compiled_schedule, parse_minutes
+
+# Intervallo usato quando il dispenser non ha un orario di assunzione configurato
+DEFAULT_WINDOW = ("08:00", "20:00")
+DEFAULT_SCHEDULE = CompiledSchedule([DoseWindow(parse_minutes(DEFAULT_WINDOW[0]), parse_minutes(DEFAULT_WINDOW[1]))])
+
+# Stato di un giorno
+TAKEN = "taken"        # apertura e chiusura in ogni intervallo di assunzione del giorno
+LATE = "late"          # assunzione completata dopo la fine dell'intervallo
+MISSED = "missed"      # eventi porta presenti ma nessuna assunzione
+NO_DATA = "no_data"    # nessun evento porta registrato
+
+
+def day_status(row: Optional[Dict]) -> str:
+    """Stato di un giorno a partire dalla sua riga di riepilogo"""
+    if not row or not row.get("events"):
+        return NO_DATA
+    if all(dose_taken(row, index) for index in range(len(row.get("windows") or ()) or 1)):
+        return TAKEN
+    if (row.get("open_in_window") or row.get("open_after")) and row.get("close_after"):
+        return LATE
+    return MISSED
+
+
+def adherence_rate(statuses: List[str]) -> Optional[float]:
+    """Percentuale di giorni con assunzione (puntuale o in ritardo) sui giorni con dati"""
+    tracked = [status for status in statuses if status != NO_DATA]
+    if not tracked:
+        return None
+    return round(100 * sum(1 for status in tracked if status in (TAKEN, LATE)) / len(tracked), 1)
+
+
+def dose_taken(row: Optional[Dict], index: int) -> bool:
+    """Vero se la dose della finestra ``index`` è stata assunta (apertura e chiusura nella finestra)"""
+    row = row or {}
+    doses = row.get("doses")
+    if doses is None:
+        # Riepiloghi senza dettaglio per dose: basta un'apertura e una chiusura in finestra
+        return bool(row.get("open_in_window") and row.get("close_in_window"))
+    dose = doses.get(str(index)) or {}
+    return bool(dose.get("open") and dose.get("close"))
+
+
+def _schedule(dispenser: Optional[Dict]) -> CompiledSchedule:
+    return (get_compiled_schedule(dispenser) if dispenser else None) or DEFAULT_SCHEDULE
+
+
+def local_days(dispenser: Optional[Dict], count: int, now: Optional[datetime] = None) -> List[str]:
+    """
+    Ultimi ``count`` giorni (dal più vecchio a oggi) nel fuso degli orari del
+    dispenser, lo stesso usato come chiave delle righe di riepilogo.
+    """
+    today = _schedule(dispenser).local_date(now or datetime.now())
+    return [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(count - 1, -1, -1)]
+
+
+def _day(value) -> str:
+    if isinstance(value, (datetime, date)):
+        return value.strftime("%Y-%m-%d")
+    return str(value)[:10]
+
+
+class AdherenceStore:
+    """Riepiloghi giornalieri dell'aderenza, aggiornati a ogni evento porta"""
+
+    def __init__(self, db_service, collection_name: str = "adherence_daily"):
+        self.db_service = db_service
+        self.collection_name = collection_name
+        self._indexed = False
+
+    def _collection(self):
+        collection = self.db_service.db[self.collection_name]
+        if not self._indexed:
+            collection.create_index([("dispenser_id", 1), ("date", 1)])
+            self._indexed = True
+        return collection
+
+    @staticmethod
+    def _event_update(state: str, timestamp: datetime, schedule: CompiledSchedule) -> Dict:
+        update = {
+            "$inc": {"events": 1},
+            "$set": {"updated_at": datetime.now().isoformat()},
+        }
+        if state in ("open", "closed"):
+            flag = "open" if state == "open" else "close"
+            index = schedule.window_index(timestamp)
+            if index is not None:
+                update["$set"][f"{flag}_in_window"] = True
+                update["$set"][f"doses.{index}.{flag}"] = True
+                update["$min"] = {f"first_{flag}": schedule.local(timestamp).strftime("%H:%M")}
+            elif schedule.last_ended_window(timestamp) is not None:
+                update["$set"][f"{flag}_after"] = True
+        return update
+
+    @staticmethod
+    def _on_insert(dispenser_id: str, day: str, schedule: CompiledSchedule) -> Dict:
+        first = schedule.windows[0]
+        return {
+            "dispenser_id": dispenser_id, "date": day,
+            "window_start": first.start_time, "window_end": schedule.windows[-1].end_time,
+            "windows": [window.label for window in schedule.windows],
+        }
+
+    def record_door_event(self, dispenser_id: str, state: str, timestamp: datetime,
+                          schedule: Optional[CompiledSchedule] = None) -> None:
+        """
+        Aggiorna il riepilogo del giorno con un evento porta.
+
+        Args:
+            dispenser_id: ID del dispenser
+            state: 'open' o 'closed'
+            timestamp: Data e ora dell'evento
+            schedule: Finestre di assunzione compilate; lette dal DB se non passate
+        """
+        if schedule is None:
+            schedule = _schedule(dr_views.get_schedule(self.db_service, dispenser_id))
+        day = _day(schedule.local_date(timestamp))
+
+        update = self._event_update(state, timestamp, schedule)
+        update["$setOnInsert"] = self._on_insert(dispenser_id, day, schedule)
+        self._collection().update_one({"_id": f"{dispenser_id}:{day}"}, update, upsert=True)
+
+    def get_days(self, dispenser_ids: Iterable[str], days: List[str]) -> Dict[Tuple[str, str], Dict]:
+        """Righe dei giorni richiesti per più dispenser, con una sola query"""
+        dispenser_ids = list(dispenser_ids)
+        if not dispenser_ids or not days:
+            return {}
+        cursor = self._collection().find({
+            "dispenser_id": {"$in": dispenser_ids},
+            "date": {"$gte": min(days), "$lte": max(days)},
+        })
+        return {(row["dispenser_id"], row["date"]): row for row in cursor}
+
+    def get_statuses(self, dispenser_ids: Iterable[str], days: List[str]) -> Dict[str, List[str]]:
+        """Stato di ogni giorno (nell'ordine di ``days``) per ciascun dispenser"""
+        dispenser_ids = list(dispenser_ids)
+        rows = self.get_days(dispenser_ids, days)
+        return {
+            dispenser_id: [day_status(rows.get((dispenser_id, day))) for day in days]
+            for dispenser_id in dispenser_ids
+        }
+
+    def get_local_statuses(self, dispensers: Iterable[Dict], count: int,
+                           now: Optional[datetime] = None) -> Dict[str, List[str]]:
+        """
+        Stato degli ultimi ``count`` giorni locali di ciascun dispenser (vedi
+        ``local_days``), dal più vecchio a oggi, con una sola query.
+        """
+        days_by_dispenser = {dispenser["_id"]: local_days(dispenser, count, now) for dispenser in dispensers}
+        all_days = sorted({day for days in days_by_dispenser.values() for day in days})
+        rows = self.get_days(days_by_dispenser, all_days)
+        return {
+            dispenser_id: [day_status(rows.get((dispenser_id, day))) for day in days]
+            for dispenser_id, days in days_by_dispenser.items()
+        }
+
+    def get_summary(self, dispenser_id: str, days: int = 30, today: Optional[date] = None) -> Dict:
+        """
+        Conteggi degli ultimi ``days`` giorni e percentuale di aderenza
+        (assunzioni puntuali o in ritardo sui giorni con dati).
+        """
+        today = today or datetime.now().date()
+        day_list = [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+        statuses = self.get_statuses([dispenser_id], day_list)[dispenser_id]
+        counts = {status: statuses.count(status) for status in (TAKEN, LATE, MISSED, NO_DATA)}
+        counts["days"] = days
+        counts["adherence_rate"] = adherence_rate(statuses)
+        return counts
+
+    def rebuild(self, days: int = 30) -> int:
+        """
+        Ricostruisce i riepiloghi degli ultimi ``days`` giorni dalla serie door_events
+        (da usare una volta, quando la collezione è vuota).
+
+        Returns:
+            int: Numero di eventi elaborati
+        """
+        since = (datetime.now().date() - timedelta(days=days)).strftime("%Y%m%d")
+        buckets = list(self.db_service.db["telemetry_door_events"].find(
+            {"day": {"$gte": since}}, {"device_id": 1, "samples": 1}
+        ))
+        if not buckets:
+            return 0
+
+        dispenser_ids = list({bucket["device_id"] for bucket in buckets})
+        schedules = {
+            dispenser["_id"]: _schedule(dispenser)
+            for dispenser in self.db_service.get_drs_bulk(
+                dr_views.DISPENSER_TYPE, dispenser_ids, projection=dr_views.SCHEDULE_FIELDS
+            )
+        }
+
+        operations = []
+        for bucket in buckets:
+            dispenser_id = bucket["device_id"]
+            schedule = schedules.get(dispenser_id) or DEFAULT_SCHEDULE
+            for event in bucket.get("samples", []):
+                try:
+                    timestamp = datetime.fromisoformat(event.get("timestamp", ""))
+                except ValueError:
+                    continue
+                day = _day(schedule.local_date(timestamp))
+                update = self._event_update(event.get("state"), timestamp, schedule)
+                update["$setOnInsert"] = self._on_insert(dispenser_id, day, schedule)
+                operations.append(UpdateOne({"_id": f"{dispenser_id}:{day}"}, update, upsert=True))
+
+        self._collection().delete_many({"date": {"$gte": _day(datetime.strptime(since, "%Y%m%d"))}})
+        if operations:
+            self._collection().bulk_write(operations, ordered=True)
+        print(f"AdherenceStore: ricostruiti i riepiloghi di {len(dispenser_ids)} dispenser ({len(operations)} eventi)")
+        return len(operations)
+
+    def is_empty(self) -> bool:
+        return self._collection().find_one({}, {"_id": 1}) is None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_adherence_store(db_service) -> AdherenceStore:
+    """Store condiviso dal processo, creato al primo utilizzo"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = AdherenceStore(db_service)
+    return _store
@@ -0,0 +1,273 @@
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+try:
+    from pymongo.errors import DuplicateKeyError
+except ImportError:  # senza pymongo lo stato resta solo in memoria
+    DuplicateKeyError = None
+
+# Azioni restituite dal motore: il chiamante invia la notifica corrispondente
+FIRE = "fire"          # allarme appena attivato
+REPEAT = "repeat"      # allarme ancora attivo, finestra di silenzio scaduta
+ESCALATE = "escalate"  # allarme attivo da più di escalate_after secondi
+RESOLVE = "resolve"    # condizione rientrata
+
+# Politiche per tipo di allarme (il tipo è la parte della chiave prima di ":")
+#   cooldown: secondi minimi tra due notifiche dello stesso allarme
+#   hysteresis: margine di rientro per i valori numerici (evita allarmi intermittenti)
+#   escalate_after: secondi di allarme continuo prima dell'escalation (None = mai)
+#   notify_resolved: notifica anche il rientro della condizione
+DEFAULT_POLICIES = {
+    "temperature": {"cooldown": 1800, "hysteresis": 0.5, "escalate_after": 3600, "notify_resolved": True},
+    "humidity": {"cooldown": 1800, "hysteresis": 2.0, "escalate_after": 3600, "notify_resolved": True},
+    "door_open": {"cooldown": 600, "escalate_after": 1800, "notify_resolved": True},
+    "door_irregular": {"cooldown": 300},
+    "missed_dose": {"cooldown": 0},
+}
+_BASE_POLICY = {"cooldown": 900, "hysteresis": 0.0, "escalate_after": None, "notify_resolved": False}
+
+# Tentativi di una transizione quando un'altra istanza ha aggiornato lo stesso allarme
+_MAX_ATTEMPTS = 5
+
+
+class AlertStateEngine:
+    """
+    Stato degli allarmi per coppia (dispositivo, tipo di allarme).
+
+    Il motore decide se una nuova rilevazione deve generare una notifica:
+    la prima rilevazione fuori soglia attiva l'allarme, le successive vengono
+    soppresse fino alla scadenza del cooldown, un allarme che dura troppo viene
+    notificato una volta come escalation e il rientro (oltre il margine di
+    isteresi) chiude l'allarme. Lo stato è salvato nella collezione
+    ``alert_states`` e scritto solo quando cambia, così un riavvio non
+    ripete le notifiche già inviate.
+
+    Con più istanze (SCHEDULER_SHARDS, MQTT_SHARED_GROUP) ogni valutazione
+    rilegge lo stato dal database e lo salva solo se il campo ``version`` non è
+    cambiato nel frattempo; altrimenti la transizione viene ripetuta sullo
+    stato aggiornato, così una notifica non parte due volte.
+    """
+
+    def __init__(self, db_service=None, policies: Optional[Dict[str, Dict]] = None,
+                 collection_name: str = "alert_states"):
+        self.db_service = db_service
+        self.collection_name = collection_name
+        self.policies = {kind: dict(_BASE_POLICY, **policy) for kind, policy in DEFAULT_POLICIES.items()}
+        for kind, policy in (policies or {}).items():
+            self.policies[kind] = dict(self.policies.get(kind, _BASE_POLICY), **policy)
+        self._states: Dict[str, Dict] = {}
+        self._lock = threading.RLock()
+        self.metrics = {"fired": 0, "repeated": 0, "escalated": 0, "resolved": 0, "suppressed": 0}
+
+    def policy(self, kind: str) -> Dict:
+        return self.policies.get(kind.split(":", 1)[0], _BASE_POLICY)
+
+    def evaluate(self, device_id: str, kind: str, active: bool, value=None,
+                 now: Optional[datetime] = None) -> Optional[str]:
+        """
+        Registra lo stato corrente di una condizione continua (es. porta aperta).
+
+        Returns:
+            FIRE, REPEAT, ESCALATE, RESOLVE oppure None se non va notificato nulla
+        """
+        return self._evaluate(device_id, kind, lambda state: active, value, now)
+
+    def evaluate_range(self, device_id: str, kind: str, value: float, min_value: float, max_value: float,
+                       now: Optional[datetime] = None) -> Optional[str]:
+        """
+        Come ``evaluate`` per una misura con limiti: un allarme attivo rientra solo
+        quando il valore torna dentro l'intervallo di almeno il margine di isteresi.
+        """
+        margin = min(self.policy(kind)["hysteresis"], (max_value - min_value) / 4)
+
+        def is_active(state):
+            if state["active"]:
+                return value < min_value + margin or value > max_value - margin
+            return value < min_value or value > max_value
+
+        return self._evaluate(device_id, kind, is_active, value, now)
+
+    def _evaluate(self, device_id: str, kind: str, is_active: Callable[[Dict], bool], value,
+                  now: Optional[datetime]) -> Optional[str]:
+        now = now or datetime.now()
+        policy = self.policy(kind)
+        seen = {}
+
+        def transition(state):
+            active = seen["active"] = is_active(state)
+            if active:
+                if not state["active"]:
+                    state.update(active=True, since=now, last_notified=now, notify_count=1,
+                                 escalated=False, suppressed=0, last_value=value)
+                    return FIRE
+                if (policy["escalate_after"] is not None and not state["escalated"]
+                        and now - state["since"] >= timedelta(seconds=policy["escalate_after"])):
+                    state.update(escalated=True, last_notified=now, notify_count=state["notify_count"] + 1,
+                                 last_value=value)
+                    return ESCALATE
+                if now - state["last_notified"] >= timedelta(seconds=policy["cooldown"]):
+                    state.update(last_notified=now, notify_count=state["notify_count"] + 1, last_value=value)
+                    return REPEAT
+                state["suppressed"] = state.get("suppressed", 0) + 1
+                state["last_value"] = value
+                return None
+            if state["active"]:
+                state.update(active=False, resolved_at=now, last_value=value)
+                return RESOLVE
+            return None
+
+        action = self._apply(device_id, kind, transition)
+        with self._lock:
+            if action == RESOLVE:
+                self.metrics["resolved"] += 1
+                return RESOLVE if policy["notify_resolved"] else None
+            if action is not None:
+                self.metrics[{FIRE: "fired", REPEAT: "repeated", ESCALATE: "escalated"}[action]] += 1
+            elif seen.get("active"):
+                self.metrics["suppressed"] += 1
+        return action
+
+    def evaluate_event(self, device_id: str, kind: str, token: Optional[str] = None,
+                       now: Optional[datetime] = None) -> Optional[str]:
+        """
+        Allarme puntuale (es. apertura irregolare, dose mancata): FIRE se va notificato.
+
+        Con ``token`` l'allarme scatta una sola volta per token (es. giorno e
+        intervallo di assunzione); senza, al massimo una volta per cooldown.
+        """
+        now = now or datetime.now()
+        policy = self.policy(kind)
+
+        def transition(state):
+            if token is not None and state.get("last_token") == token:
+                duplicate = True
+            else:
+                last = state.get("last_notified")
+                duplicate = last is not None and now - last < timedelta(seconds=policy["cooldown"])
+            if duplicate:
+                state["suppressed"] = state.get("suppressed", 0) + 1
+                return None
+            state.update(last_notified=now, last_token=token, notify_count=state.get("notify_count", 0) + 1)
+            return FIRE
+
+        action = self._apply(device_id, kind, transition)
+        with self._lock:
+            self.metrics["fired" if action == FIRE else "suppressed"] += 1
+        return action
+
+    def _apply(self, device_id: str, kind: str, transition: Callable[[Dict], Optional[str]]) -> Optional[str]:
+        """
+        Esegue ``transition`` sullo stato più recente; se restituisce un'azione lo
+        stato viene salvato, ripetendo la transizione in caso di conflitto di versione.
+        """
+        with self._lock:
+            for _ in range(_MAX_ATTEMPTS):
+                state = self._load(device_id, kind)
+                version = state.get("version", 0)
+                action = transition(state)
+                if action is None or self._save(state, version):
+                    return action
+            print(f"AlertStateEngine: stato {device_id}:{kind} conteso, transizione abbandonata")
+            return None
+
+    def get_state(self, device_id: str, kind: str) -> Dict:
+        """Stato corrente di un allarme (riletto dal database)"""
+        with self._lock:
+            return dict(self._load(device_id, kind))
+
+    def active_alerts(self, device_id: Optional[str] = None) -> List[Dict]:
+        """Allarmi attivi (dal database se disponibile, altrimenti dalla memoria)"""
+        collection = self._collection()
+        if collection is not None:
+            query = {"active": True}
+            if device_id:
+                query["device_id"] = device_id
+            return list(collection.find(query))
+        with self._lock:
+            return [dict(s) for s in self._states.values()
+                    if s["active"] and (device_id is None or s["device_id"] == device_id)]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.metrics)
+            stats["tracked"] = len(self._states)
+            stats["active"] = sum(1 for s in self._states.values() if s["active"])
+        return stats
+
+    def _collection(self):
+        if self.db_service is None or not self.db_service.is_connected():
+            return None
+        return self.db_service.db[self.collection_name]
+
+    def _load(self, device_id: str, kind: str) -> Dict:
+        """
+        Stato corrente: riletto dal database a ogni richiesta (le altre istanze
+        possono averlo aggiornato), dalla memoria se il database non è disponibile.
+        Chiamato col lock.
+        """
+        key = f"{device_id}:{kind}"
+        collection = self._collection()
+        if collection is not None:
+            try:
+                stored = collection.find_one({"_id": key})
+                if stored is not None:
+                    self._states[key] = stored
+                    return stored
+                self._states.pop(key, None)
+            except Exception as e:
+                print(f"AlertStateEngine: errore nella lettura dello stato {key}: {e}")
+        state = self._states.get(key)
+        if state is None:
+            state = {
+                "_id": key, "device_id": device_id, "kind": kind,
+                "active": False, "since": None, "last_notified": None,
+                "notify_count": 0, "escalated": False, "suppressed": 0,
+            }
+            self._states[key] = state
+        return state
+
+    def _save(self, state: Dict, version: int) -> bool:
+        """
+        Salva lo stato se nel database ha ancora ``version`` (chiamato col lock).
+
+        Returns:
+            bool: False se un'altra istanza lo ha aggiornato nel frattempo
+        """
+        collection = self._collection()
+        state["version"] = version + 1
+        state["updated_at"] = datetime.now()
+        if collection is None:
+            return True
+        # Gli stati salvati prima del campo version valgono come versione 0
+        expected = version if version else {"$in": [0, None]}
+        try:
+            # Se la versione non corrisponde l'upsert tenta un inserimento con lo stesso _id
+            collection.replace_one({"_id": state["_id"], "version": expected}, state, upsert=True)
+        except Exception as e:
+            if DuplicateKeyError is not None and isinstance(e, DuplicateKeyError):
+                return False
+            # Al peggio la prossima valutazione ripete una notifica
+            print(f"AlertStateEngine: errore nel salvataggio dello stato {state['_id']}: {e}")
+        return True
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_alert_engine(db_service=None) -> AlertStateEngine:
+    """Motore condiviso dal processo, creato al primo utilizzo"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                from config.settings import ALERT_COOLDOWN_SECONDS, ALERT_ESCALATE_SECONDS
+                overrides = {
+                    kind: {"cooldown": ALERT_COOLDOWN_SECONDS, "escalate_after": ALERT_ESCALATE_SECONDS}
+                    for kind in ("temperature", "humidity")
+                }
+                _engine = AlertStateEngine(db_service, policies=overrides)
+    if db_service is not None and _engine.db_service is None:
+        _engine.db_service = db_service
+    return _engine
@@ -5,20 +5,24 @@ from .base import BaseService
 from typing import List, Dict, Any
 from datetime import datetime
 from .base import BaseService
-import statistics
+from .rollups import RunningStats, get_rollup_store
 
 
 class AggregationService(BaseService):
     """Service for aggregating measurements across different Digital Replicas"""
 
-    def execute(self, data: Dict, dr_type: str = None, attribute: str = None) -> Dict:
+    def execute(self, data: Dict, dr_type: str = None, attribute: str = None, window: str = "all") -> Dict:
         """
         Execute aggregation on measurements from specified DR type
 
+        Statistics come from the incremental rollups kept by the RollupStore,
+        so the cost does not depend on how many measurements were ingested.
+
         Args:
             data: Dictionary containing the DT data including all DRs
             dr_type: Type of DR to aggregate (e.g., 'bottle', 'device')
             attribute: Specific measurement type to aggregate (e.g., 'temperature')
+            window: Time window (see rollups.WINDOWS: 'hour', '24h', 'day', '7d', '30d', 'all')
         """
         if not data or 'digital_replicas' not in data:
             raise ValueError("Invalid data: missing digital replicas")
@@ -29,43 +33,25 @@ class AggregationService(BaseService):
         if not drs:
             return {"error": f"No digital replicas found of type {dr_type}"}
 
-        # Collect all measurements
-        all_measurements = []
+        rollups = get_rollup_store()
+        grouped: Dict[str, RunningStats] = {}
         for dr in drs:
-            if 'data' in dr and 'measurements' in dr['data']:
-                measurements = dr['data']['measurements']
-                if attribute:
-                    # Filter measurements by attribute
-                    measurements = [m for m in measurements
-                                    if m['measure_type'] == attribute]
-                all_measurements.extend(measurements)
-
-        if not all_measurements:
+            # Measurements still embedded in the DR (no timestamps: counted in every window)
+            for measure in dr.get('data', {}).get('measurements', []):
+                measure_type = measure['measure_type']
+                if attribute and measure_type != attribute:
+                    continue
+                grouped.setdefault(measure_type, RunningStats()).add(float(measure['value']))
+
+            for measure_type in rollups.measure_types(dr['_id']):
+                if attribute and measure_type != attribute:
+                    continue
+                grouped.setdefault(measure_type, RunningStats()).merge(
+                    rollups.get_stats(dr['_id'], measure_type, window)
+                )
+
+        stats = {measure_type: values.to_dict() for measure_type, values in grouped.items() if values.count}
+        if not stats:
             return {"error": f"No measurements found for attribute {attribute}"}
 
-        # Group measurements by type
-        grouped_measurements = {}
-        for measure in all_measurements:
-            measure_type = measure['measure_type']
-            if measure_type not in grouped_measurements:
-                grouped_measurements[measure_type] = []
-            grouped_measurements[measure_type].append(float(measure['value']))
-
-        # Calculate statistics for each measurement type
-        stats = {}
-        for measure_type, values in grouped_measurements.items():
-            try:
-                stats[measure_type] = {
-                    'count': len(values),
-                    'mean': statistics.mean(values),
-                    'min': min(values),
-                    'max': max(values),
-                    'stddev': statistics.stdev(values) if len(values) > 1 else 0
-                }
-            except (statistics.StatisticsError, ValueError) as e:
-                stats[measure_type] = {
-                    'error': str(e),
-                    'count': len(values)
-                }
-
-        return stats
\ No newline at end of file
+        return stats
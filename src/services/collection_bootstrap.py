@@ -0,0 +1,73 @@
+from typing import Dict, Optional
+
+
+class CollectionBootstrapper:
+    """
+    Installa lato server i validatori $jsonSchema generati dallo SchemaRegistry.
+
+    Le collezioni dei DR mancanti vengono create con validatore e, se richiesti,
+    collation e ``_id`` clustered (possibili solo alla creazione); su quelle già
+    esistenti il validatore viene aggiornato con collMod. Con validationLevel
+    "moderate" i documenti già presenti che non rispettano lo schema restano
+    modificabili, mentre inserimenti e aggiornamenti dei documenti validi vengono
+    controllati dal server: i percorsi di scrittura frequenti (porta, telemetria)
+    non devono ripetere la validazione lato client.
+    """
+
+    def __init__(self, db_service, validation_level: str = "moderate", validation_action: str = "error",
+                 collation_locale: Optional[str] = None, clustered_id: bool = False):
+        self.db_service = db_service
+        self.schema_registry = db_service.schema_registry
+        self.validation_level = validation_level
+        self.validation_action = validation_action
+        self.collation_locale = collation_locale
+        self.clustered_id = clustered_id
+
+    def _create_options(self) -> Dict:
+        options = {}
+        if self.collation_locale:
+            options["collation"] = {"locale": self.collation_locale}
+        if self.clustered_id:
+            # Documenti ordinati per _id nello storage: niente indice _id separato
+            options["clusteredIndex"] = {"key": {"_id": 1}, "unique": True}
+        return options
+
+    def apply(self) -> Dict[str, str]:
+        """
+        Crea o aggiorna le collezioni di tutti i tipi registrati.
+
+        Returns:
+            Dict[str, str]: per collezione "created", "updated" o "failed"
+        """
+        if not self.db_service.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+        db = self.db_service.db
+        existing = set(db.list_collection_names())
+        results = {}
+        for dr_type in self.schema_registry.schemas:
+            name = self.schema_registry.get_collection_name(dr_type)
+            validator = self.schema_registry.get_validation_schema(dr_type)
+            try:
+                if name in existing:
+                    db.command(
+                        "collMod", name,
+                        validator=validator,
+                        validationLevel=self.validation_level,
+                        validationAction=self.validation_action,
+                    )
+                    results[name] = "updated"
+                else:
+                    db.create_collection(
+                        name,
+                        validator=validator,
+                        validationLevel=self.validation_level,
+                        validationAction=self.validation_action,
+                        **self._create_options(),
+                    )
+                    results[name] = "created"
+            except Exception as e:
+                # Es. utente senza privilegi dbAdmin o server senza collezioni clustered (< 5.3)
+                print(f"CollectionBootstrapper: impossibile installare il validatore su {name}: {e}")
+                results[name] = "failed"
+        print(f"CollectionBootstrapper: validatori ({self.validation_level}/{self.validation_action}) {results}")
+        return results
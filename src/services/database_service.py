@@ -1,10 +1,30 @@
-from typing import Dict, List, Optional, Any
-from pymongo import MongoClient
+from typing import Callable, Dict, List, Optional, Any, Set, Union
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from datetime import datetime
 from src.virtualization.digital_replica.schema_registry import SchemaRegistry
 # import timezone
 from datetime import timezone
 
+# Time-series stored outside the dispenser document, in daily buckets:
+# series name -> field of the old embedded array (used by the migration)
+TELEMETRY_SERIES = {
+    "environmental": "environmental_data",
+    "door_events": "door_events",
+    "emergency_requests": "emergency_requests",
+    "missed_doses": "missed_dose_notifications",
+}
+
+
+class TelemetryWriteError(Exception):
+    """A telemetry bulk write that only partially succeeded"""
+
+    def __init__(self, message: str, failed: Dict[str, List[Dict]]):
+        super().__init__(message)
+        # device_id -> samples that were NOT written (the other buckets were)
+        self.failed = failed
+
+
 class DatabaseService:
     def __init__(
         self, connection_string: str, db_name: str, schema_registry: SchemaRegistry
@@ -14,6 +34,26 @@ class DatabaseService:
         self.schema_registry = schema_registry
         self.client = None
         self.db = None
+        self._change_listeners: List[Callable[[str, str, Optional[Set[str]]], None]] = []
+        self._telemetry_listeners: List[Callable[[str, Dict[str, List[Dict]]], None]] = []
+        self._telemetry_indexed: Set[str] = set()
+
+    def add_change_listener(self, listener: Callable[[str, str, Optional[Set[str]]], None]) -> None:
+        """
+        Register a callback invoked after a Digital Replica is written.
+
+        The callback receives (dr_type, dr_id, changed_fields); changed_fields is
+        the set of dotted paths touched by an atomic update, or None when the
+        whole document was inserted, replaced or deleted.
+        """
+        self._change_listeners.append(listener)
+
+    def _notify_change(self, dr_type: str, dr_id: str, changed_fields: Optional[Set[str]] = None) -> None:
+        for listener in list(self._change_listeners):
+            try:
+                listener(dr_type, dr_id, changed_fields)
+            except Exception as e:
+                print(f"ERROR in DR change listener: {e}")
 
     def connect(self) -> None:
         try:
@@ -37,21 +77,34 @@ class DatabaseService:
             raise ConnectionError("Not connected to MongoDB")
 
         try:
-            # Get collection name and validation schema from registry
+            # Unknown types are rejected here; the document itself is validated
+            # by the $jsonSchema installed on the collection (CollectionBootstrapper)
             collection_name = self.schema_registry.get_collection_name(dr_type)
-            validation_schema = self.schema_registry.get_validation_schema(dr_type)
-
-            # The SchemaRegistry handles ALL validation - no type-specific logic here!
+            self.schema_registry.get_validation_schema(dr_type)
             collection = self.db[collection_name]
 
             result = collection.insert_one(dr_data)
+            self._notify_change(dr_type, str(dr_data["_id"]))
             return str(dr_data["_id"])
         except Exception as e:
             raise Exception(f"Failed to save Digital Replica: {str(e)}")
 
-    def get_dr(self, dr_type: str, dr_id: str) -> Dict:
+    @staticmethod
+    def _projection(fields: Union[List[str], Dict, None]) -> Optional[Dict]:
+        """Accept a list of dotted field paths or a ready-made MongoDB projection"""
+        if fields is None or isinstance(fields, dict):
+            return fields
+        return {field: 1 for field in fields}
+
+    def get_dr(self, dr_type: str, dr_id: str, projection: Union[List[str], Dict, None] = None) -> Dict:
         """
         Retrieves a Digital Replica by type and ID
+
+        Args:
+            dr_type: Type of Digital Replica
+            dr_id: Digital Replica ID
+            projection: Optional list of dotted fields (or MongoDB projection) to
+                return instead of the whole document; ``_id`` is always included
         """
         if not self.is_connected():
             raise ConnectionError("Not connected to MongoDB")
@@ -60,7 +113,7 @@ class DatabaseService:
             print(f"DEBUG: Retrieving DR type={dr_type}, id={dr_id}")  # Aggiungi questa linea per il debug
             collection_name = self.schema_registry.get_collection_name(dr_type)
             collection = self.db[collection_name]
-            result = collection.find_one({"_id": dr_id})
+            result = collection.find_one({"_id": dr_id}, self._projection(projection))
             if result:
                 return result
             return None
@@ -68,13 +121,43 @@ class DatabaseService:
             print(f"ERROR in get_dr: {e}")  # Aggiungi questa linea per il debug
             raise
 
-    def query_drs(self, dr_type: str, query: Dict = None) -> List[Dict]:
+    def get_drs_bulk(self, dr_type: str, dr_ids: List[str],
+                     projection: Union[List[str], Dict, None] = None) -> List[Dict]:
+        """
+        Retrieve several Digital Replicas of the same type with a single query
+
+        Args:
+            dr_type: Type of Digital Replica
+            dr_ids: Digital Replica IDs
+            projection: Optional fields to return (see get_dr)
+
+        Returns:
+            List[Dict]: Documents in the order of ``dr_ids``; missing IDs are skipped
+        """
         if not self.is_connected():
             raise ConnectionError("Not connected to MongoDB")
+        if not dr_ids:
+            return []
 
         try:
             collection_name = self.schema_registry.get_collection_name(dr_type)
-            return list(self.db[collection_name].find(query or {}))
+            unique_ids = list(dict.fromkeys(dr_ids))
+            found = {
+                doc["_id"]: doc
+                for doc in self.db[collection_name].find({"_id": {"$in": unique_ids}}, self._projection(projection))
+            }
+            return [found[dr_id] for dr_id in unique_ids if dr_id in found]
+        except Exception as e:
+            raise Exception(f"Failed to bulk load Digital Replicas: {str(e)}")
+
+    def query_drs(self, dr_type: str, query: Dict = None,
+                  projection: Union[List[str], Dict, None] = None) -> List[Dict]:
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        try:
+            collection_name = self.schema_registry.get_collection_name(dr_type)
+            return list(self.db[collection_name].find(query or {}, self._projection(projection)))
         except Exception as e:
             raise Exception(f"Failed to query Digital Replicas: {str(e)}")
 
@@ -116,9 +199,22 @@ class DatabaseService:
             if result.matched_count == 0:
                 raise ValueError(f"Digital Replica not found: {dr_id}")
 
+            changed_fields = self._changed_fields(update_doc) if is_atomic_update else None
+            self._notify_change(dr_type, dr_id, changed_fields)
+
         except Exception as e:
             raise RuntimeError(f"Failed to update Digital Replica: {e}, full error: {getattr(e, 'details', '')}") from e
 
+    @staticmethod
+    def _changed_fields(update_doc: Dict) -> Set[str]:
+        """Dotted paths touched by an atomic update document"""
+        return {
+            path
+            for operator, spec in update_doc.items()
+            if operator.startswith('$') and isinstance(spec, dict)
+            for path in spec
+        }
+
 
 
 
@@ -135,5 +231,247 @@ class DatabaseService:
 
             if result.deleted_count == 0:
                 raise ValueError(f"Digital Replica not found: {dr_id}")
+            self._notify_change(dr_type, dr_id)
         except Exception as e:
             raise Exception(f"Failed to delete Digital Replica: {str(e)}")
+
+    # --- Telemetry (time-bucketed series) ---
+
+    def add_telemetry_listener(self, listener: Callable[[str, Dict[str, List[Dict]]], None]) -> None:
+        """
+        Register a callback invoked after samples are appended to a series.
+
+        The callback receives (series, samples_by_device) once per write batch.
+        """
+        self._telemetry_listeners.append(listener)
+
+    def _notify_telemetry(self, series: str, samples_by_device: Dict[str, List[Dict]]) -> None:
+        for listener in list(self._telemetry_listeners):
+            try:
+                listener(series, samples_by_device)
+            except Exception as e:
+                print(f"ERROR in telemetry listener: {e}")
+
+    def _telemetry_collection(self, series: str):
+        """Bucket collection of a series; indexes are ensured on first use"""
+        if series not in TELEMETRY_SERIES:
+            raise ValueError(f"Unknown telemetry series: {series}")
+        collection = self.db[f"telemetry_{series}"]
+        if series not in self._telemetry_indexed:
+            collection.create_index([("device_id", 1), ("day", 1)])
+            self._telemetry_indexed.add(series)
+        return collection
+
+    @staticmethod
+    def _telemetry_day(timestamp: Union[str, datetime, None]) -> str:
+        """Bucket key (YYYYMMDD) of a sample timestamp"""
+        if isinstance(timestamp, datetime):
+            return timestamp.strftime("%Y%m%d")
+        if isinstance(timestamp, str) and len(timestamp) >= 10:
+            return timestamp[:10].replace("-", "")
+        return datetime.now().strftime("%Y%m%d")
+
+    @staticmethod
+    def _telemetry_bound(value: Union[str, datetime, None]) -> Optional[str]:
+        if value is None or isinstance(value, str):
+            return value
+        return value.isoformat()
+
+    def _telemetry_buckets(self, samples_by_device: Dict[str, List[Dict]]) -> Dict[tuple, List[Dict]]:
+        """Samples grouped by (device_id, day) bucket"""
+        buckets: Dict[tuple, List[Dict]] = {}
+        for device_id, samples in samples_by_device.items():
+            for sample in samples:
+                day = self._telemetry_day(sample.get("timestamp"))
+                buckets.setdefault((device_id, day), []).append(sample)
+        return buckets
+
+    @staticmethod
+    def _telemetry_operations(buckets: Dict[tuple, List[Dict]]) -> List[UpdateOne]:
+        """One upsert per bucket, in the iteration order of ``buckets``"""
+        return [
+            UpdateOne(
+                {"_id": f"{device_id}:{day}"},
+                {
+                    "$push": {"samples": {"$each": samples}},
+                    "$inc": {"count": len(samples)},
+                    "$setOnInsert": {"device_id": device_id, "day": day},
+                },
+                upsert=True,
+            )
+            for (device_id, day), samples in buckets.items()
+        ]
+
+    def append_telemetry(self, series: str, device_id: str, samples: Union[Dict, List[Dict]]) -> None:
+        """
+        Append samples of a device to a time series (one daily bucket document per device).
+
+        Args:
+            series: Series name (see TELEMETRY_SERIES)
+            device_id: Device / Digital Replica ID
+            samples: One sample or a list of samples, each with a ``timestamp``
+        """
+        if isinstance(samples, dict):
+            samples = [samples]
+        self.append_telemetry_bulk(series, {device_id: samples})
+
+    def append_telemetry_bulk(self, series: str, samples_by_device: Dict[str, List[Dict]]) -> int:
+        """
+        Append samples of several devices with a single bulk_write.
+
+        Returns:
+            int: Number of samples written
+
+        Raises:
+            TelemetryWriteError: when only some buckets were written; ``failed``
+                holds the samples of the failed ones, so callers can retry just those
+        """
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        buckets = self._telemetry_buckets(samples_by_device)
+        if not buckets:
+            return 0
+        keys = list(buckets)
+        try:
+            self._telemetry_collection(series).bulk_write(self._telemetry_operations(buckets), ordered=False)
+        except BulkWriteError as e:
+            failed_keys = {keys[error["index"]] for error in e.details.get("writeErrors", [])}
+            failed: Dict[str, List[Dict]] = {}
+            written: Dict[str, List[Dict]] = {}
+            for key in keys:
+                target = failed if key in failed_keys else written
+                target.setdefault(key[0], []).extend(buckets[key])
+            if written:
+                self._notify_telemetry(series, written)
+            raise TelemetryWriteError(
+                f"Failed to append telemetry to {len(failed_keys)} of {len(keys)} buckets", failed
+            ) from e
+        except Exception as e:
+            raise Exception(f"Failed to append telemetry: {str(e)}")
+
+        self._notify_telemetry(series, samples_by_device)
+        return sum(len(samples) for samples in samples_by_device.values())
+
+    def query_telemetry(
+        self,
+        series: str,
+        device_id: str,
+        start: Union[str, datetime, None] = None,
+        end: Union[str, datetime, None] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict]:
+        """
+        Read the samples of a device in chronological order.
+
+        Args:
+            series: Series name (see TELEMETRY_SERIES)
+            device_id: Device / Digital Replica ID
+            start: Inclusive lower bound on the sample timestamp
+            end: Exclusive upper bound on the sample timestamp
+            limit: If given, only the most recent ``limit`` samples are returned
+
+        Returns:
+            List[Dict]: Samples sorted by timestamp
+        """
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        try:
+            start = self._telemetry_bound(start)
+            end = self._telemetry_bound(end)
+
+            query: Dict[str, Any] = {"device_id": device_id}
+            day_range = {}
+            if start:
+                day_range["$gte"] = self._telemetry_day(start)
+            if end:
+                day_range["$lte"] = self._telemetry_day(end)
+            if day_range:
+                query["day"] = day_range
+
+            cursor = self._telemetry_collection(series).find(query, {"samples": 1, "count": 1}).sort("day", -1)
+
+            # Buckets are read newest first, so a limit stops the scan early
+            buckets = []
+            collected = 0
+            for bucket in cursor:
+                buckets.append(bucket.get("samples", []))
+                collected += bucket.get("count", 0)
+                if limit and not (start or end) and collected >= limit:
+                    break
+
+            samples = [sample for bucket_samples in reversed(buckets) for sample in bucket_samples]
+            if start or end:
+                samples = [
+                    sample for sample in samples
+                    if (not start or str(sample.get("timestamp", "")) >= start)
+                    and (not end or str(sample.get("timestamp", "")) < end)
+                ]
+            samples.sort(key=lambda sample: str(sample.get("timestamp", "")))
+            if limit:
+                samples = samples[-limit:]
+            return samples
+        except Exception as e:
+            raise Exception(f"Failed to query telemetry: {str(e)}")
+
+    def migrate_embedded_telemetry(self, dr_type: str = "dispenser_medicine") -> int:
+        """
+        Move the history arrays still embedded in Digital Replica documents into
+        the telemetry buckets and drop them from the documents.
+
+        Each document is claimed with a single find_one_and_update that unsets the
+        arrays and returns the pre-image, so instances starting together never
+        migrate the same document twice and a restart never appends it again.
+        If an append fails, the arrays not appended yet are written back for the next attempt.
+
+        Returns:
+            int: Number of migrated documents
+        """
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        try:
+            collection = self.db[self.schema_registry.get_collection_name(dr_type)]
+            fields = {f"data.{field}": 1 for field in TELEMETRY_SERIES.values()}
+            query = {"$or": [{path: {"$exists": True}} for path in fields]}
+
+            migrated = 0
+            for candidate in collection.find(query, {"_id": 1}):
+                document = collection.find_one_and_update(
+                    {"_id": candidate["_id"], **query}, {"$unset": fields}, projection=fields
+                )
+                if document is None:
+                    # Already claimed by another instance
+                    continue
+                data = document.get("data", {})
+                pending = [field for field in TELEMETRY_SERIES.values() if field in data]
+                try:
+                    for series, field in TELEMETRY_SERIES.items():
+                        samples = data.get(field) or []
+                        if series == "missed_doses":
+                            # Old format: plain "YYYY-MM-DD_start_end" keys
+                            samples = [
+                                sample if isinstance(sample, dict)
+                                else {"key": sample, "timestamp": str(sample)[:10]}
+                                for sample in samples
+                            ]
+                        if samples:
+                            self.append_telemetry(series, document["_id"], samples)
+                        if field in pending:
+                            pending.remove(field)
+                except Exception:
+                    # Only the arrays not appended yet go back, so a retry does not duplicate the others
+                    if pending:
+                        collection.update_one(
+                            {"_id": document["_id"]}, {"$set": {f"data.{field}": data[field] for field in pending}}
+                        )
+                    raise
+                self._notify_change(dr_type, document["_id"], set(fields))
+                migrated += 1
+
+            if migrated:
+                print(f"Migrated embedded telemetry of {migrated} {dr_type} documents")
+            return migrated
+        except Exception as e:
+            raise Exception(f"Failed to migrate embedded telemetry: {str(e)}")
@@ -1,6 +1,11 @@
 # Modifichiamo la classe esistente per implementare la nuova interfaccia
+import asyncio
 from datetime import datetime
 from src.services.base import BaseService
+from src.services import dr_views
+from src.services.alert_state import RESOLVE, get_alert_engine
+from src.services.adherence import DEFAULT_SCHEDULE, get_adherence_store
+from src.services.medication_schedule import get_compiled_schedule
 import json
 
 class DoorEventService(BaseService):
@@ -13,8 +18,6 @@ class DoorEventService(BaseService):
         self.name = "DoorEventService"
         self.last_state = {}
         self.irregularity_events = {}
-        self.last_notifications = {}
-        self.notification_threshold = 30  # secondi
         self.db_service = db_service
     
     # Metodo di compatibilità con lo scheduler esistente
@@ -75,7 +78,7 @@ class DoorEventService(BaseService):
         
         # Ottieni il dispenser per verificare la regolarità
         if self.db_service:
-            dispenser = self.db_service.get_dr("dispenser_medicine", dispenser_id)
+            dispenser = dr_views.get_schedule(self.db_service, dispenser_id)
             if dispenser:
                 # Verifica se l'evento è regolare
                 is_regular = self.is_event_regular(dispenser, timestamp, state)
@@ -93,7 +96,8 @@ class DoorEventService(BaseService):
                 }
                 
                 # Memorizza l'evento nel database
-                self.door_state_changed(dispenser_id, state, timestamp, is_regular)
+                self.door_state_changed(dispenser_id, state, timestamp, is_regular,
+                                        schedule=get_compiled_schedule(dispenser) or DEFAULT_SCHEDULE)
                 
                 return event_details
         
@@ -109,29 +113,13 @@ class DoorEventService(BaseService):
         """
         Determina se un evento porta è regolare in base all'orario configurato
         """
-        # Ottieni l'orario di assunzione configurato
-        medicine_time = dispenser_data.get("data", {}).get("medicine_time", {})
-        if not medicine_time:
-            return False
-            
-        start_time = medicine_time.get("start")
-        end_time = medicine_time.get("end")
-        
-        if not start_time or not end_time:
+        # Orari di assunzione compilati (None se non configurati o non validi)
+        schedule = get_compiled_schedule(dispenser_data)
+        if not schedule:
             return False
         
-        try:
-            # Converti orari in oggetti datetime per confronto
-            today_str = timestamp.strftime("%Y-%m-%d")
-            start_dt = datetime.strptime(f"{today_str} {start_time}", "%Y-%m-%d %H:%M")
-            end_dt = datetime.strptime(f"{today_str} {end_time}", "%Y-%m-%d %H:%M")
-            
-            # L'evento è regolare se avviene nell'intervallo configurato
-            return start_dt <= timestamp <= end_dt
-            
-        except ValueError as e:
-            print(f"Errore nel parsing degli orari di medicina: {e}")
-            return False
+        # L'evento è regolare se avviene in una delle finestre configurate
+        return schedule.is_within(timestamp)
     
     # Mantieni i metodi esistenti per retrocompatibilità
     def handle_door_status_update(self, db_service, dt_factory, dispenser_id, payload):
@@ -167,17 +155,28 @@ class DoorEventService(BaseService):
                 self.dt_factory = dt_factory
             
             # Ottieni il dispenser
-            dispenser = self.db_service.get_dr("dispenser_medicine", dispenser_id)
+            dispenser = dr_views.get_owner(self.db_service, dispenser_id)
             if not dispenser:
                 print(f"Dispenser {dispenser_id} non trovato nel database")
                 return
             
             # Usa il metodo dell'interfaccia
             event_details = self.handle_door_event(dispenser_id, state, timestamp)
-            is_regular = event_details.get("is_regular", False)
-            
-            # Invia notifica all'utente se l'evento è irregolare
-            if not is_regular and hasattr(self, 'dt_factory'):
+            is_regular = event_details.get("regularity") == "regular"
+            alert_engine = get_alert_engine(self.db_service)
+
+            # La chiusura della porta chiude l'eventuale allarme "porta aperta"
+            if state == "closed" and hasattr(self, 'dt_factory'):
+                door_alert = alert_engine.get_state(dispenser_id, "door_open")
+                if alert_engine.evaluate(dispenser_id, "door_open", False) == RESOLVE:
+                    from src.application.bot.notifications import send_alert_resolved
+                    send_alert_resolved(self.db_service, self.dt_factory, dispenser_id, "door_open",
+                                        since=door_alert.get("since"))
+
+            # Invia notifica all'utente se l'evento è irregolare (aperture ravvicinate
+            # vengono raggruppate in un'unica notifica per finestra di cooldown)
+            if (not is_regular and hasattr(self, 'dt_factory')
+                    and alert_engine.evaluate_event(dispenser_id, "door_irregular")):
                 from src.application.bot.notifications import send_door_irregularity_alert
                 send_door_irregularity_alert(
                     self.db_service,
@@ -193,7 +192,13 @@ class DoorEventService(BaseService):
             import traceback
             traceback.print_exc()
     
-    def door_state_changed(self, dispenser_id, state, timestamp, is_regular):
+    async def handle_door_status_update_async(self, db_service, dt_factory, dispenser_id, payload):
+        """Versione asincrona di handle_door_status_update (l'accesso al DB resta su un thread)"""
+        return await asyncio.to_thread(
+            self.handle_door_status_update, db_service, dt_factory, dispenser_id, payload
+        )
+
+    def door_state_changed(self, dispenser_id, state, timestamp, is_regular, schedule=None):
         """
         Aggiorna lo stato della porta nel database e registra l'evento
         
@@ -202,6 +207,7 @@ class DoorEventService(BaseService):
             state: Nuovo stato della porta ('open' o 'closed')
             timestamp: Data e ora dell'evento
             is_regular: Flag che indica se l'evento è regolare
+            schedule: Orari di assunzione compilati, se già letti dal chiamante
         """
         if not self.db_service:
             print(f"Impossibile aggiornare stato porta: servizio database non disponibile")
@@ -224,13 +230,13 @@ class DoorEventService(BaseService):
                 "regularity": "regular" if is_regular else "irregular"
             }
             
-            # Aggiungi l'evento alla lista degli eventi porta
-            update_operation = {
-                "$push": {
-                    "data.door_events": event_data
-                }
-            }
-            self.db_service.update_dr("dispenser_medicine", dispenser_id, update_operation)
+            # Aggiungi l'evento alla serie temporale degli eventi porta
+            self.db_service.append_telemetry("door_events", dispenser_id, event_data)
+
+            # Aggiorna il riepilogo giornaliero dell'aderenza
+            get_adherence_store(self.db_service).record_door_event(
+                dispenser_id, state, timestamp, schedule=schedule
+            )
             
             print(f"Stato porta aggiornato per dispenser {dispenser_id}: {state}, regolare: {is_regular}")
         
@@ -0,0 +1,53 @@
+"""
+Viste parziali dei dispenser costruite sulle proiezioni del DatabaseService.
+
+Ogni vista legge solo i campi che servono al chiamante e restituisce un
+documento con la stessa struttura annidata della Digital Replica (``_id``,
+``user_db_id``, ``data.*``), così le funzioni che già accettano un dispenser
+completo funzionano senza modifiche.
+"""
+from typing import Dict, List, Optional, Tuple
+
+DISPENSER_TYPE = "dispenser_medicine"
+
+LIMITS_FIELDS = ["data.temperature_limits", "data.humidity_limits"]
+SCHEDULE_FIELDS = ["user_db_id", "data.name", "data.medicine_time", "data.frequency_per_day"]
+OWNER_FIELDS = ["user_db_id", "data.name"]
+
+
+def get_schedule(db_service, dispenser_id: str) -> Optional[Dict]:
+    """Intervalli di assunzione configurati (data.medicine_time, data.frequency_per_day)"""
+    return db_service.get_dr(DISPENSER_TYPE, dispenser_id, projection=SCHEDULE_FIELDS)
+
+
+def get_owner(db_service, dispenser_id: str) -> Optional[Dict]:
+    """Proprietario e nome del dispenser, per i controlli di accesso"""
+    return db_service.get_dr(DISPENSER_TYPE, dispenser_id, projection=OWNER_FIELDS)
+
+
+def get_environmental_limits(db_service, dispenser_id: str) -> Optional[Dict[str, Tuple[float, float]]]:
+    """
+    Limiti ambientali personalizzati del dispenser.
+
+    Returns:
+        Dict con le chiavi "temperature"/"humidity" presenti e valide,
+        None se il dispenser non esiste
+    """
+    device = db_service.get_dr(DISPENSER_TYPE, dispenser_id, projection=LIMITS_FIELDS)
+    if not device:
+        return None
+
+    limits = {}
+    data = device.get("data", {})
+    for key, field in (("temperature", "temperature_limits"), ("humidity", "humidity_limits")):
+        value = data.get(field)
+        if value and len(value) == 2:
+            limits[key] = tuple(value)
+    return limits
+
+
+def list_owned_dispensers(db_service, user_db_id: str, fields: Optional[List[str]] = None) -> List[Dict]:
+    """Dispenser di un utente, con i soli campi richiesti (default: il nome)"""
+    return db_service.query_drs(
+        DISPENSER_TYPE, {"user_db_id": user_db_id}, projection=fields or ["data.name"]
+    )
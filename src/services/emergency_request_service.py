@@ -1,3 +1,4 @@
+import asyncio
 from datetime import datetime
 from src.services.base import BaseService
 from flask import current_app
@@ -65,15 +66,13 @@ class EmergencyRequestService(BaseService):
         
         # Registra l'evento nel database
         if self.db_service:
-            # Aggiornamento del documento del dispositivo
+            # Storico nella serie temporale, stato corrente nel documento del dispositivo
+            self.db_service.append_telemetry("emergency_requests", device_id, {
+                "timestamp": timestamp.isoformat(),
+                "status": "active",
+                "resolved_at": None
+            })
             update_operation = {
-                "$push": {
-                    "data.emergency_requests": {
-                        "timestamp": timestamp.isoformat(),
-                        "status": "active",
-                        "resolved_at": None
-                    }
-                },
                 "$set": {
                     "data.emergency_active": True,
                     "data.last_emergency_request": timestamp.isoformat()
@@ -94,6 +93,10 @@ class EmergencyRequestService(BaseService):
             "notifications_sent": notifications_sent
         }
     
+    async def execute_async(self, device_id, dt_id, dt_name, timestamp=None):
+        """Versione asincrona di execute (l'accesso al DB resta su un thread)"""
+        return await asyncio.to_thread(self.execute, device_id, dt_id, dt_name, timestamp)
+
     def _send_emergency_notification(self, device_id, dt_id, dt_name):
         """Invia notifica di emergenza ai contatti configurati"""
         try:
@@ -106,11 +109,13 @@ class EmergencyRequestService(BaseService):
             )
             
             # Importa la funzione per inviare notifiche
-            from src.application.bot.notifications import send_notification_to_dt_users, send_generic_emergency_alert
+            from src.application.bot.notifications import (
+                PRIORITY_EMERGENCY, send_notification_to_dt_users, send_generic_emergency_alert
+            )
             
-            # Se dt_factory è disponibile, usa send_notification_to_dt_users
+            # Se dt_factory è disponibile, usa send_notification_to_dt_users (corsia prioritaria)
             if hasattr(self, 'dt_factory') and self.dt_factory:
-                return send_notification_to_dt_users(self.dt_factory, dt_id, message)
+                return send_notification_to_dt_users(self.dt_factory, dt_id, message, priority=PRIORITY_EMERGENCY)
             # Altrimenti usa send_generic_emergency_alert che non richiede dt_factory
             else:
                 return send_generic_emergency_alert(self.db_service, device_id)
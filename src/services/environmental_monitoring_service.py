@@ -1,7 +1,27 @@
+import asyncio
+import threading
 from src.services.base import BaseService
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Optional, Tuple
-from src.application.bot.notifications import send_environmental_alert
+from src.application.bot.notifications import send_environmental_alert, send_alert_resolved
+from src.services import dr_views
+from src.services.alert_state import FIRE, REPEAT, ESCALATE, RESOLVE, get_alert_engine
+
+# Limiti personalizzati per dispositivo, condivisi da tutte le istanze del servizio.
+# Vengono invalidati dal listener del DatabaseService quando i limiti cambiano.
+_LIMIT_FIELDS = ("data.temperature_limits", "data.humidity_limits")
+_custom_limits_cache: Dict[str, Dict[str, Tuple[float, float]]] = {}
+_custom_limits_lock = threading.Lock()
+_limits_listener_owners = set()
+
+
+def _on_dispenser_changed(dr_type, dr_id, changed_fields=None):
+    if dr_type != "dispenser_medicine":
+        return
+    if changed_fields is None or any(field.startswith(_LIMIT_FIELDS) for field in changed_fields):
+        with _custom_limits_lock:
+            _custom_limits_cache.pop(dr_id, None)
+
 
 class EnvironmentalMonitoringService(BaseService):
     """
@@ -134,25 +154,37 @@ class EnvironmentalMonitoringService(BaseService):
         # Se abbiamo accesso al database, ottieni limiti personalizzati
         if hasattr(self, 'db_service') and self.db_service:
             try:
-                device = self.db_service.get_dr("dispenser_medicine", device_id)
-                if device:
-                    # Ottieni i limiti personalizzati, se disponibili
-                    custom_temp_limits = device.get("data", {}).get("temperature_limits")
-                    if custom_temp_limits and len(custom_temp_limits) == 2:
-                        limits["temperature"] = tuple(custom_temp_limits)
-                        
-                    custom_humidity_limits = device.get("data", {}).get("humidity_limits")
-                    if custom_humidity_limits and len(custom_humidity_limits) == 2:
-                        limits["humidity"] = tuple(custom_humidity_limits)
+                limits.update(self._get_custom_limits(device_id))
             except Exception as e:
                 print(f"Errore nel recupero dei limiti ambientali: {e}")
                 
         return limits
 
-    def handle_environmental_data(self, db_service, dt_factory, device_id, env_data):
+    def _get_custom_limits(self, device_id: str) -> Dict[str, Tuple[float, float]]:
+        """Limiti personalizzati del dispositivo, letti dal database solo se non in cache"""
+        with _custom_limits_lock:
+            if id(self.db_service) not in _limits_listener_owners:
+                self.db_service.add_change_listener(_on_dispenser_changed)
+                _limits_listener_owners.add(id(self.db_service))
+            cached = _custom_limits_cache.get(device_id)
+        if cached is not None:
+            return cached
+
+        # Legge solo i due array dei limiti, non l'intero documento
+        custom_limits = dr_views.get_environmental_limits(self.db_service, device_id)
+        if custom_limits is None:
+            return {}
+        with _custom_limits_lock:
+            _custom_limits_cache[device_id] = custom_limits
+        return custom_limits
+
+    def handle_environmental_data(self, db_service, dt_factory, device_id, env_data, telemetry_buffer=None):
         """
         Gestisce i dati ambientali ricevuti da MQTT, li salva, controlla i limiti
         e invia notifiche in caso di allarme.
+
+        Se viene passato un ``telemetry_buffer`` la scrittura è differita e
+        raggruppata; il controllo dei limiti avviene comunque subito sul valore ricevuto.
         """
         self.db_service = db_service
         self.dt_factory = dt_factory
@@ -194,25 +226,24 @@ class EnvironmentalMonitoringService(BaseService):
             print(f"Warning: No valid measurements found in data from device {device_id}: {env_data}")
             return
 
-        # 3. Aggiorna il documento del dispenser nel database
-        update_operation = {
-            "$push": {
-                "data.environmental_data": {
-                    "$each": measurements_to_push
-                }
-            }
-        }
-        db_service.update_dr("dispenser_medicine", device_id, update_operation)
-        print(f"Successfully updated device {device_id} with data: {measurements_to_push}")
+        # 3. Salva le misurazioni nella serie temporale (o accoda nel buffer write-behind)
+        if telemetry_buffer is not None:
+            telemetry_buffer.add(device_id, measurements_to_push)
+        else:
+            db_service.append_telemetry("environmental", device_id, measurements_to_push)
+            print(f"Successfully stored data for device {device_id}: {measurements_to_push}")
 
         # 4. Controlla i limiti e invia le notifiche
-        # Ora questa chiamata userà il self.db_service appena impostato e troverà i limiti corretti
+        # Il motore degli allarmi notifica solo l'attivazione, i promemoria dopo il
+        # cooldown, l'escalation e il rientro: i campioni intermedi vengono soppressi
         limits = self.get_environmental_limits(device_id)
+        alert_engine = get_alert_engine(db_service)
         for measure_type, value in data_to_check.items():
             min_value, max_value = limits[measure_type]
             unit = "°C" if measure_type == "temperature" else "%"
 
-            if value < min_value or value > max_value:
+            action = alert_engine.evaluate_range(device_id, measure_type, value, min_value, max_value)
+            if action in (FIRE, REPEAT, ESCALATE):
                 print(f"ALERT: {measure_type} for device {device_id} is out of range! Value: {value}")
                 # Invia la notifica
                 send_environmental_alert(
@@ -223,8 +254,21 @@ class EnvironmentalMonitoringService(BaseService):
                     value=value,
                     unit=unit,
                     min_value=min_value,
-                    max_value=max_value
+                    max_value=max_value,
+                    escalated=action == ESCALATE
                 )
+            elif action == RESOLVE:
+                state = alert_engine.get_state(device_id, measure_type)
+                send_alert_resolved(db_service, dt_factory, device_id, measure_type,
+                                    since=state.get("since"), value=value, unit=unit)
+
+    async def handle_environmental_data_async(self, db_service, dt_factory, device_id, env_data,
+                                              telemetry_buffer=None):
+        """Versione asincrona di handle_environmental_data (l'accesso al DB resta su un thread)"""
+        return await asyncio.to_thread(
+            self.handle_environmental_data, db_service, dt_factory, device_id, env_data, telemetry_buffer
+        )
+
     def set_environmental_limits(self, device_id: str, 
                                limit_type: str, 
                                min_value: float, 
@@ -0,0 +1,152 @@
+from typing import Dict, List, Optional, Tuple
+
+# Indici della collezione digital_twins, che non ha un template YAML
+DIGITAL_TWIN_INDEXES = [
+    {"keys": [("name", 1)], "options": {"unique": True}},
+    {"keys": [("metadata.created_at", 1)], "options": {}},
+    {"keys": [("metadata.updated_at", 1)], "options": {}},
+    # Multikey: DT che contengono una replica (routing delle notifiche, ReplicaIndex)
+    {"keys": [("digital_replicas.id", 1), ("digital_replicas.type", 1)], "options": {}},
+    # DT di un utente (/list_dt, login, notifiche)
+    {"keys": [("metadata.user_id", 1)], "options": {}},
+    # Multikey: DT collegati a una chat Telegram
+    {"keys": [("metadata.active_telegram_ids", 1)], "options": {}},
+]
+
+_PROBE = "__index_self_check__"
+
+# Query frequenti da verificare con explain(): (descrizione, tipo DR o None per digital_twins, filtro)
+HOT_QUERIES = [
+    ("utente per username", "user", {"data.username": _PROBE}),
+    ("dispenser di un utente", "dispenser_medicine", {"user_db_id": _PROBE}),
+    ("DT di un utente", None, {"metadata.user_id": _PROBE}),
+    ("DT di una chat Telegram", None, {"metadata.active_telegram_ids": 0}),
+    ("DT che contengono una replica", None,
+     {"digital_replicas": {"$elemMatch": {"id": _PROBE, "type": "dispenser_medicine"}}}),
+]
+
+
+def _key(keys) -> Tuple:
+    """Chiave confrontabile di un indice: le direzioni numeriche possono arrivare come float"""
+    return tuple(
+        (field, int(direction) if isinstance(direction, (int, float)) else direction)
+        for field, direction in keys
+    )
+
+
+def ensure_indexes(collection, specs: List[Dict]) -> Dict[str, int]:
+    """
+    Crea gli indici mancanti di una collezione; quelli già presenti non vengono toccati.
+
+    Un indice esistente con le stesse chiavi ma opzioni diverse viene segnalato e
+    lasciato com'è: va sostituito a mano, perché ricrearlo richiederebbe un drop.
+
+    Returns:
+        Dict[str, int]: indici creati, già presenti e falliti
+    """
+    summary = {"created": 0, "existing": 0, "failed": 0}
+    existing = {_key(info["key"]): (name, info) for name, info in collection.index_information().items()}
+    for spec in specs:
+        keys = spec["keys"]
+        options = spec.get("options", {})
+        found = existing.get(_key(keys))
+        if found is not None:
+            name, info = found
+            if bool(info.get("unique")) != bool(options.get("unique")):
+                print(f"IndexManager: l'indice {collection.name}.{name} esiste con unique={bool(info.get('unique'))}, "
+                      f"il manifest richiede unique={bool(options.get('unique'))}")
+            summary["existing"] += 1
+            continue
+        try:
+            collection.create_index(keys, **options)
+            summary["created"] += 1
+        except Exception as e:
+            print(f"IndexManager: impossibile creare l'indice {keys} su {collection.name}: {e}")
+            summary["failed"] += 1
+    return summary
+
+
+def plan_stages(plan) -> List[str]:
+    """Stadi di un piano di esecuzione (anche annidati o nel formato SBE 'queryPlan')"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(plan_stages(item))
+    return stages
+
+
+class IndexManager:
+    """
+    Manifest degli indici costruito dai template YAML (sezione ``indexes``)
+    registrati nello SchemaRegistry, più quelli di digital_twins.
+
+    ``apply`` è idempotente e va chiamato all'avvio; ``verify`` esegue explain()
+    sulle query frequenti e segnala quelle che finiscono in COLLSCAN.
+    """
+
+    def __init__(self, db_service):
+        self.db_service = db_service
+        self.schema_registry = db_service.schema_registry
+
+    def _collection_name(self, dr_type: Optional[str]) -> str:
+        if dr_type is None:
+            return "digital_twins"
+        return self.schema_registry.get_collection_name(dr_type)
+
+    def manifest(self) -> Dict[str, List[Dict]]:
+        """Indici richiesti per collezione"""
+        manifest = {
+            self._collection_name(dr_type): self.schema_registry.get_indexes(dr_type)
+            for dr_type in self.schema_registry.schemas
+        }
+        manifest["digital_twins"] = DIGITAL_TWIN_INDEXES
+        return manifest
+
+    def apply(self) -> Dict[str, Dict[str, int]]:
+        """Crea gli indici mancanti di tutte le collezioni del manifest"""
+        if not self.db_service.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+        results = {}
+        for collection_name, specs in self.manifest().items():
+            if specs:
+                results[collection_name] = ensure_indexes(self.db_service.db[collection_name], specs)
+        created = sum(result["created"] for result in results.values())
+        failed = sum(result["failed"] for result in results.values())
+        print(f"IndexManager: {created} indici creati, {failed} falliti su {len(results)} collezioni")
+        return results
+
+    def verify(self) -> List[Dict]:
+        """
+        Esegue explain() sulle query frequenti.
+
+        Returns:
+            List[Dict]: per ogni query collezione, stadi del piano vincente e flag collscan
+        """
+        if not self.db_service.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+        report = []
+        for description, dr_type, query in HOT_QUERIES:
+            collection_name = self._collection_name(dr_type)
+            try:
+                explain = self.db_service.db[collection_name].find(query).explain()
+            except Exception as e:
+                print(f"IndexManager: explain fallito per '{description}': {e}")
+                continue
+            stages = plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+            collscan = "COLLSCAN" in stages
+            if collscan:
+                print(f"⚠️ IndexManager: la query '{description}' su {collection_name} esegue un COLLSCAN {query}")
+            report.append({
+                "query": description,
+                "collection": collection_name,
+                "stages": stages,
+                "collscan": collscan,
+            })
+        if not any(entry["collscan"] for entry in report):
+            print(f"IndexManager: {len(report)} query frequenti verificate, nessun COLLSCAN")
+        return report
@@ -1,7 +1,10 @@
 
 from src.services.base import BaseService
-from datetime import datetime, timedelta
-from src.application.mqtt import send_mqtt_message
+from datetime import datetime
+from src.application.mqtt import send_mqtt_message_async
+from src.services.alert_state import get_alert_engine
+from src.services.adherence import TAKEN, LATE, day_status, dose_taken, get_adherence_store, local_days
+from src.services.medication_schedule import get_compiled_schedule, invalidate_schedule
 import json
 
 class MedicationReminderService(BaseService):
@@ -12,7 +15,6 @@ class MedicationReminderService(BaseService):
         self.name = "MedicationReminderService"
         self.time_based_reminders = {}  
         self.last_notification_sent = {}
-        self.missed_dose_notifications = {}
         self.min_notification_interval = 3600  # 1 ora
         
     def execute(self, dt_data, **kwargs):
@@ -27,34 +29,23 @@ class MedicationReminderService(BaseService):
     def _check_time_based_reminder(self, dispenser):
         """Verifica se è il momento di inviare un promemoria basato sull'orario configurato"""
         dispenser_id = dispenser.get("_id")
-        medicine_time = dispenser.get("data", {}).get("medicine_time")
+        schedule = get_compiled_schedule(dispenser)
         
-        if not medicine_time:
-            return False
-            
-        start_time = medicine_time.get("start")
-        end_time = medicine_time.get("end")
-        
-        if not start_time or not end_time:
+        if not schedule:
             return False
             
         try:
-            # Converti gli orari in oggetti datetime
             now = datetime.now()
             today_str = now.strftime("%Y-%m-%d")
             
-            start_dt = datetime.strptime(f"{today_str} {start_time}", "%Y-%m-%d %H:%M")
-            end_dt = datetime.strptime(f"{today_str} {end_time}", "%Y-%m-%d %H:%M")
-            
             # Verifica l'ultima notifica inviata (ora usa timestamp completo)
             last_sent = self.last_notification_sent.get(dispenser_id)
             
             # Invia il promemoria solo se:
             # 1. Non è già stato inviato recentemente (nell'intervallo minimo)
-            # 2. L'ora attuale è entro un minuto dall'inizio dell'intervallo
-            time_diff = (now - start_dt).total_seconds()
-            
-            if (not last_sent or (now - last_sent).total_seconds() > self.min_notification_interval) and 0 <= time_diff <= 60:
+            # 2. L'ora attuale è entro un minuto dall'inizio di una delle finestre di assunzione
+            if ((not last_sent or (now - last_sent).total_seconds() > self.min_notification_interval)
+                    and schedule.starting_window(now, 60) is not None):
                 # Registra l'invio di questa notifica
                 self.last_notification_sent[dispenser_id] = now
                 
@@ -85,18 +76,24 @@ class MedicationReminderService(BaseService):
         # Invia il messaggio MQTT
         try:
             print(f"DEBUG: Invio notifica MQTT a {topic}: '{message}'")
-            # Mettiamo l'aggiornamento del timestamp DOPO l'invio riuscito
-            send_mqtt_message(message, topic)
-            
-            # Aggiorniamo l'ultimo invio SOLO dopo un invio riuscito
-            self.last_notification_sent[dispenser_id] = now
-            
-            # Aggiungiamo al dizionario di monitoraggio
-            if dispenser_id not in self.time_based_reminders:
-                self.time_based_reminders[dispenser_id] = {}
-            self.time_based_reminders[dispenser_id][now.strftime("%Y-%m-%d")] = now
-            
-            print(f"✅ [{now.strftime('%H:%M:%S')}] Inviata notifica MQTT a {topic} per {medicine_name}")
+            # Invio non bloccante sulla connessione persistente: l'esito arriva sulla Future
+            future = send_mqtt_message_async(message, topic)
+
+            def on_sent(f):
+                if not f.result():
+                    print(f"❌ Conferma MQTT non ricevuta per {topic}: il promemoria verrà ritentato")
+                    return
+                # Aggiorniamo l'ultimo invio SOLO dopo un invio riuscito (conferma del broker)
+                self.last_notification_sent[dispenser_id] = now
+
+                # Aggiungiamo al dizionario di monitoraggio
+                if dispenser_id not in self.time_based_reminders:
+                    self.time_based_reminders[dispenser_id] = {}
+                self.time_based_reminders[dispenser_id][now.strftime("%Y-%m-%d")] = now
+                print(f"✅ [{now.strftime('%H:%M:%S')}] Confermata notifica MQTT a {topic} per {medicine_name}")
+
+            future.add_done_callback(on_sent)
+            print(f"[{now.strftime('%H:%M:%S')}] Accodata notifica MQTT a {topic} per {medicine_name}")
             return True
         except Exception as e:
             print(f"❌ Errore nell'invio del messaggio MQTT: {repr(e)}")
@@ -107,6 +104,9 @@ class MedicationReminderService(BaseService):
         Aggiorna gli orari di assunzione per un dispenser specifico
         Può essere chiamato direttamente dal handler per aggiornare il servizio
         """
+        # Gli orari compilati del dispenser non sono più validi
+        invalidate_schedule(dispenser_id)
+        
         # Resetta eventuali promemoria precedenti per questo dispenser
         if dispenser_id in self.time_based_reminders:
             del self.time_based_reminders[dispenser_id]
@@ -132,23 +132,14 @@ class MedicationReminderService(BaseService):
         if status in ["empty", "error"]:
             return False
         
-        # Verifica se esiste medicine_time invece dell'intervallo
-        medicine_time = dispenser_data.get("medicine_time", {})
-        start_time = medicine_time.get("start")
-        end_time = medicine_time.get("end")
-        
         # Se non ci sono orari configurati, non inviare promemoria
-        if not start_time or not end_time:
+        schedule = get_compiled_schedule(dispenser)
+        if not schedule:
             return False
         
         try:
-            # Converti gli orari in oggetti datetime
-            today_str = now.strftime("%Y-%m-%d")
-            start_dt = datetime.strptime(f"{today_str} {start_time}", "%Y-%m-%d %H:%M")
-            end_dt = datetime.strptime(f"{today_str} {end_time}", "%Y-%m-%d %H:%M")
-            
-            # Se non siamo nell'intervallo orario, non inviare promemoria
-            if not (start_dt <= now <= end_dt):
+            # Se non siamo in una finestra di assunzione, non inviare promemoria
+            if not schedule.is_within(now):
                 return False
                 
             # Verifica quante dosi sono già state prese oggi
@@ -210,21 +201,24 @@ class MedicationReminderService(BaseService):
         dispensers = [dr for dr in dt_data.get("digital_replicas", []) if dr.get("type") == "dispenser_medicine"]
         
         now = datetime.now()
-        today = now.strftime("%Y-%m-%d")
+        
+        # Riepiloghi giornalieri di oggi e degli ultimi 3 giorni per tutti i dispenser, con una query;
+        # i giorni sono quelli locali del fuso degli orari di ogni dispenser (chiavi delle righe)
+        check_days = {d.get("_id"): local_days(d, 4, now) for d in dispensers}
+        adherence_store = get_adherence_store(self.db_service)
+        rows = adherence_store.get_days(
+            check_days, sorted({day for days in check_days.values() for day in days})
+        )
         
         for dispenser in dispensers:
             dispenser_id = dispenser.get("_id")
             dispenser_name = dispenser.get("data", {}).get("name", "medicinale")
-            regularity = dispenser.get("data", {}).get("regularity", [])
-            
-            # Controlla se negli ultimi giorni ci sono state assunzioni mancate
-            missing_days = 0
             
-            for i in range(1, 4):  # controlla gli ultimi 3 giorni
-                check_date = (now.date() - timedelta(days=i)).strftime("%Y-%m-%d")
-                day_entries = [r for r in regularity if r.get("date") == check_date]
-                if not day_entries:
-                    missing_days += 1
+            # Controlla se negli ultimi 3 giorni ci sono state assunzioni mancate
+            missing_days = sum(
+                1 for day in check_days[dispenser_id][:-1]
+                if day_status(rows.get((dispenser_id, day))) not in (TAKEN, LATE)
+            )
             
             if missing_days >= threshold:
                 alerts.append({
@@ -236,95 +230,67 @@ class MedicationReminderService(BaseService):
                     "timestamp": datetime.now()
                 })
 
-            # Verifica se oggi è mancata una dose nell'intervallo configurato
-            medicine_time = dispenser.get("data", {}).get("medicine_time", {})
-            if medicine_time:
-                start_time = medicine_time.get("start")
-                end_time = medicine_time.get("end")
-                
-                if start_time and end_time:
-                    try:
-                        # Converti gli orari in oggetti datetime
-                        end_dt = datetime.strptime(f"{today} {end_time}", "%Y-%m-%d %H:%M")
+            # Verifica se oggi è mancata la dose dell'ultima finestra di assunzione terminata
+            # (lo scheduler esegue il controllo alla fine di ogni finestra)
+            schedule = get_compiled_schedule(dispenser)
+            last_ended = schedule.last_ended_window(now) if schedule else None
+            if last_ended is not None:
+                window = schedule.windows[last_ended]
+                try:
+                    # Verifica nello stato degli allarmi se la notifica per questo
+                    # dispenser e intervallo orario è già stata inviata oggi
+                    alert_engine = get_alert_engine(self.db_service)
+                    notification_key = f"{check_days[dispenser_id][-1]}_{window.start_time}_{window.end_time}"
+                    if alert_engine.get_state(dispenser_id, "missed_dose").get("last_token") == notification_key:
+                        # Già inviata notifica per oggi, salta
+                        continue
+                    
+                    # Se il riepilogo di oggi non registra un'assunzione completa
+                    # nella finestra, aggiungiamo un alert e notifichiamo
+                    if not dose_taken(rows.get((dispenser_id, check_days[dispenser_id][-1])), last_ended):
+                        # Aggiungiamo l'alert
+                        alerts.append({
+                            "type": "today_missed_dose",
+                            "dispenser_id": dispenser_id,
+                            "dispenser_name": dispenser_name,
+                            "scheduled_time": window.label,
+                            "severity": "high",
+                            "timestamp": now
+                        })
                         
-                        # Se siamo DOPO la fine dell'intervallo di assunzione, verifichiamo se c'è stata un'assunzione
-                        if now > end_dt:
-                            # Verificare se esiste già una notifica per questo dispenser e intervallo orario oggi
-                            missed_notifications = dispenser.get("data", {}).get("missed_dose_notifications", [])
-                            notification_key = f"{today}_{start_time}_{end_time}"
-                            
-                            # Verifica se questa notifica è già stata inviata oggi
-                            if notification_key in missed_notifications:
-                                # Già inviata notifica per oggi, salta
-                                continue
+                        # Invia una notifica al supervisore
+                        try:
+                            from src.application.bot.notifications import send_adherence_notification
                             
-                            # Verifica se c'è stata un'assunzione nell'intervallo
-                            door_events = dispenser.get("data", {}).get("door_events", [])
-                            today_events = [e for e in door_events if e.get("timestamp", "").startswith(today)]
-                            
-                            # Filtriamo gli eventi nell'intervallo di assunzione
-                            open_events = False
-                            close_events = False
-                            
-                            for event in today_events:
-                                timestamp = event.get("timestamp", "")
-                                if "T" in timestamp:
-                                    event_time = timestamp.split("T")[1][:5]  # Estrae HH:MM
-                                    if start_time <= event_time <= end_time:
-                                        state = event.get("state", "")
-                                        if state == "open":
-                                            open_events = True
-                                        elif state == "closed":
-                                            close_events = True
-                            
-                            # Se non c'è stata un'assunzione completa, aggiungiamo un alert e notifichiamo
-                            if not (open_events and close_events):
-                                # Aggiungiamo l'alert
-                                alerts.append({
-                                    "type": "today_missed_dose",
-                                    "dispenser_id": dispenser_id,
-                                    "dispenser_name": dispenser_name,
-                                    "scheduled_time": f"{start_time} - {end_time}",
-                                    "severity": "high",
-                                    "timestamp": now
+                            if (hasattr(self, 'db_service') and self.db_service and hasattr(self, 'dt_factory') and self.dt_factory
+                                    and alert_engine.evaluate_event(dispenser_id, "missed_dose", token=notification_key)):
+                                # Prepara i dettagli per la notifica
+                                details = {
+                                    "scheduled_time": window.label
+                                }
+                                
+                                # Invia la notifica per dose mancata
+                                send_adherence_notification(
+                                    self.db_service,
+                                    self.dt_factory,
+                                    dispenser_id,
+                                    "missed_dose",
+                                    details
+                                )
+                                
+                                
+                                # Registra la notifica inviata nella serie temporale del dispenser
+                                self.db_service.append_telemetry("missed_doses", dispenser_id, {
+                                    "key": notification_key,
+                                    "timestamp": now.isoformat()
                                 })
                                 
-                                # Invia una notifica al supervisore
-                                try:
-                                    from src.application.bot.notifications import send_adherence_notification
-                                    
-                                    if hasattr(self, 'db_service') and self.db_service and hasattr(self, 'dt_factory') and self.dt_factory:
-                                        # Prepara i dettagli per la notifica
-                                        details = {
-                                            "scheduled_time": f"{start_time} - {end_time}"
-                                        }
-                                        
-                                        # Invia la notifica per dose mancata
-                                        send_adherence_notification(
-                                            self.db_service,
-                                            self.dt_factory,
-                                            dispenser_id,
-                                            "missed_dose",
-                                            details
-                                        )
-                                        
-                                        
-                                        # Aggiungi questa notifica all'elenco delle notifiche inviate per questo dispenser
-                                        update_operation = {
-                                            "$addToSet": {  # Usa $addToSet per evitare duplicati
-                                                "data.missed_dose_notifications": notification_key
-                                            }
-                                        }
-                                        self.db_service.update_dr("dispenser_medicine", dispenser_id, update_operation)
-                                        
-                                        print(f"Inviata notifica per dose mancata del dispenser {dispenser_name} ({start_time}-{end_time})")
-                                except Exception as e:
-                                    print(f"Errore nell'invio della notifica per dose mancata: {e}")
-                    
-                    except ValueError as e:
-                        print(f"Errore nel parsing degli orari di medicina: {e}")
-                    except Exception as e:
-                        print(f"Errore nel controllo dose mancata per dispenser {dispenser.get('_id')}: {e}")
+                                print(f"Inviata notifica per dose mancata del dispenser {dispenser_name} ({window.label})")
+                        except Exception as e:
+                            print(f"Errore nell'invio della notifica per dose mancata: {e}")
+                
+                except Exception as e:
+                    print(f"Errore nel controllo dose mancata per dispenser {dispenser.get('_id')}: {e}")
                 
         return alerts
     
@@ -347,27 +313,19 @@ class MedicationReminderService(BaseService):
             return False
             
         # Verifica orario di assunzione
-        medicine_time = dispenser_data.get("data", {}).get("medicine_time", {})
-        start_time = medicine_time.get("start")
-        end_time = medicine_time.get("end")
-        
-        if not start_time or not end_time:
+        schedule = get_compiled_schedule(dispenser_data)
+        if not schedule:
             return False
             
         try:
-            # Converti gli orari in oggetti datetime
             today_str = timestamp.strftime("%Y-%m-%d")
             
-            start_dt = datetime.strptime(f"{today_str} {start_time}", "%Y-%m-%d %H:%M")
-            end_dt = datetime.strptime(f"{today_str} {end_time}", "%Y-%m-%d %H:%M")
-            
             # Verifica l'ultima notifica inviata (ora usa timestamp completo)
             last_sent = self.last_notification_sent.get(dispenser_id)
             
-            
-            time_diff = (timestamp - start_dt).total_seconds()
-            
-            if (not last_sent or (timestamp - last_sent).total_seconds() > self.min_notification_interval) and 0 <= time_diff <= 60:
+            # Promemoria entro un minuto dall'inizio di una delle finestre di assunzione
+            if ((not last_sent or (timestamp - last_sent).total_seconds() > self.min_notification_interval)
+                    and schedule.starting_window(timestamp, 60) is not None):
                 # Registra l'invio di questa notifica
                 self.last_notification_sent[dispenser_id] = timestamp
                 
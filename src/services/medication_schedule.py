@@ -0,0 +1,232 @@
+"""
+Orari di assunzione dei dispenser precompilati in minuti dalla mezzanotte.
+
+Il campo ``data.medicine_time`` ({start, end} in "HH:MM") viene convertito una
+sola volta in un ``CompiledSchedule``; promemoria, regolarità degli eventi
+porta, dosi mancate e scadenze dello scheduler confrontano poi interi invece
+di ricostruire e interpretare stringhe di date a ogni chiamata.
+
+Più dosi al giorno:
+
+- ``medicine_time.doses``: lista esplicita di intervalli ``[{start, end}, ...]``
+- altrimenti, con ``frequency_per_day`` > 1, l'intervallo configurato viene
+  ripetuto ogni 24h / frequenza (solo se le finestre non si sovrappongono;
+  le finestre che attraverserebbero la mezzanotte vengono scartate)
+
+Il fuso orario degli orari è ``medicine_time.timezone`` oppure
+SCHEDULE_TIMEZONE; se non configurato si usa l'ora locale del server.
+"""
+import threading
+from datetime import date, datetime, time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:  # Python < 3.9: solo ora locale del server
+    ZoneInfo = None
+    ZoneInfoNotFoundError = KeyError
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_minutes(value: str) -> int:
+    """Converte "HH:MM" in minuti dalla mezzanotte"""
+    hours, minutes = str(value).strip().split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"Orario non valido: {value}")
+    return hours * 60 + minutes
+
+
+def format_minutes(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+class DoseWindow(NamedTuple):
+    """Intervallo di assunzione di una dose, in minuti dalla mezzanotte (estremi inclusi)"""
+    start: int
+    end: int
+
+    @property
+    def label(self) -> str:
+        return f"{format_minutes(self.start)} - {format_minutes(self.end)}"
+
+    @property
+    def start_time(self) -> str:
+        return format_minutes(self.start)
+
+    @property
+    def end_time(self) -> str:
+        return format_minutes(self.end)
+
+
+class CompiledSchedule:
+    """Finestre di assunzione giornaliere di un dispenser"""
+
+    __slots__ = ("windows", "tz")
+
+    def __init__(self, windows: List[DoseWindow], tz=None):
+        self.windows: Tuple[DoseWindow, ...] = tuple(sorted(windows))
+        self.tz = tz
+
+    def __repr__(self) -> str:
+        return f"CompiledSchedule({', '.join(w.label for w in self.windows)}, tz={self.tz})"
+
+    def local(self, timestamp: datetime) -> datetime:
+        """Istante nel fuso degli orari (i datetime naive sono considerati ora locale del server)"""
+        return timestamp.astimezone(self.tz) if self.tz is not None else timestamp
+
+    def local_date(self, timestamp: datetime) -> date:
+        return self.local(timestamp).date()
+
+    def second_of_day(self, timestamp: datetime) -> int:
+        t = self.local(timestamp)
+        return t.hour * 3600 + t.minute * 60 + t.second
+
+    def window_index(self, timestamp: datetime) -> Optional[int]:
+        """Indice della finestra che contiene l'istante (None se fuori da tutte)"""
+        second = self.second_of_day(timestamp)
+        for i, window in enumerate(self.windows):
+            if window.start * 60 <= second <= window.end * 60:
+                return i
+        return None
+
+    def is_within(self, timestamp: datetime) -> bool:
+        return self.window_index(timestamp) is not None
+
+    def starting_window(self, timestamp: datetime, grace_seconds: int = 60) -> Optional[int]:
+        """Indice della finestra iniziata da al più ``grace_seconds`` secondi"""
+        second = self.second_of_day(timestamp)
+        for i, window in enumerate(self.windows):
+            if 0 <= second - window.start * 60 <= grace_seconds:
+                return i
+        return None
+
+    def ended_windows(self, timestamp: datetime) -> List[int]:
+        """Indici delle finestre di oggi già terminate"""
+        second = self.second_of_day(timestamp)
+        return [i for i, window in enumerate(self.windows) if second > window.end * 60]
+
+    def last_ended_window(self, timestamp: datetime) -> Optional[int]:
+        ended = self.ended_windows(timestamp)
+        return ended[-1] if ended else None
+
+    def occurrences(self, day: date, edge: str = "start") -> List[datetime]:
+        """
+        Inizi (o fini, con ``edge="end"``) delle finestre di un giorno del fuso
+        degli orari, come datetime naive nell'ora locale del server.
+        """
+        result = []
+        for window in self.windows:
+            minutes = window.start if edge == "start" else window.end
+            at = datetime.combine(day, time(minutes // 60, minutes % 60))
+            if self.tz is not None:
+                at = at.replace(tzinfo=self.tz).astimezone().replace(tzinfo=None)
+            result.append(at)
+        return result
+
+
+def _load_timezone(name: Optional[str]):
+    if not name:
+        from config.settings import SCHEDULE_TIMEZONE
+        name = SCHEDULE_TIMEZONE
+    if not name or ZoneInfo is None:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        print(f"MedicationSchedule: fuso orario non valido '{name}', uso l'ora locale: {e}")
+        return None
+
+
+def _source(data: Dict) -> tuple:
+    """Campi da cui dipende lo schedule compilato (per riconoscere una versione superata)"""
+    medicine_time = data.get("medicine_time") or {}
+    doses = medicine_time.get("doses") or ()
+    return (
+        medicine_time.get("start"),
+        medicine_time.get("end"),
+        data.get("frequency_per_day"),
+        medicine_time.get("timezone"),
+        tuple((dose.get("start"), dose.get("end")) for dose in doses if isinstance(dose, dict)),
+    )
+
+
+def compile_schedule(data: Dict) -> Optional[CompiledSchedule]:
+    """
+    Compila gli orari dai campi ``data`` di un dispenser.
+
+    Returns:
+        CompiledSchedule, o None se non è configurato nessun intervallo valido
+    """
+    start, end, frequency, timezone, doses = _source(data)
+
+    windows = []
+    for dose_start, dose_end in doses or ((start, end),):
+        if not dose_start or not dose_end:
+            continue
+        window = DoseWindow(parse_minutes(dose_start), parse_minutes(dose_end))
+        if window.start > window.end:
+            raise ValueError(f"Intervallo di assunzione non valido: {dose_start} - {dose_end}")
+        windows.append(window)
+    if not windows:
+        return None
+
+    try:
+        frequency = int(frequency or 1)
+    except (TypeError, ValueError):
+        frequency = 1
+    if not doses and frequency > 1:
+        base = windows[0]
+        step = MINUTES_PER_DAY // frequency
+        # Ripete l'intervallo solo se le dosi restano finestre distinte
+        if base.end - base.start < step:
+            windows = []
+            for k in range(frequency):
+                shifted = DoseWindow((base.start + k * step) % MINUTES_PER_DAY,
+                                     (base.end + k * step) % MINUTES_PER_DAY)
+                if shifted.start <= shifted.end:
+                    windows.append(shifted)
+
+    return CompiledSchedule(windows, tz=_load_timezone(timezone))
+
+
+_cache: Dict[str, Tuple[tuple, Optional[CompiledSchedule]]] = {}
+_cache_lock = threading.Lock()
+
+
+def get_compiled_schedule(dispenser: Dict) -> Optional[CompiledSchedule]:
+    """
+    Schedule compilato di un dispenser, dalla cache se gli orari non sono cambiati.
+
+    Args:
+        dispenser: Documento (anche parziale, vedi dr_views.SCHEDULE_FIELDS) con ``_id`` e ``data``
+
+    Returns:
+        CompiledSchedule, o None se gli orari mancano o non sono validi
+    """
+    dispenser_id = dispenser.get("_id")
+    data = dispenser.get("data", {})
+    source = _source(data)
+
+    with _cache_lock:
+        cached = _cache.get(dispenser_id)
+    if cached is not None and cached[0] == source:
+        return cached[1]
+
+    try:
+        schedule = compile_schedule(data)
+    except ValueError as e:
+        print(f"MedicationSchedule: orari non validi per il dispenser {dispenser_id}: {e}")
+        schedule = None
+    if dispenser_id is not None:
+        with _cache_lock:
+            _cache[dispenser_id] = (source, schedule)
+    return schedule
+
+
+def invalidate_schedule(dispenser_id: str) -> None:
+    """Scarta lo schedule compilato di un dispenser (dopo una modifica degli orari)"""
+    with _cache_lock:
+        _cache.pop(dispenser_id, None)
+
@@ -0,0 +1,335 @@
+import math
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+
+from src.services.scheduler_leases import MongoLeaseStore
+
+# Finestre interrogabili: granularità dei rollup e numero di periodi da unire
+WINDOWS = {
+    "hour": ("hour", 1),
+    "24h": ("hour", 24),
+    "day": ("day", 1),
+    "7d": ("day", 7),
+    "30d": ("day", 30),
+    "all": ("all", 1),
+}
+
+# Lease che impedisce a due istanze di ricostruire i rollup insieme (somme raddoppiate)
+REBUILD_LEASE = "rollups_rebuild"
+REBUILD_LEASE_TTL = 3600
+
+# Chiave del periodo ricavata dal timestamp ISO del campione
+_PERIOD_LENGTH = {"hour": 13, "day": 10}
+_PERIOD_STEP = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+
+class RunningStats:
+    """
+    Statistiche incrementali (algoritmo di Welford): conteggio, media, M2,
+    minimo e massimo, aggiornabili un valore alla volta e unibili tra loro
+    senza conservare i singoli campioni.
+    """
+
+    __slots__ = ("count", "mean", "m2", "min", "max")
+
+    def __init__(self, count: int = 0, mean: float = 0.0, m2: float = 0.0,
+                 min: Optional[float] = None, max: Optional[float] = None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.min = min
+        self.max = max
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: "RunningStats") -> "RunningStats":
+        """Unisce un altro accumulatore (formula parallela di Chan)"""
+        if not other.count:
+            return self
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def stddev(self) -> float:
+        """Deviazione standard campionaria (come statistics.stdev)"""
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0
+
+    def to_dict(self) -> Dict:
+        return {"count": self.count, "mean": self.mean, "min": self.min, "max": self.max, "stddev": self.stddev}
+
+    def to_update(self) -> Dict:
+        """Aggiornamento additivo del documento salvato: più processi possono applicarlo in parallelo"""
+        total = self.mean * self.count
+        return {
+            "$inc": {"count": self.count, "sum": total, "sum_sq": self.m2 + total * self.mean},
+            "$min": {"min": self.min},
+            "$max": {"max": self.max},
+        }
+
+    @classmethod
+    def from_document(cls, document: Dict) -> "RunningStats":
+        """Media e M2 ricavati da somma e somma dei quadrati del documento salvato"""
+        count = document.get("count", 0)
+        if not count:
+            return cls()
+        mean = document.get("sum", 0.0) / count
+        m2 = max(document.get("sum_sq", 0.0) - mean * document.get("sum", 0.0), 0.0)
+        return cls(count, mean, m2, document.get("min"), document.get("max"))
+
+
+class RollupStore:
+    """
+    Rollup orari, giornalieri e complessivi delle misure ambientali, per
+    dispositivo e tipo di misura.
+
+    Quando i campioni sono scritti nella serie "environmental" (listener del
+    DatabaseService) gli accumulatori della collezione ``telemetry_rollups``
+    vengono incrementati con $inc/$min/$max (conteggio, somma, somma dei
+    quadrati, minimo e massimo), quindi più istanze possono scrivere sugli
+    stessi periodi senza sovrascriversi; media e deviazione standard sono
+    ricavate in lettura. Le statistiche sono sempre lette dal database, così
+    ogni istanza vede anche i campioni ricevuti dalle altre. Una statistica su
+    una finestra unisce al più 30 accumulatori, indipendentemente da quanti
+    campioni sono stati ricevuti.
+
+    Senza database i rollup restano in memoria (solo gli ultimi
+    ``hours_retained`` periodi orari e ``days_retained`` giornalieri).
+    """
+
+    def __init__(self, db_service=None, hours_retained: int = 48, days_retained: int = 90,
+                 collection_name: str = "telemetry_rollups"):
+        self.db_service = db_service
+        self.hours_retained = hours_retained
+        self.days_retained = days_retained
+        self.collection_name = collection_name
+        # Solo senza database: device_id -> measure_type -> {"hour": {periodo: stats}, "day": {...}, "all": {...}}
+        self._rollups: Dict[str, Dict[str, Dict[str, Dict[str, RunningStats]]]] = {}
+        self._indexed = False
+        self._lock = threading.RLock()
+
+    def attach(self, db_service) -> None:
+        """Collega lo store al DatabaseService e ai suoi aggiornamenti di telemetria"""
+        self.db_service = db_service
+        db_service.add_telemetry_listener(self.on_telemetry)
+
+    def on_telemetry(self, series: str, samples_by_device: Dict[str, List[Dict]]) -> None:
+        if series != "environmental":
+            return
+        for device_id, samples in samples_by_device.items():
+            self.ingest(device_id, samples)
+
+    def ingest(self, device_id: str, samples: Iterable[Dict], persist: bool = True) -> int:
+        """
+        Aggiorna i rollup con i campioni ``{"type", "value", "timestamp"}`` di un dispositivo.
+
+        Returns:
+            int: Numero di campioni numerici considerati
+        """
+        ingested = 0
+        deltas: Dict[tuple, RunningStats] = {}  # (measure_type, granularity, periodo) -> campioni del lotto
+        for sample in samples:
+            measure_type = sample.get("type") or sample.get("measure_type")
+            try:
+                value = float(sample.get("value"))
+            except (TypeError, ValueError):
+                continue
+            if not measure_type or math.isnan(value):
+                continue
+
+            timestamp = sample.get("timestamp") or datetime.now().isoformat()
+            if isinstance(timestamp, datetime):
+                timestamp = timestamp.isoformat()
+
+            for granularity, length in _PERIOD_LENGTH.items():
+                deltas.setdefault((measure_type, granularity, timestamp[:length]), RunningStats()).add(value)
+            deltas.setdefault((measure_type, "all", "all"), RunningStats()).add(value)
+            ingested += 1
+
+        if not deltas:
+            return ingested
+        collection = self._collection() if persist else None
+        if collection is not None:
+            self._persist(collection, device_id, deltas)
+            return ingested
+        with self._lock:
+            device = self._rollups.setdefault(device_id, {})
+            for (measure_type, granularity, period), stats in deltas.items():
+                rollup = device.setdefault(measure_type, {"hour": {}, "day": {}, "all": {}})
+                rollup[granularity].setdefault(period, RunningStats()).merge(stats)
+            for measure_type in {key[0] for key in deltas}:
+                self._prune(device[measure_type])
+        return ingested
+
+    def get_stats(self, device_id: str, measure_type: str, window: str = "all",
+                  now: Optional[datetime] = None) -> RunningStats:
+        """Statistiche di un dispositivo su una finestra (vedi WINDOWS)"""
+        if window not in WINDOWS:
+            raise ValueError(f"Finestra non valida: {window} (valori ammessi: {', '.join(WINDOWS)})")
+        granularity, periods = WINDOWS[window]
+        now = now or datetime.now()
+
+        if granularity == "all":
+            keys = ["all"]
+        else:
+            keys = [(now - i * _PERIOD_STEP[granularity]).isoformat()[:_PERIOD_LENGTH[granularity]]
+                    for i in range(periods)]
+
+        result = RunningStats()
+        collection = self._collection()
+        if collection is not None:
+            ids = [self._document_id(device_id, measure_type, granularity, period) for period in keys]
+            for document in collection.find({"_id": {"$in": ids}}):
+                result.merge(RunningStats.from_document(document))
+            return result
+        with self._lock:
+            rollup = self._rollups.get(device_id, {}).get(measure_type)
+            if rollup:
+                for period in keys:
+                    stats = rollup[granularity].get(period)
+                    if stats:
+                        result.merge(stats)
+        return result
+
+    def measure_types(self, device_id: str) -> List[str]:
+        collection = self._collection()
+        if collection is not None:
+            return collection.distinct("measure_type", {"device_id": device_id, "granularity": "all"})
+        with self._lock:
+            return list(self._rollups.get(device_id, {}))
+
+    def rebuild(self) -> int:
+        """Ricalcola tutti i rollup dallo storico della serie environmental"""
+        if self.db_service is None or not self.db_service.is_connected():
+            return 0
+        collection = self._collection()
+        with self._lock:
+            self._rollups = {}
+            collection.delete_many({})
+            devices = set()
+            for bucket in self.db_service.db["telemetry_environmental"].find({}, {"device_id": 1, "samples": 1}):
+                device_id = bucket.get("device_id")
+                self.ingest(device_id, bucket.get("samples", []), persist=False)
+                devices.add(device_id)
+            for device_id in devices:
+                rollup_by_type = self._rollups.pop(device_id, {})
+                self._persist(collection, device_id, {
+                    (measure_type, granularity, period): stats
+                    for measure_type, rollup in rollup_by_type.items()
+                    for granularity, periods in rollup.items()
+                    for period, stats in periods.items()
+                })
+        print(f"RollupStore: ricalcolati i rollup di {len(devices)} dispositivi")
+        return len(devices)
+
+    def rebuild_if_needed(self) -> int:
+        """
+        Ricostruisce i rollup se ``needs_rebuild``, con un lease nella collezione
+        ``maintenance_leases``: le istanze avviate mentre un'altra sta ricostruendo
+        non cancellano né reincrementano lo storico.
+
+        Returns:
+            int: Numero di dispositivi ricostruiti (0 se non necessario o già in corso altrove)
+        """
+        if not self.needs_rebuild():
+            return 0
+        leases = MongoLeaseStore(self.db_service.db, "maintenance_leases")
+        owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        if not leases.acquire(REBUILD_LEASE, owner, REBUILD_LEASE_TTL):
+            print("RollupStore: ricostruzione dei rollup già in corso su un'altra istanza")
+            return 0
+        try:
+            # Un'altra istanza può aver terminato la ricostruzione prima che il lease fosse libero
+            if not self.needs_rebuild():
+                return 0
+            return self.rebuild()
+        finally:
+            leases.release(REBUILD_LEASE, owner)
+
+    def needs_rebuild(self) -> bool:
+        """Collezione vuota o con documenti nel vecchio formato assoluto (media/M2 senza somme)"""
+        collection = self._collection()
+        if collection is None:
+            return False
+        return (collection.find_one({}, {"_id": 1}) is None
+                or collection.find_one({"sum": {"$exists": False}}, {"_id": 1}) is not None)
+
+    def _collection(self):
+        if self.db_service is None or not self.db_service.is_connected():
+            return None
+        collection = self.db_service.db[self.collection_name]
+        if not self._indexed:
+            collection.create_index("device_id")
+            # I rollup orari e giornalieri scadono da soli dopo il periodo di conservazione
+            collection.create_index("expires_at", expireAfterSeconds=0)
+            self._indexed = True
+        return collection
+
+    def _prune(self, rollup: Dict) -> None:
+        for granularity, retained in (("hour", self.hours_retained), ("day", self.days_retained)):
+            periods = rollup[granularity]
+            if len(periods) > retained:
+                for period in sorted(periods)[:len(periods) - retained]:
+                    del periods[period]
+
+    @staticmethod
+    def _document_id(device_id: str, measure_type: str, granularity: str, period: str) -> str:
+        return f"{device_id}:{measure_type}:{granularity}:{period}"
+
+    def _persist(self, collection, device_id: str, deltas: Dict[tuple, RunningStats]) -> None:
+        operations = []
+        for (measure_type, granularity, period), stats in deltas.items():
+            update = stats.to_update()
+            fields = {"device_id": device_id, "measure_type": measure_type, "granularity": granularity,
+                      "period": period}
+            if granularity != "all":
+                retained = self.hours_retained if granularity == "hour" else self.days_retained
+                start = datetime.fromisoformat(period if granularity == "day" else f"{period}:00")
+                fields["expires_at"] = start + retained * _PERIOD_STEP[granularity]
+            update["$setOnInsert"] = fields
+            _id = self._document_id(device_id, measure_type, granularity, period)
+            operations.append(UpdateOne({"_id": _id}, update, upsert=True))
+        if operations:
+            try:
+                collection.bulk_write(operations, ordered=False)
+            except Exception as e:
+                print(f"RollupStore: errore nel salvataggio dei rollup di {device_id}: {e}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_rollup_store(db_service=None) -> RollupStore:
+    """Store condiviso dal processo; il primo db_service passato viene collegato"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = RollupStore()
+    if db_service is not None and _store.db_service is None:
+        with _store_lock:
+            if _store.db_service is None:
+                _store.attach(db_service)
+    return _store
@@ -0,0 +1,257 @@
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set
+
+try:
+    from pymongo.errors import DuplicateKeyError
+except ImportError:  # necessario solo con MongoLeaseStore
+    DuplicateKeyError = None
+
+MEMBER_PREFIX = "member:"
+
+
+def shard_of(key: str, num_shards: int) -> int:
+    """Shard di una chiave (es. l'ID di un DT), stabile tra processi"""
+    return zlib.crc32(str(key).encode("utf-8")) % num_shards
+
+
+class LocalLeaseStore:
+    """
+    Lease in memoria, condivisi solo dai manager dello stesso processo.
+    Ha la stessa interfaccia di MongoLeaseStore; utile con un solo processo o in sviluppo.
+    """
+
+    def __init__(self):
+        self._leases: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, shard: int, owner: str, ttl: float) -> bool:
+        now = datetime.utcnow()
+        with self._lock:
+            lease = self._leases.get(str(shard))
+            if lease and lease["owner"] != owner and lease["expires_at"] > now:
+                return False
+            self._leases[str(shard)] = {"owner": owner, "expires_at": now + timedelta(seconds=ttl)}
+            return True
+
+    def release(self, shard: int, owner: str) -> None:
+        with self._lock:
+            lease = self._leases.get(str(shard))
+            if lease and lease["owner"] == owner:
+                del self._leases[str(shard)]
+
+    def heartbeat_member(self, owner: str, ttl: float) -> None:
+        with self._lock:
+            self._leases[MEMBER_PREFIX + owner] = {
+                "owner": owner, "expires_at": datetime.utcnow() + timedelta(seconds=ttl)
+            }
+
+    def remove_member(self, owner: str) -> None:
+        with self._lock:
+            self._leases.pop(MEMBER_PREFIX + owner, None)
+
+    def live_members(self) -> List[str]:
+        now = datetime.utcnow()
+        with self._lock:
+            return [
+                lease["owner"] for key, lease in self._leases.items()
+                if key.startswith(MEMBER_PREFIX) and lease["expires_at"] > now
+            ]
+
+
+class MongoLeaseStore:
+    """
+    Lease salvati in una collezione MongoDB condivisa da tutte le istanze.
+
+    Ogni shard è un documento ``{_id: "<shard>", owner, expires_at}``; l'acquisizione
+    è un ``find_one_and_update`` con upsert che riesce solo se il lease è libero,
+    scaduto o già nostro. Le scadenze sono in UTC: gli orologi dei nodi devono
+    essere sincronizzati con un margine molto inferiore al TTL.
+    """
+
+    def __init__(self, db, collection_name: str = "scheduler_leases"):
+        if DuplicateKeyError is None:
+            raise ImportError("MongoLeaseStore richiede il pacchetto 'pymongo'")
+        self.collection = db[collection_name]
+        self.collection.create_index("expires_at")
+
+    def acquire(self, shard: int, owner: str, ttl: float) -> bool:
+        now = datetime.utcnow()
+        try:
+            self.collection.find_one_and_update(
+                {"_id": str(shard), "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            # Il documento esiste ed è di un altro proprietario ancora valido
+            return False
+
+    def release(self, shard: int, owner: str) -> None:
+        self.collection.delete_one({"_id": str(shard), "owner": owner})
+
+    def heartbeat_member(self, owner: str, ttl: float) -> None:
+        self.collection.update_one(
+            {"_id": MEMBER_PREFIX + owner},
+            {"$set": {"owner": owner, "expires_at": datetime.utcnow() + timedelta(seconds=ttl)}},
+            upsert=True,
+        )
+
+    def remove_member(self, owner: str) -> None:
+        self.collection.delete_one({"_id": MEMBER_PREFIX + owner})
+
+    def live_members(self) -> List[str]:
+        cursor = self.collection.find(
+            {"_id": {"$regex": f"^{MEMBER_PREFIX}"}, "expires_at": {"$gt": datetime.utcnow()}},
+            {"owner": 1},
+        )
+        return [doc["owner"] for doc in cursor]
+
+
+class ShardLeaseManager:
+    """
+    Assegna a questo processo una parte degli shard dei Digital Twin.
+
+    Ogni ``heartbeat`` secondi il manager rinnova i propri lease, calcola la quota
+    equa (shard / istanze attive), rilascia gli shard in eccesso e acquisisce
+    quelli liberi o scaduti. Se un'istanza termina senza rilasciare i lease, le
+    altre ne rilevano gli shard entro ``ttl`` secondi.
+
+    Ogni shard ha anche una scadenza locale (istante prima del rinnovo + ttl -
+    ``safety_margin``): se un rinnovo si blocca (es. attesa della selezione del
+    server MongoDB) ``owns`` restituisce False prima che un'altra istanza possa
+    acquisire lo shard, così i controlli non vengono eseguiti due volte.
+    """
+
+    def __init__(self, store, num_shards: int, owner_id: Optional[str] = None,
+                 ttl: float = 30, heartbeat: Optional[float] = None,
+                 on_change: Optional[Callable[[Set[int], Set[int]], None]] = None,
+                 safety_margin: Optional[float] = None):
+        """
+        Args:
+            store: LocalLeaseStore o MongoLeaseStore
+            num_shards: Numero totale di shard
+            owner_id: Identificativo di questa istanza (default: host:pid:random)
+            ttl: Durata di un lease in secondi
+            heartbeat: Intervallo di rinnovo (default: ttl / 3)
+            on_change: Callback (acquisiti, persi) quando cambiano gli shard posseduti
+            safety_margin: Secondi tolti al ttl per la scadenza locale (default: ttl / 10),
+                copre la differenza tra gli orologi delle istanze
+        """
+        self.store = store
+        self.num_shards = num_shards
+        self.owner_id = owner_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.ttl = ttl
+        self.heartbeat = heartbeat or ttl / 3
+        self.on_change = on_change
+        self.safety_margin = ttl / 10 if safety_margin is None else safety_margin
+        self._owned: Dict[int, float] = {}  # shard -> scadenza locale (time.monotonic)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self.rebalance()
+        self._thread = threading.Thread(target=self._run, name="scheduler-leases", daemon=True)
+        self._thread.start()
+        print(f"ShardLeaseManager: {self.owner_id} avviato, shard posseduti: {sorted(self._owned)}")
+
+    def stop(self) -> None:
+        """Rilascia subito i lease, così le altre istanze li rilevano senza attendere il TTL"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        with self._lock:
+            owned, self._owned = self._owned, {}
+        for shard in owned:
+            try:
+                self.store.release(shard, self.owner_id)
+            except Exception as e:
+                print(f"ShardLeaseManager: errore nel rilascio dello shard {shard}: {e}")
+        try:
+            self.store.remove_member(self.owner_id)
+        except Exception as e:
+            print(f"ShardLeaseManager: errore nella rimozione dell'istanza: {e}")
+
+    def owns(self, key: str) -> bool:
+        """True se la chiave (es. l'ID di un DT) appartiene a uno shard di questa istanza"""
+        shard = shard_of(key, self.num_shards)
+        with self._lock:
+            deadline = self._owned.get(shard)
+        return deadline is not None and time.monotonic() < deadline
+
+    def owned_shards(self) -> Set[int]:
+        now = time.monotonic()
+        with self._lock:
+            return {shard for shard, deadline in self._owned.items() if now < deadline}
+
+    def _acquire(self, shard: int) -> bool:
+        """Acquisisce o rinnova un lease e ne aggiorna la scadenza locale"""
+        started = time.monotonic()
+        acquired = self.store.acquire(shard, self.owner_id, self.ttl)
+        with self._lock:
+            if acquired:
+                self._owned[shard] = started + self.ttl - self.safety_margin
+            else:
+                self._owned.pop(shard, None)
+        return acquired
+
+    def rebalance(self) -> None:
+        """Rinnova, rilascia e acquisisce lease fino alla quota equa"""
+        self.store.heartbeat_member(self.owner_id, self.ttl)
+        members = max(1, len(self.store.live_members()))
+        target = math.ceil(self.num_shards / members)
+
+        with self._lock:
+            previous = set(self._owned)
+
+        owned = set()
+        for shard in sorted(previous):
+            if self._acquire(shard):
+                owned.add(shard)
+
+        # Cede gli shard in eccesso alle istanze appena arrivate (smette di eseguirli prima del rilascio)
+        while len(owned) > target:
+            shard = max(owned)
+            owned.discard(shard)
+            with self._lock:
+                self._owned.pop(shard, None)
+            self.store.release(shard, self.owner_id)
+
+        # Parte da un offset diverso per ogni istanza per ridurre la contesa
+        offset = zlib.crc32(self.owner_id.encode("utf-8")) % self.num_shards
+        for i in range(self.num_shards):
+            if len(owned) >= target:
+                break
+            shard = (offset + i) % self.num_shards
+            if shard not in owned and self._acquire(shard):
+                owned.add(shard)
+
+        gained, lost = owned - previous, previous - owned
+        if (gained or lost) and self.on_change:
+            try:
+                self.on_change(gained, lost)
+            except Exception as e:
+                print(f"ShardLeaseManager: errore nel callback on_change: {e}")
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.heartbeat):
+            try:
+                self.rebalance()
+            except Exception as e:
+                # Senza rinnovo i lease scadono: meglio non eseguire nulla che eseguire due volte
+                print(f"ShardLeaseManager: errore nel rinnovo dei lease: {e}")
+                with self._lock:
+                    lost, self._owned = set(self._owned), {}
+                if lost and self.on_change:
+                    self.on_change(set(), lost)
@@ -1,140 +1,482 @@
+import heapq
+import itertools
 import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+from src.services.medication_schedule import get_compiled_schedule
+
+DISPENSER_TYPE = "dispenser_medicine"
+
+# Campi del dispenser da cui dipendono le scadenze: una scrittura su altri campi
+# (es. last_reminder_sent) non richiede di ricalcolarle
+_SCHEDULE_FIELDS = ("data.medicine_time", "data.frequency_per_day", "data.door_status", "data.last_door_event")
+
+# Margine sulle riletture incrementali: copre scritture in corso e orologi non allineati tra istanze
+_RESYNC_OVERLAP = timedelta(seconds=5)
+
 
 class SchedulerService:
-    """Servizio schedulatore che esegue periodicamente i servizi dei Digital Twin"""
-    
-    def __init__(self, dt_factory, db_service=None, interval=60):
+    """
+    Schedulatore a eventi dei servizi dei Digital Twin.
+
+    Per ogni dispenser collegato ad almeno un DT viene calcolato il prossimo
+    istante rilevante:
+
+    - ``reminder``: inizio della prossima finestra di assunzione (promemoria)
+    - ``window_end``: fine della finestra (controllo di aderenza / dose mancata)
+    - ``door``: apertura della porta + soglia (allarme porta aperta), ripetuto
+      ogni ``interval`` secondi finché la porta resta aperta
+
+    Con più dosi al giorno (vedi medication_schedule) le due scadenze seguono
+    una finestra dopo l'altra.
+
+    Le scadenze sono tenute in una coda di priorità e il thread dorme fino alla
+    più vicina. Quando cambiano gli orari, lo stato della porta o i collegamenti
+    di un dispenser ai DT vengono ricalcolate solo le sue scadenze, quindi il
+    lavoro è proporzionale agli eventi in scadenza e non al numero di installazioni.
+
+    I controlli scaduti nello stesso risveglio (tick) vengono eseguiti in
+    parallelo, uno per coppia DT/dispenser, su un pool di ``workers`` thread: un
+    invio MQTT o Telegram lento non blocca gli altri DT. Il tick attende al massimo
+    ``tick_deadline`` secondi, poi prosegue (overrun); un controllo ancora in corso
+    non viene accodato di nuovo finché non termina.
+
+    Con più istanze dell'applicazione si passa un ``lease_manager``
+    (vedi scheduler_leases): ogni istanza esegue solo i controlli dei DT che
+    cadono negli shard di cui possiede il lease, così nessuna notifica parte due volte.
+    I listener vedono solo le scritture del proprio processo: ogni
+    ``resync_interval`` secondi (default: heartbeat dei lease) l'istanza legge
+    solo i DT e i dispenser con ``metadata.updated_at`` successivo all'ultima
+    rilettura e ricalcola quelli dei propri DT modificati altrove (porta aperta,
+    nuovi orari, collegamenti). Solo a un cambio di shard (takeover) collegamenti
+    e dispenser posseduti vengono riletti per intero.
+    """
+
+    def __init__(self, dt_factory, db_service=None, interval=60, door_threshold_minutes=1,
+                 workers=8, tick_deadline=30, lease_manager=None, resync_interval=None):
         """
         Inizializza il servizio di scheduling
-        
+
         Args:
             dt_factory: Factory per accedere ai Digital Twin
             db_service: Servizio database per accesso ai dati
-            interval: Intervallo di esecuzione in secondi (default: 60s)
+            interval: Secondi tra due allarmi successivi per la stessa porta aperta (default: 60s)
+            door_threshold_minutes: Minuti di apertura dopo cui la porta genera un allarme
+            workers: Thread che eseguono i controlli in parallelo
+            tick_deadline: Secondi massimi di attesa dei controlli di un tick
+            lease_manager: ShardLeaseManager per la modalità partizionata (None = tutti i DT)
+            resync_interval: Secondi tra due riletture dei dispenser posseduti (solo con lease_manager)
         """
         self.dt_factory = dt_factory
-        self.db_service = db_service
+        self.db_service = db_service or dt_factory.db_service
         self.interval = interval
+        self.door_threshold_minutes = door_threshold_minutes
+        self.workers = workers
+        self.tick_deadline = tick_deadline
+        self.lease_manager = lease_manager
+        self.resync_interval = resync_interval or (lease_manager.heartbeat if lease_manager else None)
+        if lease_manager and lease_manager.on_change is None:
+            # Gli shard acquisiti (es. takeover) vanno riletti subito
+            lease_manager.on_change = self._on_shards_changed
         self.running = False
         self.thread = None
-    
+        self._executor = None
+        self._in_flight = set()  # (dt_id, dispenser_id, kind) in esecuzione
+        self._condition = threading.Condition()
+        self._heap = []
+        self._sequence = itertools.count()
+        self._deadlines = {}  # dispenser_id -> {kind: datetime}
+        self._fired = {}  # (dispenser_id, kind) -> datetime dell'ultima esecuzione
+        self._dirty = set()
+        self._sources = {}  # dispenser_id -> valori di _SCHEDULE_FIELDS usati per le scadenze
+        self._next_resync = None
+        self._resynced_at = None  # istante (UTC) dell'ultima rilettura dal database
+        self._force_resync = False
+        self._listening = False
+        self.metrics = {
+            "ticks": 0, "fired": 0, "twins_processed": 0, "skipped": 0, "not_owned": 0, "overruns": 0,
+            "recomputed": 0, "resyncs": 0, "last_tick_seconds": 0.0, "max_tick_seconds": 0.0,
+        }
+
     def start(self):
         """Avvia lo scheduler in un thread separato"""
         if self.running:
             print("Scheduler già in esecuzione")
             return
-        
+
+        if not self._listening:
+            self.db_service.add_change_listener(self._on_dispenser_changed)
+            self.dt_factory.add_link_listener(self._on_link_changed)
+            self._listening = True
+
+        if self.lease_manager:
+            self.lease_manager.start()
+
+        started_at = datetime.now(timezone.utc)
+        dispenser_ids = self._linked_dispensers()
+        with self._condition:
+            self._dirty.update(dispenser_ids)
         self.running = True
+        if self.lease_manager:
+            self._next_resync = time.monotonic() + self.resync_interval
+            self._resynced_at = started_at
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scheduler")
         self.thread = threading.Thread(target=self._run_scheduler)
         self.thread.daemon = True
         self.thread.start()
-        print(f"Scheduler avviato - esecuzione servizi ogni {self.interval} secondi")
-    
+        print(f"Scheduler avviato - {len(dispenser_ids)} dispenser da pianificare")
+
     def stop(self):
         """Ferma lo scheduler"""
-        self.running = False
+        with self._condition:
+            self.running = False
+            self._condition.notify_all()
         if self.thread:
             self.thread.join(timeout=5)
-            print("Scheduler fermato")
-    
+        if self._executor:
+            # I controlli in corso terminano da soli, quelli non ancora avviati vengono annullati
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self.lease_manager:
+            self.lease_manager.stop()
+        print("Scheduler fermato")
+
+    def reschedule(self, dispenser_id):
+        """Richiede il ricalcolo delle scadenze di un dispenser"""
+        with self._condition:
+            self._dirty.add(dispenser_id)
+            self._condition.notify_all()
+
+    def get_stats(self):
+        with self._condition:
+            stats = dict(self.metrics)
+            stats["dispensers"] = len(self._deadlines)
+            stats["queued"] = len(self._heap)
+            stats["in_flight"] = len(self._in_flight)
+        if self.lease_manager:
+            stats["owned_shards"] = sorted(self.lease_manager.owned_shards())
+        return stats
+
+    def _on_dispenser_changed(self, dr_type, dr_id, changed_fields=None):
+        """Listener del DatabaseService: ricalcola solo se cambiano orari o stato porta"""
+        if dr_type != DISPENSER_TYPE:
+            return
+        if changed_fields is None or any(field.startswith(_SCHEDULE_FIELDS) for field in changed_fields):
+            self.reschedule(dr_id)
+
+    def _on_link_changed(self, dr_type, dr_id):
+        """Listener del DTFactory: un dispenser è stato collegato o scollegato da un DT"""
+        if dr_type == DISPENSER_TYPE:
+            self.reschedule(dr_id)
+
+    def _on_shards_changed(self, gained, lost):
+        """Callback dello ShardLeaseManager: rilegge subito i dispenser degli shard acquisiti"""
+        if gained:
+            with self._condition:
+                self._force_resync = True
+                self._condition.notify_all()
+
+    def _linked_dispensers(self):
+        """ID dei dispenser collegati ad almeno un DT (una sola lettura dei DT)"""
+        dispenser_ids = set()
+        for dt_doc in self.dt_factory.list_dts():
+            for dr_ref in dt_doc.get("digital_replicas", []):
+                if dr_ref.get("type") == DISPENSER_TYPE:
+                    dispenser_ids.add(dr_ref.get("id"))
+        return dispenser_ids
+
     def _run_scheduler(self):
-        """Loop principale dello scheduler"""
-        while self.running:
+        """Loop principale: dorme fino alla prossima scadenza o a una richiesta di ricalcolo"""
+        while True:
+            with self._condition:
+                while self.running and not self._dirty and not self._force_resync:
+                    timeout = self._seconds_to_next_deadline()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    if self._next_resync is not None:
+                        resync_in = self._next_resync - time.monotonic()
+                        if resync_in <= 0:
+                            break
+                        timeout = resync_in if timeout is None else min(timeout, resync_in)
+                    self._condition.wait(timeout)
+                if not self.running:
+                    return
+                resync = self._force_resync or (
+                    self._next_resync is not None and time.monotonic() >= self._next_resync
+                )
+                force, self._force_resync = self._force_resync, False
+                dirty, self._dirty = self._dirty, set()
+
+            if resync:
+                self._next_resync = time.monotonic() + self.resync_interval
+                try:
+                    dirty |= self._changed_elsewhere(force)
+                except Exception as e:
+                    print(f"[Scheduler] Errore nella rilettura dei dispenser: {e}")
+
             try:
-                self._execute_dt_services()
+                with self._condition:
+                    due = self._pop_due(datetime.now())
+                if dirty:
+                    self._recompute(dirty)
+                if due:
+                    self._run_tick(due)
             except Exception as e:
-                print(f"Errore nell'esecuzione dei servizi DT: {e}")
-            
-            # Attendi l'intervallo configurato
-            time.sleep(self.interval)
-    
-    def _execute_dt_services(self):
-        """Esegue i servizi di tutti i Digital Twin"""
-        try:
-            # Ottieni tutti i Digital Twin dal database
-            dt_docs = self.dt_factory.list_dts()
-            print(f"[Scheduler] {datetime.now().strftime('%H:%M:%S')} - Esecuzione servizi per {len(dt_docs)} Digital Twin")
-            
-            for dt_doc in dt_docs:
-                dt_id = dt_doc.get("_id")
-                dt_name = dt_doc.get("name", "Unnamed DT")
-                
-                try:
-                    # Ottieni l'istanza del DT con tutti i suoi servizi
-                    dt_instance = self.dt_factory.get_dt_instance(dt_id)
-                    if not dt_instance:
+                print(f"[Scheduler] Errore nell'esecuzione dei servizi DT: {e}")
+
+    def _seconds_to_next_deadline(self):
+        # Le voci superate da un ricalcolo restano nella coda e vengono scartate qui
+        while self._heap:
+            when, _, dispenser_id, kind = self._heap[0]
+            if self._deadlines.get(dispenser_id, {}).get(kind) == when:
+                return (when - datetime.now()).total_seconds()
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, _, dispenser_id, kind = heapq.heappop(self._heap)
+            deadlines = self._deadlines.get(dispenser_id, {})
+            if deadlines.get(kind) == when:
+                del deadlines[kind]
+                due.append((dispenser_id, kind))
+        return due
+
+    @staticmethod
+    def _source(dispenser):
+        """Valori dei campi da cui dipendono le scadenze (per rilevare modifiche)"""
+        data = dispenser.get("data", {})
+        return tuple(repr(data.get(field.split(".", 1)[1])) for field in _SCHEDULE_FIELDS)
+
+    def _owned_dispensers(self, dispenser_ids):
+        """Dispenser collegati ad almeno un DT degli shard di questa istanza"""
+        return [
+            dispenser_id for dispenser_id in dispenser_ids
+            if any(self.lease_manager.owns(dt_id)
+                   for dt_id in self.dt_factory.find_dts_with_dr(DISPENSER_TYPE, dispenser_id))
+        ]
+
+    def _changed_elsewhere(self, force=False):
+        """
+        Dispenser dei DT posseduti modificati da altre istanze (o tutti se ``force``).
+
+        Rilegge solo i DT e i dispenser aggiornati dopo l'ultima rilettura (indici
+        su ``metadata.updated_at``): i collegamenti cambiati aggiornano il
+        ReplicaIndex, i campi di pianificazione vengono confrontati con quelli
+        usati nell'ultimo ricalcolo. Con ``force`` (shard acquisiti) ricarica
+        l'intero indice e tutti i dispenser posseduti.
+        """
+        now = datetime.now(timezone.utc)
+        index = self.dt_factory.replica_index
+        changed = set()
+        if force or self._resynced_at is None:
+            index.reload()
+            linked = index.replica_ids(DISPENSER_TYPE)
+            dispensers = self.db_service.get_drs_bulk(
+                DISPENSER_TYPE, self._owned_dispensers(linked), projection=list(_SCHEDULE_FIELDS)
+            )
+            with self._condition:
+                # Dispenser scollegati altrove: le loro scadenze vanno rimosse
+                changed |= set(self._deadlines) - set(linked)
+        else:
+            since = self._resynced_at - _RESYNC_OVERLAP
+            twins = self.db_service.db["digital_twins"].find(
+                {"metadata.updated_at": {"$gt": since}}, {"digital_replicas": 1}
+            )
+            for twin in twins:
+                before = set(index.twin_refs(twin["_id"]))
+                index.set_twin(twin["_id"], twin.get("digital_replicas", []))
+                changed |= {dr_id for dr_type, dr_id in before ^ set(index.twin_refs(twin["_id"]))
+                            if dr_type == DISPENSER_TYPE}
+            updated = self.db_service.query_drs(
+                DISPENSER_TYPE, {"metadata.updated_at": {"$gt": since}}, projection=list(_SCHEDULE_FIELDS)
+            )
+            owned = set(self._owned_dispensers(dispenser["_id"] for dispenser in updated))
+            dispensers = [dispenser for dispenser in updated if dispenser["_id"] in owned]
+
+        with self._condition:
+            changed |= {
+                dispenser["_id"] for dispenser in dispensers
+                if force or self._sources.get(dispenser["_id"]) != self._source(dispenser)
+            }
+            self.metrics["resyncs"] += 1
+        self._resynced_at = now
+        return changed
+
+    def _recompute(self, dispenser_ids):
+        """Ricalcola le scadenze dei dispenser indicati con un'unica lettura dal database"""
+        linked = [d for d in dispenser_ids if self.dt_factory.find_dts_with_dr(DISPENSER_TYPE, d)]
+        dispensers = self.db_service.get_drs_bulk(DISPENSER_TYPE, linked, projection=list(_SCHEDULE_FIELDS))
+        now = datetime.now()
+
+        with self._condition:
+            for dispenser_id in dispenser_ids:
+                self._deadlines.pop(dispenser_id, None)
+                self._sources.pop(dispenser_id, None)
+            for dispenser in dispensers:
+                self._sources[dispenser["_id"]] = self._source(dispenser)
+                deadlines = self._compute_deadlines(dispenser, now)
+                self._deadlines[dispenser["_id"]] = deadlines
+                for kind, when in deadlines.items():
+                    heapq.heappush(self._heap, (when, next(self._sequence), dispenser["_id"], kind))
+            self.metrics["recomputed"] += len(dispenser_ids)
+
+    def _compute_deadlines(self, dispenser, now):
+        """Prossimi istanti rilevanti di un dispenser"""
+        dispenser_id = dispenser["_id"]
+        data = dispenser.get("data", {})
+        deadlines = {}
+
+        schedule = get_compiled_schedule(dispenser)
+        if schedule:
+            today = schedule.local_date(now)
+            days = (today, today + timedelta(days=1))
+            # Il promemoria parte entro un minuto dall'inizio finestra (vedi check_reminders)
+            starts = [at for day in days for at in schedule.occurrences(day, "start")]
+            deadlines["reminder"] = self._next_occurrence(
+                dispenser_id, "reminder", starts, now, timedelta(seconds=60)
+            )
+            # La dose è mancata solo dopo la fine della finestra
+            ends = [at + timedelta(seconds=1) for day in days for at in schedule.occurrences(day, "end")]
+            deadlines["window_end"] = self._next_occurrence(dispenser_id, "window_end", ends, now, None)
+
+        last_door_event = data.get("last_door_event")
+        if data.get("door_status") == "open" and last_door_event:
+            try:
+                opened_at = (datetime.fromisoformat(last_door_event)
+                             if isinstance(last_door_event, str) else last_door_event)
+                when = opened_at + timedelta(minutes=self.door_threshold_minutes, seconds=1)
+                last_alert = self._fired.get((dispenser_id, "door"))
+                if last_alert and last_alert >= opened_at:
+                    when = max(when, last_alert + timedelta(seconds=self.interval))
+                deadlines["door"] = max(when, now)
+            except (TypeError, ValueError) as e:
+                print(f"[Scheduler] Timestamp porta non valido per il dispenser {dispenser_id}: {e}")
+
+        return deadlines
+
+    def _next_occurrence(self, dispenser_id, kind, occurrences, now, grace):
+        """
+        Prossima occorrenza di un evento tra quelle di oggi e domani (ordinate).
+
+        Le occorrenze già eseguite vengono saltate; una già passata viene
+        eseguita subito quando rientra in ``grace`` (o sempre se ``grace`` è
+        None), altrimenti si passa alla successiva.
+        """
+        last_fired = self._fired.get((dispenser_id, kind))
+        for at in occurrences:
+            if last_fired and last_fired >= at:
+                continue
+            if now < at:
+                return at
+            if grace is None or now <= at + grace:
+                return now
+        return occurrences[-1] + timedelta(days=1)
+
+    def _run_tick(self, due):
+        """Distribuisce i controlli scaduti sul pool e attende fino a tick_deadline"""
+        started = time.monotonic()
+        now = datetime.now()
+        futures = []
+
+        for dispenser_id, kind in due:
+            with self._condition:
+                self._fired[(dispenser_id, kind)] = now
+                self.metrics["fired"] += 1
+            for dt_id in self.dt_factory.find_dts_with_dr(DISPENSER_TYPE, dispenser_id):
+                if self.lease_manager and not self.lease_manager.owns(dt_id):
+                    # Il DT appartiene a uno shard di un'altra istanza
+                    with self._condition:
+                        self.metrics["not_owned"] += 1
+                    continue
+                job = (dt_id, dispenser_id, kind)
+                with self._condition:
+                    if job in self._in_flight:
+                        # Il controllo precedente non è ancora finito: non si accumulano esecuzioni
+                        self.metrics["skipped"] += 1
                         continue
-                    
-                    # Esegui servizi importanti come i promemoria
-                    self._execute_reminder_service(dt_instance, dt_name)
-                    
-                    # Esegui anche il controllo di aderenza per rilevare mancate assunzioni
-                    self._execute_adherence_check_service(dt_instance, dt_name)
-                    
-                    # Esegui anche il controllo delle porte
-                    self._execute_door_service(dt_instance, dt_name)
-                    
-                    
-                except Exception as e:
-                    print(f"[Scheduler] Errore nell'esecuzione dei servizi per DT {dt_name}: {e}")
-        
+                    self._in_flight.add(job)
+                futures.append(self._executor.submit(self._fire, *job))
+            # Programma la prossima occorrenza (domani, o il prossimo allarme porta)
+            self.reschedule(dispenser_id)
+
+        _, pending = wait(futures, timeout=self.tick_deadline)
+        elapsed = time.monotonic() - started
+        with self._condition:
+            self.metrics["ticks"] += 1
+            self.metrics["last_tick_seconds"] = round(elapsed, 3)
+            self.metrics["max_tick_seconds"] = max(self.metrics["max_tick_seconds"], round(elapsed, 3))
+            if pending:
+                self.metrics["overruns"] += 1
+        if pending:
+            print(f"[Scheduler] Tick oltre la scadenza di {self.tick_deadline}s: "
+                  f"{len(pending)} controlli ancora in corso su {len(futures)}")
+
+    def _fire(self, dt_id, dispenser_id, kind):
+        """Esegue il controllo scaduto di un dispenser su un DT (eseguito nel pool)"""
+        try:
+            dt_instance = self.dt_factory.get_dt_instance(dt_id)
+            if not dt_instance:
+                return
+            if kind == "reminder":
+                self._execute_reminder_service(dt_instance, dt_id, dispenser_id)
+            elif kind == "window_end":
+                self._execute_adherence_check_service(dt_instance, dt_id, dispenser_id)
+            elif kind == "door":
+                self._execute_door_service(dt_instance, dt_id, dispenser_id)
         except Exception as e:
-            print(f"[Scheduler] Errore generale nell'esecuzione dei servizi: {e}")
+            print(f"[Scheduler] Errore nell'esecuzione dei servizi per DT {dt_id}: {e}")
+        finally:
+            with self._condition:
+                self._in_flight.discard((dt_id, dispenser_id, kind))
+                self.metrics["twins_processed"] += 1
 
-    def _execute_reminder_service(self, dt_instance, dt_name):
-        """Esegue specificamente il servizio di promemoria medicinali (versione semplificata)."""
+    def _execute_reminder_service(self, dt_instance, dt_id, dispenser_id):
+        """Esegue il servizio di promemoria medicinali per un dispenser."""
         try:
-            # Controlla se il servizio esiste nel DT
             if dt_instance.get_service("MedicationReminderService"):
-                # Chiama direttamente il metodo orchestratore del DT.
-                # Il DT ha già accesso ai suoi dati e servizi.
-                result = dt_instance.execute_medication_reminders()
-                
+                result = dt_instance.execute_medication_reminders(dispenser_ids=[dispenser_id])
+
                 if result and result.get("promemoria_inviati", 0) > 0:
-                    print(f"[Scheduler] {dt_name}: Inviati {result['promemoria_inviati']} promemoria medicinali")
+                    print(f"[Scheduler] DT {dt_id}: Inviato promemoria per il dispenser {dispenser_id}")
         except Exception as e:
-            print(f"[Scheduler] Errore nell'esecuzione del servizio di promemoria per {dt_name}: {e}")
+            print(f"[Scheduler] Errore nell'esecuzione del servizio di promemoria per DT {dt_id}: {e}")
 
-    def _execute_adherence_check_service(self, dt_instance, dt_name):
-        """Esegue specificamente il controllo di aderenza per rilevare mancate assunzioni"""
+    def _execute_adherence_check_service(self, dt_instance, dt_id, dispenser_id):
+        """Esegue il controllo di aderenza di un dispenser a fine finestra di assunzione"""
         try:
             reminder_service = dt_instance.get_service("MedicationReminderService")
             if reminder_service:
-                # Ottieni i dati aggiornati del DT
-                dt_data = dt_instance.get_dt_data()
-                
+                dt_data = {"digital_replicas": dt_instance.get_replicas_by_type(DISPENSER_TYPE, [dispenser_id])}
+
                 # Passa le dipendenze necessarie al servizio
                 reminder_service.db_service = self.db_service
                 reminder_service.dt_factory = self.dt_factory
-                
-                # Esegui il controllo delle irregolarità di aderenza
+
                 alerts = reminder_service.check_adherence_irregularities(dt_data)
-                
-                if alerts and len(alerts) > 0:
-                    print(f"[Scheduler] {dt_name}: Rilevate {len(alerts)} irregolarità nell'assunzione dei medicinali")
-                
+
+                if alerts:
+                    print(f"[Scheduler] DT {dt_id}: Rilevate {len(alerts)} irregolarità nell'assunzione per {dispenser_id}")
+
         except Exception as e:
-            print(f"[Scheduler] Errore nel controllo di aderenza per {dt_name}: {e}")
-    
-    # All'interno della classe SchedulerService
-    def _execute_door_service(self, dt_instance, dt_name):
-        """Esegue specificamente il servizio di controllo porte."""
+            print(f"[Scheduler] Errore nel controllo di aderenza per DT {dt_id}: {e}")
+
+    def _execute_door_service(self, dt_instance, dt_id, dispenser_id):
+        """Esegue il controllo della porta di un dispenser rimasta aperta."""
         try:
-            # Verifica che il servizio esista nel DT
-            door_service = dt_instance.get_service("DoorEventService")
-            if door_service:
-                # Passa le dipendenze necessarie (db_service, dt_factory) 
-                # al metodo del DT che orchestra il monitoraggio.
+            if dt_instance.get_service("DoorEventService"):
                 result = dt_instance.execute_door_monitoring(
-                    db_service=self.db_service, 
-                    dt_factory=self.dt_factory
+                    threshold_minutes=self.door_threshold_minutes,
+                    db_service=self.db_service,
+                    dt_factory=self.dt_factory,
+                    dispenser_ids=[dispenser_id]
                 )
 
-                # Logga l'esito dell'operazione
                 if result and len(result.get("door_alerts", [])) > 0:
-                    print(f"[Scheduler] {dt_name}: Gestite {len(result['door_alerts'])} notifiche di porta aperta")
+                    print(f"[Scheduler] DT {dt_id}: Gestite {len(result['door_alerts'])} notifiche di porta aperta")
 
         except Exception as e:
-            print(f"[Scheduler] Errore nel controllo porte per {dt_name}: {e}")
\ No newline at end of file
+            print(f"[Scheduler] Errore nel controllo porte per DT {dt_id}: {e}")
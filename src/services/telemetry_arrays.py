@@ -0,0 +1,156 @@
+"""
+Serie temporali della telemetria come array NumPy.
+
+I campioni letti da ``DatabaseService.query_telemetry`` vengono convertiti
+una sola volta in coppie di array (``datetime64[us]``, ``float64``) per tipo
+di misura; filtri, statistiche e ricampionamento lavorano poi sugli array
+interi invece che campione per campione.
+"""
+from datetime import date, datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Union
+
+import numpy as np
+
+TIME_UNIT = "datetime64[us]"
+
+# Punti massimi di una curva nei grafici inviati su Telegram
+MAX_PLOT_POINTS = 500
+
+
+class Series(NamedTuple):
+    """Serie di una misura ordinata per tempo"""
+    times: np.ndarray
+    values: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+def empty_series() -> Series:
+    return Series(np.array([], dtype=TIME_UNIT), np.array([], dtype=np.float64))
+
+
+def _parse_times(timestamps: List) -> np.ndarray:
+    try:
+        return np.array(
+            [t.isoformat() if isinstance(t, (datetime, date)) else t for t in timestamps], dtype=TIME_UNIT
+        )
+    except (ValueError, TypeError):
+        # Formati non ISO (es. "YYYY-MM-DD HH:MM:SS" con spazio): conversione elemento per elemento
+        parsed = []
+        for t in timestamps:
+            try:
+                parsed.append(np.datetime64(str(t).replace(" ", "T").rstrip("Z"), "us"))
+            except ValueError:
+                parsed.append(np.datetime64("NaT"))
+        return np.array(parsed, dtype=TIME_UNIT)
+
+
+def _parse_values(values: List) -> np.ndarray:
+    try:
+        return np.array(values, dtype=np.float64)
+    except (ValueError, TypeError):
+        def to_float(value):
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return np.nan
+        return np.fromiter((to_float(v) for v in values), dtype=np.float64, count=len(values))
+
+
+def from_samples(samples: Iterable[Dict], key: str = "type") -> Dict[str, Series]:
+    """
+    Raggruppa i campioni ``{type, value, timestamp}`` per tipo di misura.
+
+    I campioni senza timestamp valido o con valore non numerico vengono scartati.
+    """
+    grouped: Dict[str, tuple] = {}
+    for sample in samples:
+        times, values = grouped.setdefault(sample.get(key), ([], []))
+        times.append(sample.get("timestamp"))
+        values.append(sample.get("value"))
+
+    result = {}
+    for measure_type, (times, values) in grouped.items():
+        if measure_type is None:
+            continue
+        times = _parse_times(times)
+        values = _parse_values(values)
+        valid = ~np.isnat(times) & ~np.isnan(values)
+        times, values = times[valid], values[valid]
+        order = np.argsort(times, kind="stable")
+        result[measure_type] = Series(times[order], values[order])
+    return result
+
+
+def load_series(db_service, device_id: str, start: Union[str, datetime, None] = None,
+                end: Union[str, datetime, None] = None, limit: Optional[int] = None,
+                series: str = "environmental") -> Dict[str, Series]:
+    """Legge una serie di telemetria di un dispositivo e la converte in array per tipo di misura"""
+    return from_samples(db_service.query_telemetry(series, device_id, start=start, end=end, limit=limit))
+
+
+def merge(parts: Iterable[Series]) -> Series:
+    """Unisce più serie (es. di dispositivi diversi) in una sola, ordinata per tempo"""
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return empty_series()
+    times = np.concatenate([part.times for part in parts])
+    values = np.concatenate([part.values for part in parts])
+    order = np.argsort(times, kind="stable")
+    return Series(times[order], values[order])
+
+
+def tail(series: Series, n: int) -> Series:
+    """Ultimi ``n`` campioni"""
+    return Series(series.times[-n:], series.values[-n:]) if n < len(series) else series
+
+
+def summarize(series: Series) -> Optional[Dict]:
+    """Conteggio, media, minimo, massimo, deviazione standard e ultimo valore (None se vuota)"""
+    if not len(series):
+        return None
+    values = series.values
+    return {
+        "count": int(values.size),
+        "mean": float(values.mean()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "stddev": float(values.std(ddof=1)) if values.size > 1 else 0,
+        "last_value": float(values[-1]),
+        "last_time": to_datetimes(series.times[-1:])[0],
+    }
+
+
+def lttb(series: Series, threshold: int = MAX_PLOT_POINTS) -> Series:
+    """
+    Riduce la serie a ``threshold`` punti con Largest-Triangle-Three-Buckets,
+    che mantiene picchi e avvallamenti visibili nel grafico.
+    """
+    n = len(series)
+    if threshold >= n or threshold < 3:
+        return series
+
+    x = series.times.astype(np.int64).astype(np.float64)
+    y = series.values
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_stop = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[stop:next_stop].mean()
+        avg_y = y[stop:next_stop].mean()
+        areas = np.abs(
+            (x[a] - avg_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return Series(series.times[selected], y[selected])
+
+
+def to_datetimes(times: np.ndarray) -> List[datetime]:
+    """Converte gli istanti in oggetti datetime (per matplotlib e per i messaggi)"""
+    return times.astype(TIME_UNIT).tolist()
@@ -0,0 +1,146 @@
+import threading
+import time
+from typing import Dict, List
+
+from src.services.database_service import TelemetryWriteError
+
+
+class TelemetryWriteBuffer:
+    """
+    Buffer write-behind per le misurazioni ambientali.
+
+    Le misurazioni vengono raggruppate per dispositivo e scritte con un'unica
+    ``bulk_write`` ogni ``flush_interval_ms`` millisecondi oppure appena si
+    accumulano ``max_batch_samples`` campioni. La memoria è limitata a
+    ``max_pending_samples``: oltre quella soglia ``add`` attende lo svuotamento
+    per al massimo ``put_timeout`` secondi e poi scarta i campioni.
+    ``stop`` esegue sempre un ultimo flush.
+    """
+
+    def __init__(self, db_service, flush_interval_ms: int = 1000, max_batch_samples: int = 500,
+                 max_pending_samples: int = 10000, put_timeout: float = 1.0,
+                 series: str = "environmental"):
+        self.db_service = db_service
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_batch_samples = max_batch_samples
+        self.max_pending_samples = max_pending_samples
+        self.put_timeout = put_timeout
+        self.series = series
+        self._pending: Dict[str, List[Dict]] = {}
+        self._pending_count = 0
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self.metrics = {"added": 0, "written": 0, "dropped": 0, "flushes": 0, "failed_flushes": 0}
+
+    def start(self) -> None:
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="telemetry-writer", daemon=True)
+        self._thread.start()
+        print("TelemetryWriteBuffer: avviato")
+
+    def stop(self, timeout: float = 10) -> None:
+        """Ferma il thread di scrittura e scrive tutti i campioni ancora in memoria"""
+        with self._condition:
+            if not self._running:
+                return
+            self._running = False
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+        self.flush()
+        print(f"TelemetryWriteBuffer: fermato, campioni scritti in totale: {self.metrics['written']}")
+
+    def add(self, device_id: str, samples: List[Dict]) -> bool:
+        """
+        Accoda le misurazioni di un dispositivo.
+
+        Returns:
+            bool: False se il buffer è rimasto pieno e i campioni sono stati scartati
+        """
+        if not samples:
+            return True
+        if not self._running:
+            # Senza thread di scrittura si torna alla scrittura diretta
+            self._write({device_id: list(samples)})
+            return True
+
+        with self._condition:
+            deadline = time.monotonic() + self.put_timeout
+            while self._pending_count + len(samples) > self.max_pending_samples:
+                self._condition.notify_all()  # sveglia il writer per liberare spazio
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._running:
+                    self.metrics["dropped"] += len(samples)
+                    print(f"TelemetryWriteBuffer: buffer pieno, scartati {len(samples)} campioni di {device_id}")
+                    return False
+                self._condition.wait(remaining)
+
+            self._pending.setdefault(device_id, []).extend(samples)
+            self._pending_count += len(samples)
+            self.metrics["added"] += len(samples)
+            if self._pending_count >= self.max_batch_samples:
+                self._condition.notify_all()
+        return True
+
+    def flush(self) -> int:
+        """Scrive subito tutti i campioni accodati, restituisce il numero di campioni scritti"""
+        with self._flush_lock:
+            with self._condition:
+                batch, self._pending = self._pending, {}
+                count, self._pending_count = self._pending_count, 0
+                self._condition.notify_all()
+            if not batch:
+                return 0
+            try:
+                self._write(batch)
+                self.metrics["written"] += count
+                return count
+            except TelemetryWriteError as e:
+                # Scrittura parziale: si rimettono in coda solo i bucket falliti
+                failed = sum(len(samples) for samples in e.failed.values())
+                self.metrics["failed_flushes"] += 1
+                self.metrics["written"] += count - failed
+                print(f"TelemetryWriteBuffer: flush parziale ({e}), {failed} campioni rimessi in coda")
+                self._requeue(e.failed, failed)
+                return count - failed
+            except Exception as e:
+                self.metrics["failed_flushes"] += 1
+                print(f"TelemetryWriteBuffer: flush fallito ({e}), campioni rimessi in coda")
+                self._requeue(batch, count)
+                return 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._condition:
+            stats = dict(self.metrics)
+            stats["pending"] = self._pending_count
+        return stats
+
+    def _write(self, batch: Dict[str, List[Dict]]) -> None:
+        self.db_service.append_telemetry_bulk(self.series, batch)
+        self.metrics["flushes"] += 1
+
+    def _requeue(self, batch: Dict[str, List[Dict]], count: int) -> None:
+        with self._condition:
+            if self._pending_count + count > self.max_pending_samples:
+                self.metrics["dropped"] += count
+                print(f"TelemetryWriteBuffer: spazio insufficiente, scartati {count} campioni")
+                return
+            # I campioni non scritti precedono quelli arrivati nel frattempo
+            for device_id, samples in batch.items():
+                self._pending[device_id] = samples + self._pending.get(device_id, [])
+            self._pending_count += count
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                if self._running and self._pending_count < self.max_batch_samples:
+                    self._condition.wait(self.flush_interval)
+                running = self._running
+            if not running:
+                return
+            self.flush()
@@ -1,6 +1,8 @@
 from datetime import datetime
 from typing import Dict, Any, Type, Optional, List, Union
 from pydantic import BaseModel, create_model, Field, field_validator
+import copy
+import threading
 import yaml
 import uuid
 
@@ -10,6 +12,9 @@ class DRFactory:
         self.schema = self._load_schema(schema_path)
         if not self.schema or "schemas" not in self.schema:
             raise ValueError(f"Invalid schema structure in {schema_path}")
+        # Pydantic models are built once per template, on first use
+        self._profile_model: Optional[Type[BaseModel]] = None
+        self._data_model: Optional[Type[BaseModel]] = None
 
     def _load_schema(self, path: str) -> Dict:
         try:
@@ -177,11 +182,17 @@ class DRFactory:
 
         return model
 
+    def _models(self):
+        """Profile and data models of the template (cached)"""
+        if self._profile_model is None or self._data_model is None:
+            self._profile_model = self._create_profile_model()
+            self._data_model = self._create_data_model()
+        return self._profile_model, self._data_model
+
     def create_dr(self, dr_type: str, initial_data: Dict[str, Any]) -> Dict:
         """Create a new Digital Replica instance"""
-        # Create Pydantic models for sections
-        ProfileModel = self._create_profile_model()
-        DataModel = self._create_data_model()
+        # Pydantic models for sections
+        ProfileModel, DataModel = self._models()
 
         # Initialize with required fields and defaults
         dr_dict = {
@@ -199,6 +210,8 @@ class DRFactory:
             self.schema["schemas"].get("validations", {}).get("initialization", {})
         )
         for section, defaults in init_values.items():
+            # The template is shared between calls: never hand out its objects
+            defaults = copy.deepcopy(defaults)
             if section == "metadata":
                 dr_dict["metadata"].update(defaults)
             elif section in [
@@ -232,9 +245,8 @@ class DRFactory:
 
     def update_dr(self, dr: Dict[str, Any], updates: Dict[str, Any]) -> Dict:
         """Update an existing Digital Replica"""
-        # Create Pydantic models
-        ProfileModel = self._create_profile_model()
-        DataModel = self._create_data_model()
+        # Pydantic models
+        ProfileModel, DataModel = self._models()
 
         updated_dr = dr.copy()
 
@@ -256,3 +268,16 @@ class DRFactory:
         updated_dr["metadata"]["updated_at"] = datetime.utcnow()
 
         return updated_dr
+
+
+_factories: Dict[str, DRFactory] = {}
+_factories_lock = threading.Lock()
+
+
+def get_dr_factory(schema_path: str) -> DRFactory:
+    """Shared DRFactory of a template: the YAML is parsed and the models built only once"""
+    with _factories_lock:
+        factory = _factories.get(schema_path)
+        if factory is None:
+            factory = _factories[schema_path] = DRFactory(schema_path)
+        return factory
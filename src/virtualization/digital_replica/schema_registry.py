@@ -1,10 +1,11 @@
-from typing import Dict, Any
+from typing import Dict, Any, List
 import yaml
 
 
 class SchemaRegistry:
     def __init__(self):
         self.schemas = {}
+        self.indexes = {}
 
     def load_schema(self, schema_type: str, yaml_path: str) -> None:
         """Load schema from YAML file"""
@@ -20,6 +21,7 @@ class SchemaRegistry:
                 raw_schema["schemas"]
             )
             self.schemas[schema_type] = validation_schema
+            self.indexes[schema_type] = self._parse_indexes(raw_schema.get("indexes") or [])
 
         except Exception as e:
             raise ValueError(f"Failed to load schema from {yaml_path}: {str(e)}")
@@ -27,33 +29,68 @@ class SchemaRegistry:
     def _convert_yaml_to_mongodb_schema(self, yaml_schema: Dict) -> Dict:
         """Convert YAML schema format to MongoDB $jsonSchema format"""
 
-        def convert_type(yaml_type: str) -> str:
-            """Convert YAML type to MongoDB BSON type"""
+        def convert_type(yaml_type: str):
+            """Convert YAML type to MongoDB BSON type(s), always allowing null"""
             type_mapping = {
                 "str": "string",
-                "int": "int",
-                "float": "double",
+                "int": ["int", "long"],
+                # Sensors may send integral values for float fields
+                "float": "number",
                 "bool": "bool",
-                "datetime": "date",
+                # Timestamps are written both as BSON dates and as ISO strings
+                "datetime": ["date", "string"],
                 "Dict": "object",
+                "object": "object",
                 "List": "array",
+                "list": "array",
+                "List[Dict]": "array",
+                "List[str]": "array",
             }
-            return type_mapping.get(yaml_type, yaml_type)
+            bson_type = type_mapping.get(yaml_type, yaml_type)
+            bson_types = bson_type if isinstance(bson_type, list) else [bson_type]
+            return bson_types + ["null"]
 
         def process_field(field_def):
             """Process a field definition from YAML to MongoDB format"""
             if isinstance(field_def, str):
                 return {"bsonType": convert_type(field_def)}
             elif isinstance(field_def, dict):
+                # Typed definition: {type: list, items: ...} or {type: object, properties: ...}
+                if isinstance(field_def.get("type"), str):
+                    schema = {"bsonType": convert_type(field_def["type"])}
+                    if "items" in field_def:
+                        schema["items"] = process_field(field_def["items"])
+                    if "properties" in field_def:
+                        schema["properties"] = {
+                            k: process_field(v) for k, v in field_def["properties"].items()
+                        }
+                    return schema
                 return {
                     "bsonType": "object",
                     "properties": {k: process_field(v) for k, v in field_def.items()},
                 }
             elif isinstance(field_def, list):
                 # Handle List[Dict] case
-                return {"bsonType": "array"}
+                return {"bsonType": convert_type("list")}
             return field_def
 
+        def convert_constraints(rules: Dict) -> Dict:
+            """Convert type_constraints rules to $jsonSchema keywords"""
+            constraints = {}
+            allowed = rules.get("enum", rules.get("allowed_values"))
+            if allowed is not None:
+                constraints["enum"] = list(allowed) + [None]
+            keywords = {
+                "min": "minimum",
+                "max": "maximum",
+                "min_length": "minLength",
+                "max_length": "maxLength",
+            }
+            for rule, keyword in keywords.items():
+                if rule in rules:
+                    constraints[keyword] = rules[rule]
+            return constraints
+
         # Process common fields
         properties = {}
         if "common_fields" in yaml_schema:
@@ -63,12 +100,20 @@ class SchemaRegistry:
         # Process entity fields
         if "entity" in yaml_schema and "data" in yaml_schema["entity"]:
             properties["data"] = process_field(yaml_schema["entity"]["data"])
+            data_properties = properties["data"]["properties"]
+            type_constraints = (yaml_schema.get("validations") or {}).get("type_constraints") or {}
+            for field_name, rules in type_constraints.items():
+                if field_name in data_properties and isinstance(rules, dict):
+                    data_properties[field_name].update(convert_constraints(rules))
 
         # Process validations if present
         required_fields = []
-        if "validations" in yaml_schema:
-            if "required" in yaml_schema["validations"]:
-                required_fields.extend(yaml_schema["validations"]["required"])
+        validations = yaml_schema.get("validations") or {}
+        if "required" in validations:
+            required_fields.extend(validations["required"])
+        # Root-level mandatory fields are always written at creation
+        root_fields = (validations.get("mandatory_fields") or {}).get("root") or []
+        required_fields.extend(f for f in root_fields if f not in ("_id", "type"))
 
         # Build final schema
         validation_schema = {
@@ -76,15 +121,32 @@ class SchemaRegistry:
                 "bsonType": "object",
                 "required": ["_id", "type"] + required_fields,
                 "properties": {
+                    **properties,
                     "_id": {"bsonType": "string"},
                     "type": {"bsonType": "string"},
-                    **properties,
                 },
             }
         }
 
         return validation_schema
 
+    def _parse_indexes(self, yaml_indexes: List) -> List[Dict]:
+        """Convert the YAML ``indexes`` section to (keys, options) index specs"""
+        allowed_options = {"name", "unique", "sparse", "expireAfterSeconds", "partialFilterExpression"}
+        indexes = []
+        for entry in yaml_indexes:
+            keys = entry.get("keys") if isinstance(entry, dict) else None
+            if not keys or not isinstance(keys, dict):
+                raise ValueError(f"Index definition without keys: {entry}")
+            unknown = set(entry) - allowed_options - {"keys"}
+            if unknown:
+                raise ValueError(f"Unsupported index options {sorted(unknown)} in {entry}")
+            indexes.append({
+                "keys": [(field, direction) for field, direction in keys.items()],
+                "options": {k: v for k, v in entry.items() if k != "keys"},
+            })
+        return indexes
+
     def get_collection_name(self, schema_type: str) -> str:
         """Get collection name for schema type"""
         return f"{schema_type}_collection"
@@ -94,3 +156,9 @@ class SchemaRegistry:
         if schema_type not in self.schemas:
             raise ValueError(f"Schema not found for type: {schema_type}")
         return self.schemas[schema_type]
+
+    def get_indexes(self, schema_type: str) -> List[Dict]:
+        """Get the index specs declared in the template of a type"""
+        if schema_type not in self.schemas:
+            raise ValueError(f"Schema not found for type: {schema_type}")
+        return self.indexes.get(schema_type, [])